@@ -0,0 +1,41 @@
+"""
+Load test comparing the sync (Flask) and async (ASGI) servers at rising
+concurrency. Start both against the same Mongo, e.g.
+    ./local.sh                    # Flask on :8000
+    ./local_async.sh              # uvicorn on :8001
+then run from the project root:
+    python -m bench.concurrency --path /cities/read?limit=50 \\
+        --levels 1,16,64,256
+Reports requests/s and p50/p99 latency per server and level.
+"""
+import argparse
+
+from bench.load import drive
+
+SERVERS = {
+    'sync': 'http://127.0.0.1:8000',
+    'async': 'http://127.0.0.1:8001',
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--path', default='/cities/read?limit=50')
+    parser.add_argument('--levels', default='1,16,64,256')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--sync-url', default=SERVERS['sync'])
+    parser.add_argument('--async-url', default=SERVERS['async'])
+    args = parser.parse_args()
+    urls = {'sync': args.sync_url, 'async': args.async_url}
+    for level in (int(n) for n in args.levels.split(',')):
+        for name, url in urls.items():
+            res = drive(url, lambda: ('GET', args.path, None), level,
+                        args.seconds)
+            print(f'{name:<6} c={level:<4} {res["rps"]:9.1f} req/s  '
+                  f'p50 {res["p50_ms"]:8.2f} ms  '
+                  f'p99 {res["p99_ms"]:8.2f} ms  '
+                  f'errors {res["errors"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Batch distance matrix timings: data/geo_batch.py's vectorized matrix
+against a per-pair data.geo.haversine_km loop, on random points. Run
+from the project root:
+    python -m bench.distances [--points 1000,10000] [--states 60]
+The per-pair loop is skipped above --max-loop points.
+"""
+import argparse
+import random
+import time
+
+import data.geo as geo
+import data.geo_batch as geo_batch
+
+
+def random_points(n: int) -> list:
+    return [[random.uniform(-60, 70), random.uniform(-180, 180)]
+            for _ in range(n)]
+
+
+def batch_matrix(items: list, points: list) -> list:
+    return geo_batch.distance_matrix(geo_batch.Columns(items), points)
+
+
+def loop_matrix(items: list, points: list) -> list:
+    return [[round(geo.haversine_km(lat, lon, s_lat, s_lon), 3)
+             for _, s_lat, s_lon in items]
+            for lat, lon in points]
+
+
+def time_matrix(items: list, points: list, build) -> float:
+    """Seconds for one build(items, points) call."""
+    start = time.perf_counter()
+    build(items, points)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', default='100,1000,10000')
+    parser.add_argument('--states', type=int, default=60)
+    parser.add_argument('--max-loop', type=int, default=10000)
+    args = parser.parse_args()
+    items = [(i, *pt) for i, pt in enumerate(random_points(args.states))]
+    builds = {'loop': loop_matrix, 'numpy': batch_matrix}
+    for n in (int(val) for val in args.points.split(',')):
+        points = random_points(n)
+        for name, build in builds.items():
+            if build is loop_matrix and n > args.max_loop:
+                continue
+            secs = time_matrix(items, points, build)
+            print(f'{n:>7} points x {args.states} states  {name:<7} '
+                  f'{secs * 1e3:10.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+"""
+Load and latency benchmarks for every route in server/endpoints.py.
+
+    # 1. fill a scratch database (never the real one)
+    MONGO_DB=geoBench python -m bench.endpoints seed --cities 50000 \\
+        --states 500
+    # 2. start the server against it
+    MONGO_DB=geoBench ./local.sh
+    # 3. drive every route, save results, compare with the baseline
+    MONGO_DB=geoBench python -m bench.endpoints run --concurrency 1,32 \\
+        --baseline bench/baseline.json
+
+`run` stores results as JSON (bench/results/<time>.json unless --out) and
+exits 1 if any route regressed past the thresholds against --baseline.
+Write routes are only driven with --writes.
+"""
+import argparse
+import datetime as dt
+import itertools
+import json
+import os
+import subprocess
+import sys
+
+import cities.queries as cqry
+import country.country as cntry
+import data.db_connect as dbc
+import states.queries as sqry
+from bench.load import drive
+
+DEFAULT_URL = 'http://127.0.0.1:8000'
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Seeded states share this country code so they never clash with real ones
+BENCH_COUNTRY = 'BENCH'
+
+# Relative change that counts as a regression
+MAX_RPS_DROP = 0.10
+MAX_LATENCY_RISE = 0.20
+LATENCY_KEYS = ('p95_ms', 'p99_ms')
+
+GET = 'GET'
+POST = 'POST'
+PUT = 'PUT'
+DELETE = 'DELETE'
+
+# Sent in X-Admin-Token so /admin/slow-queries answers rather than 403s
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+
+# A well-formed id no record has: DELETE scenarios time the lookup and
+# the 404 rather than emptying the benchmark database.
+MISSING_ID = '0' * 24
+
+ID_KEYS = ('city_id', 'state_id', 'country_id')
+
+POINTS = [[40.71, -74.01], [34.05, -118.24], [41.88, -87.63]]
+BOX = '24,-125,50,-66'
+POLYGON = '24,-125;50,-125;50,-66;24,-66'
+
+# name: (method, path template, json body); {city_id}, {state_id} and
+# {country_id}, in the path or in body strings, are filled from ids
+# sampled from the seeded database. Every route in server/endpoints.py
+# has at least one scenario (bench/tests checks this).
+READ_SCENARIOS = {
+    'hello': (GET, '/hello', None),
+    'endpoints': (GET, '/endpoints', None),
+    'health': (GET, '/health', None),
+    'metrics': (GET, '/metrics', None),
+    'slow_queries': (GET, '/admin/slow-queries', None),
+    'counts': (GET, '/counts', None),
+    'counts_groups': (GET, '/counts?groups=true', None),
+    'cities_read': (GET, '/cities/read', None),
+    'cities_read_sorted': (GET, '/cities/read?sort=name', None),
+    'cities_page': (GET, '/cities/read?limit=50', None),
+    'cities_page_total': (GET, '/cities/read?limit=50&total=true', None),
+    'cities_stream': (GET, '/cities/read?stream=true', None),
+    'city_item': (GET, '/cities/{city_id}', None),
+    'cities_by_ids': (GET, '/cities?ids={city_id}', None),
+    'cities_ids_post': (POST, '/cities/ids', ['{city_id}']),
+    'cities_suggest': (GET, '/cities/suggest?q=Bench%20City%2000', None),
+    'states_read': (GET, '/state/read', None),
+    'states_page': (GET, '/state/read?limit=50', None),
+    'states_stream': (GET, '/state/read?stream=true', None),
+    'state_item': (GET, '/state/{state_id}', None),
+    'states_by_ids': (GET, '/state?ids={state_id}', None),
+    'states_ids_post': (POST, '/state/ids', ['{state_id}']),
+    'states_suggest': (GET, '/state/suggest?q=Bench%20State', None),
+    'states_near': (GET, '/state/near?lat=40.71&lon=-74.01', None),
+    'states_nearest': (GET, '/state/nearest?lat=40.71&lon=-74.01&k=5',
+                       None),
+    'states_radius': (GET, '/state/radius?lat=40.71&lon=-74.01&km=500',
+                      None),
+    'states_within_box': (GET, f'/state/within?box={BOX}', None),
+    'states_within_polygon': (GET, f'/state/within?polygon={POLYGON}',
+                              None),
+    'states_distances': (POST, '/state/distances', {'points': POINTS}),
+    'states_distances_km': (POST, '/state/distances',
+                            {'points': POINTS, 'km': 500}),
+    'countries': (GET, '/countries', None),
+    'countries_page': (GET, '/countries?limit=50', None),
+    'countries_read': (GET, '/countries/read', None),
+    'country_item': (GET, '/countries/{country_id}', None),
+}
+
+WRITE_SCENARIOS = {
+    'city_create': (POST, '/cities',
+                    {cqry.NAME: 'Bench City', cqry.STATE_CODE: 'B0'}),
+    'city_create_read': (POST, '/cities/read',
+                         {cqry.NAME: 'Bench City', cqry.STATE_CODE: 'B0'}),
+    'cities_batch': (POST, '/cities/batch',
+                     [{cqry.NAME: f'Bench Batch City {i}',
+                       cqry.STATE_CODE: 'B0'} for i in range(10)]),
+    'city_update': (PUT, '/cities/{city_id}',
+                    {cqry.NAME: 'Bench City'}),
+    'city_delete': (DELETE, f'/cities/{MISSING_ID}', None),
+    'state_create': (POST, '/state',
+                     {sqry.NAME: 'Bench State', sqry.STATE_CODE: 'BX',
+                      sqry.COUNTRY_CODE: BENCH_COUNTRY}),
+    'states_batch': (POST, '/state/batch',
+                     [{sqry.NAME: f'Bench Batch State {i}',
+                       sqry.STATE_CODE: f'BB{i}',
+                       sqry.COUNTRY_CODE: BENCH_COUNTRY}
+                      for i in range(10)]),
+    'state_update': (PUT, '/state/{state_id}',
+                     {sqry.NAME: 'Bench State'}),
+    'state_delete': (DELETE, f'/state/{MISSING_ID}', None),
+    'country_create': (POST, '/countries',
+                       {'id': BENCH_COUNTRY, cntry.NAME: 'Bench Country',
+                        cntry.CAPITAL: 'Bench City'}),
+    'country_update': (PUT, '/countries/{country_id}',
+                       {cntry.CAPITAL: 'Bench City'}),
+    'country_delete': (DELETE, f'/countries/{MISSING_ID}', None),
+}
+
+
+def make_cities(n: int, n_states: int) -> list:
+    return [{cqry.NAME: f'Bench City {i:07d}',
+             cqry.STATE_CODE: f'B{i % max(n_states, 1)}'}
+            for i in range(n)]
+
+
+def make_states(n: int) -> list:
+    return [{sqry.NAME: f'Bench State {i:05d}',
+             sqry.STATE_CODE: f'B{i}',
+             sqry.COUNTRY_CODE: BENCH_COUNTRY}
+            for i in range(n)]
+
+
+def seed(n_cities: int, n_states: int, drop: bool = False,
+         force: bool = False) -> dict:
+    """
+    Fill the MONGO_DB database with generated cities and states.
+    Refuses to touch the default database unless forced.
+    """
+    if dbc.GEO_DB == dbc.DEFAULT_GEO_DB and not force:
+        raise ValueError(
+            f'Refusing to seed {dbc.GEO_DB}; set MONGO_DB to a scratch '
+            'database (or pass --force)')
+    if drop:
+        dbc.connect_db()[dbc.GEO_DB][cqry.CITY_COLLECTION].drop()
+        dbc.connect_db()[dbc.GEO_DB][sqry.STATE_COLLECTION].drop()
+        dbc.ensure_indexes()
+    ret = {}
+    for coll, docs in ((sqry.STATE_COLLECTION, make_states(n_states)),
+                       (cqry.CITY_COLLECTION,
+                        make_cities(n_cities, n_states))):
+        res = dbc.upsert_many(coll, docs, _key_fields(coll))
+        ret[coll] = {k: res[k] for k in dbc.BULK_COUNTS if k in res}
+    return ret
+
+
+def _key_fields(coll: str) -> tuple:
+    if coll == sqry.STATE_COLLECTION:
+        return (sqry.STATE_CODE, sqry.COUNTRY_CODE)
+    return (cqry.NAME, cqry.STATE_CODE)
+
+
+def sample_ids(n: int = 100) -> dict:
+    """Ids of existing records to substitute into item routes."""
+    db = dbc.connect_db()[dbc.GEO_DB]
+    ids = {}
+    for key, coll in (('city_id', cqry.CITY_COLLECTION),
+                      ('state_id', sqry.STATE_COLLECTION)):
+        ids[key] = [str(doc[dbc.MONGO_ID]) for doc in db[coll].aggregate(
+            [{'$sample': {'size': n}}, {'$project': {dbc.MONGO_ID: 1}}])]
+    ids['country_id'] = list(cntry.read())[:n]
+    return ids
+
+
+def _uses_ids(scenario: tuple) -> bool:
+    _, template, body = scenario
+    text = template + json.dumps(body)
+    return any('{' + key + '}' in text for key in ID_KEYS)
+
+
+def _fill(body, values: dict):
+    """body with {key}s in its strings replaced from values."""
+    if isinstance(body, str):
+        return body.format(**values)
+    if isinstance(body, list):
+        return [_fill(item, values) for item in body]
+    if isinstance(body, dict):
+        return {k: _fill(v, values) for k, v in body.items()}
+    return body
+
+
+def request_factory(scenario: tuple, ids: dict):
+    """A make_request() for bench.load.drive, cycling through ids."""
+    method, template, body = scenario
+    text = template + json.dumps(body)
+    needed = [key for key in ids if '{' + key + '}' in text]
+    if not needed:
+        return lambda: (method, template, body)
+    for key in needed:
+        if not ids[key]:
+            raise ValueError(f'No {key}s to benchmark {template} with')
+    cycles = {key: itertools.cycle(ids[key]) for key in needed}
+
+    def make_request():
+        values = {k: next(c) for k, c in cycles.items()}
+        return method, template.format(**values), _fill(body, values)
+    return make_request
+
+
+def run(base_url: str, scenarios: dict, levels: list, seconds: float,
+        warmup: float, ids: dict) -> dict:
+    results = {}
+    headers = {ADMIN_TOKEN_HEADER: ADMIN_TOKEN} if ADMIN_TOKEN else None
+    for name, scenario in scenarios.items():
+        make_request = request_factory(scenario, ids)
+        for level in levels:
+            key = f'{name}@c{level}'
+            results[key] = drive(base_url, make_request, level, seconds,
+                                 warmup, headers)
+            print(format_row(key, results[key]), flush=True)
+    return results
+
+
+def format_row(key: str, res: dict) -> str:
+    return (f'{key:<28} {res["rps"]:9.1f} req/s  '
+            f'p50 {res["p50_ms"]:8.2f}  p95 {res["p95_ms"]:8.2f}  '
+            f'p99 {res["p99_ms"]:8.2f} ms  errors {res["errors"]}')
+
+
+def compare(results: dict, baseline: dict,
+            max_rps_drop: float = MAX_RPS_DROP,
+            max_latency_rise: float = MAX_LATENCY_RISE) -> list:
+    """
+    Regressions of results against baseline (both {key: stats}), as
+    human-readable strings. Keys missing from either side are skipped.
+    """
+    regressions = []
+    for key, res in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if base['rps'] and res['rps'] < base['rps'] * (1 - max_rps_drop):
+            regressions.append(
+                f'{key}: rps {base["rps"]:.1f} -> {res["rps"]:.1f}')
+        for lat in LATENCY_KEYS:
+            if base[lat] and res[lat] > base[lat] * (1 + max_latency_rise):
+                regressions.append(
+                    f'{key}: {lat} {base[lat]:.2f} -> {res[lat]:.2f}')
+        if res['errors'] > base['errors']:
+            regressions.append(
+                f'{key}: errors {base["errors"]} -> {res["errors"]}')
+    return regressions
+
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def save(path: str, meta: dict, results: dict):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    p_seed = sub.add_parser('seed', help='fill MONGO_DB with test data')
+    p_seed.add_argument('--cities', type=int, default=10_000)
+    p_seed.add_argument('--states', type=int, default=100)
+    p_seed.add_argument('--drop', action='store_true',
+                        help='drop the collections first')
+    p_seed.add_argument('--force', action='store_true',
+                        help=f'allow seeding {dbc.DEFAULT_GEO_DB}')
+
+    p_run = sub.add_parser('run', help='benchmark the routes')
+    p_run.add_argument('--url', default=DEFAULT_URL)
+    p_run.add_argument('--concurrency', default='1,16')
+    p_run.add_argument('--seconds', type=float, default=5)
+    p_run.add_argument('--warmup', type=float, default=1)
+    p_run.add_argument('--only', default='',
+                       help='comma-separated scenario names')
+    p_run.add_argument('--writes', action='store_true',
+                       help='also drive the write routes')
+    p_run.add_argument('--out', help='results file')
+    p_run.add_argument('--baseline', help='baseline results to compare')
+    p_run.add_argument('--save-baseline', action='store_true',
+                       help=f'also write the results to {BASELINE}')
+    p_run.add_argument('--max-rps-drop', type=float, default=MAX_RPS_DROP)
+    p_run.add_argument('--max-latency-rise', type=float,
+                       default=MAX_LATENCY_RISE)
+
+    p_cmp = sub.add_parser('compare', help='compare two results files')
+    p_cmp.add_argument('results')
+    p_cmp.add_argument('baseline')
+    p_cmp.add_argument('--max-rps-drop', type=float, default=MAX_RPS_DROP)
+    p_cmp.add_argument('--max-latency-rise', type=float,
+                       default=MAX_LATENCY_RISE)
+
+    args = parser.parse_args(argv)
+    if args.cmd == 'seed':
+        print(seed(args.cities, args.states, args.drop, args.force))
+        return 0
+
+    if args.cmd == 'compare':
+        results = load(args.results)['results']
+        baseline = load(args.baseline)['results']
+    else:
+        scenarios = dict(READ_SCENARIOS)
+        if args.writes:
+            scenarios.update(WRITE_SCENARIOS)
+        if args.only:
+            wanted = set(args.only.split(','))
+            scenarios = {k: v for k, v in scenarios.items() if k in wanted}
+        levels = [int(n) for n in args.concurrency.split(',')]
+        uses_db = any(map(_uses_ids, scenarios.values()))
+        ids = sample_ids() if uses_db else {}
+        results = run(args.url, scenarios, levels, args.seconds,
+                      args.warmup, ids)
+        meta = {
+            'time': dt.datetime.now(dt.timezone.utc).isoformat(),
+            'git': _git_rev(),
+            'url': args.url,
+            'db': dbc.GEO_DB,
+            'seconds': args.seconds,
+            'concurrency': levels,
+        }
+        if uses_db:
+            meta['counts'] = {coll: dbc.count(coll) for coll in
+                              (cqry.CITY_COLLECTION, sqry.STATE_COLLECTION)}
+        out = args.out or os.path.join(
+            RESULTS_DIR,
+            dt.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+        save(out, meta, results)
+        print(f'Saved {out}')
+        if args.save_baseline:
+            save(BASELINE, meta, results)
+        if not args.baseline:
+            return 0
+        baseline = load(args.baseline)['results']
+
+    regressions = compare(results, baseline, args.max_rps_drop,
+                          args.max_latency_rise)
+    for line in regressions:
+        print(f'REGRESSION {line}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+Compare the API's JSON encoders on realistic city documents.
+Run from the project root:
+    python -m bench.json_encoders [--repeat N]
+orjson is benchmarked only if it is installed.
+"""
+import argparse
+import datetime as dt
+import timeit
+
+from bson import ObjectId
+
+import data.db_connect as dbc
+import server.json_repr as json_repr
+
+SIZES = (1, 100, 10_000)
+
+
+def make_docs(n: int) -> list:
+    now = dt.datetime.now(dt.timezone.utc)
+    return [{
+        dbc.MONGO_ID: ObjectId(),
+        'name': f'City {i}',
+        'state_code': 'NY',
+        'country_code': 'US',
+        'population': 1000 + i,
+        'latitude': 40.0 + i / 1e4,
+        'longitude': -73.0 - i / 1e4,
+        'updated': now,
+    } for i in range(n)]
+
+
+def convert_then_stdlib(docs):
+    """The old path: stringify _id in Python, then encode."""
+    for doc in docs:
+        dbc.convert_mongo_id(doc)
+    return json_repr.dumps_stdlib(docs)
+
+
+def candidates() -> dict:
+    funcs = {
+        'stdlib': json_repr.dumps_stdlib,
+        'convert+stdlib': convert_then_stdlib,
+    }
+    if json_repr.orjson is not None:
+        funcs['orjson'] = json_repr.dumps_orjson
+    return funcs
+
+
+def run(repeat: int = 5):
+    for size in SIZES:
+        number = max(1, 100_000 // size)
+        for name, func in candidates().items():
+            # fresh docs per timing: convert+stdlib mutates them
+            best = min(timeit.repeat(
+                'func(docs)',
+                setup='docs = make_docs(size)',
+                globals={'func': func, 'make_docs': make_docs,
+                         'size': size},
+                number=number, repeat=repeat))
+            per_call = best / number * 1e6
+            print(f'{size:>6} docs  {name:<15} {per_call:12.1f} us/call')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    run(parser.parse_args().repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Closed-loop HTTP load driver shared by the benchmarks: N clients each
+send their next request as soon as the previous one answers.
+"""
+import asyncio
+import time
+
+import httpx
+
+
+def percentile(sorted_vals: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, int(len(sorted_vals) * pct / 100))
+    return sorted_vals[idx]
+
+
+def summarize(latencies: list, errors: int, seconds: float) -> dict:
+    """Throughput and latency percentiles (ms) for one run."""
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / seconds if seconds else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1e3,
+        'p95_ms': percentile(latencies, 95) * 1e3,
+        'p99_ms': percentile(latencies, 99) * 1e3,
+    }
+
+
+async def _worker(client, make_request, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        method, path, body = make_request()
+        start = time.perf_counter()
+        try:
+            resp = await client.request(method, path, json=body)
+            ok = resp.status_code < 500
+        except httpx.HTTPError:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(1)
+
+
+async def _drive(base_url, make_request, concurrency, seconds, warmup,
+                 headers):
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits,
+                                 headers=headers, timeout=30) as client:
+        if warmup > 0:
+            await asyncio.gather(*(
+                _worker(client, make_request,
+                        time.perf_counter() + warmup, [], [])
+                for _ in range(concurrency)))
+        latencies, errors = [], []
+        deadline = time.perf_counter() + seconds
+        await asyncio.gather(*(
+            _worker(client, make_request, deadline, latencies, errors)
+            for _ in range(concurrency)))
+    return summarize(latencies, len(errors), seconds)
+
+
+def drive(base_url: str, make_request, concurrency: int, seconds: float,
+          warmup: float = 0, headers: dict = None) -> dict:
+    """
+    Run make_request() -> (method, path, json_body) from `concurrency`
+    clients for `seconds` (after `warmup` unmeasured seconds) and return
+    summarize()'s stats. 5xx answers and transport errors count as
+    errors. headers go with every request.
+    """
+    return asyncio.run(_drive(base_url, make_request, concurrency, seconds,
+                              warmup, headers))
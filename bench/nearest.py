@@ -0,0 +1,81 @@
+"""
+Nearest-state lookups three ways, for random query points:
+- kdtree: states.queries.nearest(), the in-process KD-tree;
+- scan: a brute-force haversine pass over the same cache;
+- mongo: states.queries.near(), $near on the 2dsphere index, with the
+  query cache off so every call goes to the DB.
+Run from the project root with the states (and their locations) loaded:
+    python -m bench.nearest [--queries N] [--k K]
+or without a DB, on N random points (kdtree and scan only):
+    python -m bench.nearest --synthetic 5000
+"""
+import argparse
+import random
+import time
+
+import data.db_connect as dbc
+import data.geo as geo
+import states.queries as sqry
+from bench.load import percentile
+
+
+def synthetic_cache(n: int) -> dict:
+    return {(f'S{i}', 'BENCH'): {
+        sqry.NAME: f'State {i}',
+        sqry.LOCATION: geo.point(random.uniform(-60, 70),
+                                 random.uniform(-180, 180)),
+    } for i in range(n)}
+
+
+def scan(lat, lon, k: int) -> list:
+    """The brute-force answer nearest() replaces."""
+    located = sqry._located(sqry.cache.items())
+    return sorted((geo.haversine_km(lat, lon, s_lat, s_lon), key)
+                  for key, s_lat, s_lon in located)[:k]
+
+
+def time_calls(fn, points: list) -> dict:
+    latencies = []
+    for lat, lon in points:
+        start = time.perf_counter()
+        fn(lat, lon)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        'mean_us': sum(latencies) / len(latencies) * 1e6,
+        'p50_us': percentile(latencies, 50) * 1e6,
+        'p99_us': percentile(latencies, 99) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--k', type=int, default=1)
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='benchmark on N random points, no DB')
+    args = parser.parse_args()
+    if args.synthetic:
+        sqry._replace_cache(synthetic_cache(args.synthetic), {})
+    else:
+        sqry.load_cache()
+    points = [(random.uniform(-60, 70), random.uniform(-180, 180))
+              for _ in range(args.queries)]
+    sqry.nearest(0, 0, args.k)  # build the index outside the timings
+    cases = {
+        'kdtree': lambda lat, lon: sqry.nearest(lat, lon, args.k),
+        'scan': lambda lat, lon: scan(lat, lon, args.k),
+    }
+    if not args.synthetic:
+        dbc.QUERY_CACHE_ENTRIES = 0
+        cases['mongo'] = lambda lat, lon: sqry.near(lat, lon, limit=args.k)
+    print(f'{len(sqry.location_index)} located states, k={args.k}, '
+          f'{args.queries} queries')
+    for name, fn in cases.items():
+        stats = time_calls(fn, points)
+        print(f'{name:<8} ' + '  '.join(f'{key} {val:10.1f}'
+                                        for key, val in stats.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Name autocomplete timings: cities.queries.suggest(), answered from the
+prefix index over the cities cache, against a scan of the same cache.
+Run from the project root with the cities loaded:
+    python -m bench.suggest [--queries N] [--limit L]
+or without a DB, on N made-up city names:
+    python -m bench.suggest --synthetic 100000
+"""
+import argparse
+import random
+import string
+
+import cities.queries as cqry
+import data.prefix_index as prefix_index
+from bench.nearest import time_calls
+
+
+def synthetic_cache(n: int) -> dict:
+    def name():
+        return ' '.join(''.join(random.choices(string.ascii_lowercase,
+                                               k=random.randint(3, 9)))
+                        for _ in range(random.randint(1, 3))).title()
+    return {f'c{i}': {cqry.NAME: name(),
+                      cqry.STATE_CODE: random.choice(['NY', 'NJ', 'CA'])}
+            for i in range(n)}
+
+
+def scan(q: str, limit: int, state_code=None) -> list:
+    """The cache scan suggest() replaces."""
+    prefix = prefix_index.normalize_prefix(q)
+    hits = sorted(
+        (prefix_index.normalize(city[cqry.NAME]), city_id)
+        for city_id, city in cqry.city_cache.items()
+        if isinstance(city.get(cqry.NAME), str)
+        and (state_code is None or city.get(cqry.STATE_CODE) == state_code)
+        and prefix_index.normalize(city[cqry.NAME]).startswith(prefix))
+    return [city_id for _, city_id in hits[:limit]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--limit', type=int, default=cqry.DEFAULT_SUGGEST)
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='benchmark on N made-up cities, no DB')
+    args = parser.parse_args()
+    if args.synthetic:
+        cqry._replace_cache(synthetic_cache(args.synthetic))
+    else:
+        cqry.read()
+    names = [city[cqry.NAME] for city in cqry.city_cache.values()
+             if city.get(cqry.NAME)]
+    # 1 to 4 character prefixes of real names, as typed
+    prefixes = [name[:random.randint(1, 4)]
+                for name in random.choices(names, k=args.queries)]
+    cqry.suggest('a')  # build the index outside the timings
+    cases = {
+        'index': lambda q: cqry.suggest(q, args.limit),
+        'index_ny': lambda q: cqry.suggest(q, args.limit, 'NY'),
+        'scan': lambda q: scan(q, args.limit),
+    }
+    print(f'{len(cqry.name_index)} indexed cities, limit={args.limit}, '
+          f'{args.queries} queries')
+    for name, fn in cases.items():
+        stats = time_calls(lambda q, _: fn(q), [(q, None) for q in prefixes])
+        print(f'{name:<8} ' + '  '.join(f'{key} {val:10.1f}'
+                                        for key, val in stats.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import pytest
+
+import bench.endpoints as be
+import server.endpoints as ep
+from bench.load import percentile, summarize
+
+STATS = {'rps': 100.0, 'p50_ms': 1.0, 'p95_ms': 2.0, 'p99_ms': 4.0,
+         'errors': 0, 'requests': 500}
+
+
+def test_percentile():
+    vals = list(range(1, 101))
+    assert percentile(vals, 50) == 51
+    assert percentile(vals, 99) == 100
+    assert percentile([], 50) == 0.0
+
+
+def test_summarize():
+    res = summarize([0.001] * 10, 2, 2)
+    assert res['rps'] == 5
+    assert res['errors'] == 2
+    assert res['p99_ms'] == pytest.approx(1.0)
+
+
+def test_compare_within_thresholds():
+    res = {**STATS, 'rps': 95.0, 'p99_ms': 4.5}
+    assert be.compare({'a@c1': res}, {'a@c1': STATS}) == []
+
+
+def test_compare_flags_regressions():
+    res = {**STATS, 'rps': 50.0, 'p95_ms': 3.0, 'errors': 1}
+    regressions = be.compare({'a@c1': res}, {'a@c1': STATS})
+    assert len(regressions) == 3
+    assert all(line.startswith('a@c1') for line in regressions)
+
+
+def test_compare_skips_new_routes():
+    assert be.compare({'new@c1': STATS}, {}) == []
+
+
+def test_request_factory_cycles_ids():
+    make = be.request_factory((be.GET, '/cities/{city_id}', None),
+                              {'city_id': ['a', 'b']})
+    assert [make()[1] for _ in range(3)] == [
+        '/cities/a', '/cities/b', '/cities/a']
+
+
+def test_request_factory_needs_ids():
+    with pytest.raises(ValueError):
+        be.request_factory((be.GET, '/state/{state_id}', None),
+                           {'state_id': []})
+
+
+def test_request_factory_fills_body():
+    make = be.request_factory((be.POST, '/cities/ids', ['{city_id}']),
+                              {'city_id': ['a', 'b']})
+    assert [make()[2] for _ in range(2)] == [['a'], ['b']]
+
+
+def _routes_hit(scenarios: dict) -> set:
+    adapter = ep.app.url_map.bind('localhost')
+    ids = {key: 'x' for key in be.ID_KEYS}
+    hit = set()
+    for method, template, _ in scenarios.values():
+        path = template.format(**ids).split('?')[0]
+        endpoint, _ = adapter.match(path, method=method)
+        hit.add((endpoint, method))
+    return hit
+
+
+def test_scenarios_drive_every_route():
+    routes = {(rule.endpoint, method)
+              for rule in ep.app.url_map.iter_rules()
+              if rule.endpoint in ep.api.endpoints
+              and rule.endpoint != 'specs'
+              for method in rule.methods - {'HEAD', 'OPTIONS'}}
+    hit = _routes_hit({**be.READ_SCENARIOS, **be.WRITE_SCENARIOS})
+    assert routes - hit == set()
+
+
+def test_read_scenarios_only_read():
+    assert all(method == be.GET or path.endswith(('/ids', '/distances'))
+               for method, path, _ in be.READ_SCENARIOS.values())
+
+
+def test_seed_refuses_default_db(monkeypatch):
+    monkeypatch.setattr(be.dbc, 'GEO_DB', be.dbc.DEFAULT_GEO_DB)
+    with pytest.raises(ValueError):
+        be.seed(1, 1)
@@ -0,0 +1,174 @@
+"""
+Async versions of the cities.queries functions the API uses, for the
+ASGI app. They share cities.queries' cache, validation and constants.
+"""
+from bson import ObjectId
+
+import cities.queries as cqry
+import data.db_connect as dbc
+import data.db_connect_async as adbc
+import data.metrics as metrics
+import data.tracing as tracing
+
+CITY_COLLECTION = cqry.CITY_COLLECTION
+NAME = cqry.NAME
+
+
+@tracing.traced
+async def _load_city_cache():
+    """Load all cities into cities.queries' cache."""
+    cache = {}
+    async for doc in adbc.find(CITY_COLLECTION, no_id=False):
+        cache[doc.pop(dbc.MONGO_ID)] = doc
+    cqry._replace_cache(cache)
+
+
+@tracing.traced
+async def read() -> list:
+    """Return all cities using the in-memory cache when available."""
+    metrics.cache_lookup(cqry.CACHE_NAME, cqry.city_cache is not None)
+    if cqry.city_cache is None:
+        await _load_city_cache()
+    return list(cqry.city_cache.values())
+
+
+@tracing.traced
+async def num_cities() -> int:
+    """Number of cities, from collection metadata (cached per write)."""
+    return await adbc.count(CITY_COLLECTION)
+
+
+@tracing.traced
+async def count_by_state() -> dict:
+    """{state_code: number of cities}; see cities.queries."""
+    counts = await adbc.count_by(CITY_COLLECTION, cqry.STATE_CODE)
+    return {code: n for code, n in counts.items() if code is not None}
+
+
+@tracing.traced
+async def suggest(q: str, limit: int = cqry.DEFAULT_SUGGEST,
+                  state_code: str = None) -> list:
+    """Cities by name prefix; see cities.queries.suggest()."""
+    cqry._check_suggest(q, limit)
+    if cqry.city_cache is None:
+        await _load_city_cache()
+    return cqry.suggest(q, limit, state_code)
+
+
+@tracing.traced
+@dbc.patches_cache
+async def create(flds: dict) -> str:
+    """Insert a new city document; returns its string id."""
+    cqry._validate(flds)
+    new_id = await adbc.create(CITY_COLLECTION, dict(flds))
+    cqry._cache_put(new_id, flds)
+    return new_id
+
+
+@tracing.traced
+@dbc.patches_cache
+async def create_many(recs: list) -> dict:
+    """Bulk-inserts cities; see cities.queries.create_many()."""
+    if not isinstance(recs, list):
+        raise ValueError(f'Bad type for {type(recs)=}')
+    ret = await adbc.create_many(CITY_COLLECTION, recs,
+                                 validate=cqry._validate)
+    for flds, new_id in zip(recs, ret[dbc.BULK_IDS]):
+        if new_id is not None:
+            cqry._cache_put(new_id, flds)
+    return ret
+
+
+@tracing.traced
+async def get_by_id(city_id: str) -> dict:
+    """Return a single city by its database id (string)."""
+    if not cqry.is_valid_id(city_id):
+        raise ValueError('Invalid id')
+    rec = await adbc.read_one(
+        CITY_COLLECTION, {dbc.MONGO_ID: ObjectId(city_id)})
+    if rec is None:
+        raise ValueError('City not found')
+    return rec
+
+
+@tracing.traced
+async def get_many(ids: list) -> list:
+    """Cities for ids in request order; see cities.queries.get_many()."""
+    found = cqry._many_from_cache(ids)
+    missing = [city_id for city_id in ids if city_id not in found]
+    if missing:
+        found.update(await adbc.read_by_ids(CITY_COLLECTION, missing))
+    return [found.get(city_id) for city_id in ids]
+
+
+@tracing.traced
+@dbc.patches_cache
+async def update_by_id(city_id: str, update_fields: dict) -> bool:
+    """Update a city by id; returns True if any field actually changed"""
+    if not cqry.is_valid_id(city_id):
+        raise ValueError('Invalid id')
+    if not isinstance(update_fields, dict):
+        raise ValueError('update_fields must be a dict')
+    before = await adbc.update_and_fetch(
+        CITY_COLLECTION, {dbc.MONGO_ID: ObjectId(city_id)}, update_fields)
+    if before is None:
+        return False
+    cqry._cache_put(city_id, {**before, **update_fields})
+    return any(before.get(k) != v for k, v in update_fields.items())
+
+
+@tracing.traced
+@dbc.patches_cache
+async def delete_by_id(city_id: str) -> bool:
+    """Delete a city by id; returns True if a city was deleted"""
+    if not cqry.is_valid_id(city_id):
+        raise ValueError('Invalid id')
+    deleted = await adbc.delete_and_fetch(
+        CITY_COLLECTION, {dbc.MONGO_ID: ObjectId(city_id)})
+    if deleted is None:
+        return False
+    if cqry.city_cache is not None:
+        if cqry.city_cache.pop(city_id, None) is None:
+            await _load_city_cache()
+        else:
+            cqry._name_drop(city_id)
+    return True
+
+
+@tracing.traced
+async def read_sorted(sort=None) -> list:
+    """All cities; sorted case-insensitively by Mongo when sort is given."""
+    if not sort:
+        return await adbc.read(CITY_COLLECTION)
+    return await adbc.cached_find(CITY_COLLECTION,
+                                  sort=cqry._sort_spec(sort),
+                                  collation=dbc.CASE_INSENSITIVE)
+
+
+def stream(sort=None):
+    """Async generator over every city, sorted in the DB if asked."""
+    if not sort:
+        return adbc.find(CITY_COLLECTION)
+    return adbc.find(CITY_COLLECTION, sort=cqry._sort_spec(sort),
+                     collation=dbc.CASE_INSENSITIVE)
+
+
+@tracing.traced
+async def read_page(sort=None, limit=cqry.DEFAULT_PAGE_SIZE,
+                    cursor=None) -> tuple:
+    """Return (cities, next_cursor) for one page, sorted in the DB."""
+    if not isinstance(limit, int) or not 1 <= limit <= cqry.MAX_PAGE_SIZE:
+        raise ValueError(
+            f'limit must be between 1 and {cqry.MAX_PAGE_SIZE}')
+    key, desc = cqry._parse_sort(sort or NAME)
+    return await adbc.read_page(CITY_COLLECTION, key, limit,
+                                cursor=cursor, desc=desc)
+
+
+@tracing.traced
+async def total() -> int:
+    """Cached total number of cities."""
+    return await adbc.count(CITY_COLLECTION)
+
+
+version = cqry.version
@@ -2,7 +2,12 @@
 """
 This file deals with our city-level data.
 """
+import threading
+
 import data.db_connect as dbc
+import data.metrics as metrics
+import data.prefix_index as prefix_index
+import data.tracing as tracing
 from bson import ObjectId
 MIN_ID_LEN = 1
 
@@ -18,16 +23,104 @@ SAMPLE_CITY = {
     STATE_CODE: 'NY',
 }
 
-# Placeholder for potential in-memory caching (currently unused)
+# In-memory cache: {id string: city doc without _id}. Writes patch it in
+# place; _load_city_cache() is the fallback.
 city_cache = None
+# label for this cache in app_cache_requests_total
+CACHE_NAME = 'cities'
+# Name prefix index over the cache (scoped by state_code) for suggest().
+# Built on first use, then patched along with the cache.
+name_index = None
+# Bumped (under _index_lock) after every cache change, so a name index
+# built from a snapshot that a change raced past is not installed.
+_generation = 0
+_index_lock = threading.Lock()
 
 SORTABLE_FIELDS = {NAME, STATE_CODE}
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+# most ids get_many() resolves per call
+MAX_IDS = MAX_PAGE_SIZE
+DEFAULT_SUGGEST = 10
+MAX_SUGGEST = 100
+
+# delete() looks cities up by (name, state_code)
+dbc.register_index(CITY_COLLECTION, [(NAME, 1), (STATE_CODE, 1)],
+                   'name_state_code')
+# read_sorted()/read_page() order case-insensitively on (field, _id)
+for _fld in SORTABLE_FIELDS:
+    dbc.register_index(CITY_COLLECTION, [(_fld, 1), (dbc.MONGO_ID, 1)],
+                       f'{_fld}_id_ci', collation=dbc.CASE_INSENSITIVE)
 
+
+@tracing.traced
 def _load_city_cache():
     """ load all ciites from data base to cache"""
-    global city_cache
-    city_cache = dbc.read(CITY_COLLECTION)
+    cache = {}
+    for doc in dbc.find(CITY_COLLECTION, no_id=False):
+        cache[doc.pop(dbc.MONGO_ID)] = doc
+    _replace_cache(cache)
+
+
+def _replace_cache(cache: dict):
+    """Install a freshly loaded cache; the name index follows lazily."""
+    global city_cache, name_index, _generation
+    with _index_lock:
+        city_cache, name_index = cache, None
+        _generation += 1
+
+
+def _name_put(city_id: str, city: dict):
+    """Keep the name index in step with one cached city."""
+    global _generation
+    with _index_lock:
+        _generation += 1
+        if name_index is not None:
+            name_index.add(city_id, city.get(NAME), city.get(STATE_CODE))
+
+
+def _name_drop(city_id: str):
+    global _generation
+    with _index_lock:
+        _generation += 1
+        if name_index is not None:
+            name_index.remove(city_id)
+
+
+def _cache_put(city_id: str, flds: dict):
+    """Add or replace one city in the cache, if it is loaded."""
+    if city_cache is not None:
+        rec = dict(flds)
+        rec.pop(dbc.MONGO_ID, None)
+        city_cache[city_id] = rec
+        _name_put(city_id, rec)
+
+
+def _cache_drop(city_id: str):
+    """Remove one city from the cache; reload if it wasn't there."""
+    if city_cache is None:
+        return
+    if city_cache.pop(city_id, None) is None:
+        _load_city_cache()
+    else:
+        _name_drop(city_id)
+
+
+def _on_change(kind: str, city_id: str, doc: dict):
+    """Apply a write made by any process (see dbc.subscribe_changes)."""
+    if city_cache is None:
+        return
+    if kind == dbc.CHANGE_RELOAD:
+        _load_city_cache()
+    elif kind == dbc.CHANGE_DELETE:
+        city_cache.pop(city_id, None)
+        _name_drop(city_id)
+    else:
+        _cache_put(city_id, doc)
+
+
+dbc.subscribe_changes(CITY_COLLECTION, _on_change)
 
 
 def is_valid_id(_id: str) -> bool:
@@ -39,25 +132,60 @@ def is_valid_id(_id: str) -> bool:
     return True
 
 
+@tracing.traced
 def num_cities() -> int:
-    return len(read())
+    """Number of cities, from collection metadata (cached per write)."""
+    return dbc.count(CITY_COLLECTION)
+
+
+@tracing.traced
+def count_by_state() -> dict:
+    """{state_code: number of cities}, grouped in the DB and cached."""
+    return {code: n for code, n in
+            dbc.count_by(CITY_COLLECTION, STATE_CODE).items()
+            if code is not None}
+
+
+def _validate(flds: dict):
+    """Raise ValueError unless flds is a dict with a name."""
+    if not isinstance(flds, dict):
+        raise ValueError(f'Bad type for {type(flds)=}')
+    if not flds.get(NAME):
+        raise ValueError(f'Bad value for {flds.get(NAME)=}')
 
 
+@tracing.traced
+@dbc.patches_cache
 def create(flds: dict) -> str:
     """ Insert a new city document.
         Expects a dict with at least the 'name' field.
         Returns the string id of the newly created document."""
     print(f'{flds=}')
-    if not isinstance(flds, dict):
-        raise ValueError(f'Bad type for {type(flds)=}')
-    if not flds.get(NAME):
-        raise ValueError(f'Bad value for {flds.get(NAME)=}')
-    new_id = dbc.create(CITY_COLLECTION, flds)
+    _validate(flds)
+    new_id = dbc.create(CITY_COLLECTION, dict(flds))
     print(f'{new_id=}')
-    _load_city_cache()     # refresh cache after insert
+    _cache_put(new_id, flds)
     return new_id
 
 
+@tracing.traced
+@dbc.patches_cache
+def create_many(recs: list) -> dict:
+    """
+    Insert many cities in unordered bulk batches and add the inserted
+    ones to the cache. Returns dbc's per-item result: an id (or None) per
+    record plus a list of errors keyed by record index.
+    """
+    if not isinstance(recs, list):
+        raise ValueError(f'Bad type for {type(recs)=}')
+    ret = dbc.create_many(CITY_COLLECTION, recs, validate=_validate)
+    for flds, new_id in zip(recs, ret[dbc.BULK_IDS]):
+        if new_id is not None:
+            _cache_put(new_id, flds)
+    return ret
+
+
+@tracing.traced
 def get_by_id(city_id: str) -> dict:
     """Return a single city by its database id (string)."""
     if not is_valid_id(city_id):
@@ -68,60 +196,179 @@ def get_by_id(city_id: str) -> dict:
     return rec
 
 
+def _many_from_cache(ids: list) -> dict:
+    """{id: city with its _id} for the ids found in the loaded cache."""
+    dbc.check_id_list(ids, MAX_IDS)
+    metrics.cache_lookup(CACHE_NAME, city_cache is not None)
+    if city_cache is None:
+        return {}
+    return {city_id: {**city_cache[city_id], dbc.MONGO_ID: city_id}
+            for city_id in ids if city_id in city_cache}
+
+
+@tracing.traced
+def get_many(ids: list) -> list:
+    """
+    Cities for ids in request order, None where an id matches no city.
+    Served from the cache when it is loaded; any ids it lacks (or all of
+    them, when it isn't) are fetched in one $in query.
+    """
+    found = _many_from_cache(ids)
+    missing = [city_id for city_id in ids if city_id not in found]
+    if missing:
+        found.update(dbc.read_by_ids(CITY_COLLECTION, missing))
+    return [found.get(city_id) for city_id in ids]
+
+
+@tracing.traced
+@dbc.patches_cache
 def update_by_id(city_id: str, update_fields: dict) -> bool:
-    """Update a city by id; returns True if modified_count > 0"""
+    """Update a city by id; returns True if any field actually changed"""
     if not is_valid_id(city_id):
         raise ValueError('Invalid id')
     if not isinstance(update_fields, dict):
         raise ValueError('update_fields must be a dict')
-    res = dbc.update(
+    before = dbc.update_and_fetch(
         CITY_COLLECTION, {dbc.MONGO_ID: ObjectId(city_id)}, update_fields)
-    # pymongo UpdateResult has modified_count attribute
-    try:
-        return getattr(res, 'modified_count', 0) > 0
-    except Exception:
+    if before is None:
         return False
+    _cache_put(city_id, {**before, **update_fields})
+    return any(before.get(k) != v for k, v in update_fields.items())
 
 
+@tracing.traced
+@dbc.patches_cache
 def delete_by_id(city_id: str) -> bool:
-    """Delete a city by id; returns True if deleted_count > 0"""
+    """Delete a city by id; returns True if a city was deleted"""
     if not is_valid_id(city_id):
         raise ValueError('Invalid id')
-    deleted = dbc.delete(CITY_COLLECTION, {dbc.MONGO_ID: ObjectId(city_id)})
-    if deleted > 0:
-        _load_city_cache()   # refresh cache
-    return deleted > 0
+    deleted = dbc.delete_and_fetch(
+        CITY_COLLECTION, {dbc.MONGO_ID: ObjectId(city_id)})
+    if deleted is None:
+        return False
+    _cache_drop(city_id)
+    return True
 
 
-def delete(name: str, state_code: str) -> bool:
-    ret = dbc.delete(CITY_COLLECTION, {NAME: name, STATE_CODE: state_code})
-    if ret < 1:
+@tracing.traced
+@dbc.patches_cache
+def delete(name: str, state_code: str) -> int:
+    deleted = dbc.delete_and_fetch(
+        CITY_COLLECTION, {NAME: name, STATE_CODE: state_code})
+    if deleted is None:
         raise ValueError(f'City not found: {name}, {state_code}')
-    _load_city_cache()
-    return ret
-
+    _cache_drop(deleted[dbc.MONGO_ID])
+    return 1
 
-def read_sorted(sort=None):
-    items = dbc.read(CITY_COLLECTION)
-    if not sort:
-        return items
 
+def _parse_sort(sort: str) -> tuple:
+    """Split '-name' style sort into (field, desc); validate field."""
     desc = sort.startswith("-")
     key = sort[1:] if desc else sort
     if key not in SORTABLE_FIELDS:
         raise ValueError(f'Invalid sort field: {key}')
+    return key, desc
+
 
-    def keyfunc(rec):
-        return (rec.get(key) or "").upper()
+def _sort_spec(sort: str) -> list:
+    """Turn '-name' style sort into a Mongo sort list."""
+    key, desc = _parse_sort(sort)
+    return [(key, dbc.pm.DESCENDING if desc else dbc.pm.ASCENDING)]
 
-    return sorted(items, key=keyfunc, reverse=desc)
+
+@tracing.traced
+def read_sorted(sort=None):
+    """All cities; sorted case-insensitively by Mongo when sort is given."""
+    if not sort:
+        return dbc.read(CITY_COLLECTION)
+    return dbc.cached_find(CITY_COLLECTION, sort=_sort_spec(sort),
+                           collation=dbc.CASE_INSENSITIVE)
 
 
-def read() -> dict:
+def stream(sort=None):
+    """
+    Lazily yield every city, sorted in the DB when `sort` is given.
+    Used for NDJSON exports, so it bypasses the in-memory cache.
+    """
+    if not sort:
+        return dbc.find(CITY_COLLECTION)
+    return dbc.find(CITY_COLLECTION, sort=_sort_spec(sort),
+                    collation=dbc.CASE_INSENSITIVE)
+
+
+@tracing.traced
+def read_page(sort=None, limit=DEFAULT_PAGE_SIZE, cursor=None) -> tuple:
+    """
+    Return (cities, next_cursor) for one page, sorted in the DB.
+    Defaults to name order; pass the returned cursor to get the next page.
+    """
+    if not isinstance(limit, int) or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    key, desc = _parse_sort(sort or NAME)
+    return dbc.read_page(CITY_COLLECTION, key, limit, cursor=cursor,
+                         desc=desc)
+
+
+def version():
+    """
+    Shared counter that moves on every write to cities (for ETags), or
+    None while cache sync is off; see dbc.shared_version().
+    """
+    return dbc.shared_version(CITY_COLLECTION)
+
+
+@tracing.traced
+def total() -> int:
+    """Cached total number of cities; cheap enough to call per page."""
+    return dbc.count(CITY_COLLECTION)
+
+
+def _check_suggest(q, limit: int):
+    if not isinstance(q, str) or not prefix_index.normalize(q):
+        raise ValueError('q must be a non-empty string')
+    if not isinstance(limit, int) or not 1 <= limit <= MAX_SUGGEST:
+        raise ValueError(f'limit must be between 1 and {MAX_SUGGEST}')
+
+
+@tracing.traced
+def suggest(q: str, limit: int = DEFAULT_SUGGEST,
+            state_code: str = None) -> list:
+    """
+    Cities whose name starts with q (ignoring case and accents), in name
+    order, optionally only in state_code. Served from a prefix index
+    over the cache; each city carries its _id.
+    """
+    global name_index
+    _check_suggest(q, limit)
+    metrics.cache_lookup(CACHE_NAME, city_cache is not None)
+    if city_cache is None:
+        _load_city_cache()
+    with _index_lock:
+        cache, index, built_at = city_cache, name_index, _generation
+        cities = list(cache.items()) if index is None else None
+    if index is None:
+        index = prefix_index.PrefixIndex(
+            (city_id, city.get(NAME), city.get(STATE_CODE))
+            for city_id, city in cities)
+        with _index_lock:
+            if _generation == built_at:
+                name_index = index
+    found = []
+    for city_id in index.search(q, limit, scope=state_code,
+                                scoped=state_code is not None):
+        city = cache.get(city_id)
+        if city is not None:
+            found.append({**city, dbc.MONGO_ID: city_id})
+    return found
+
+
+@tracing.traced
+def read() -> list:
     """Return all cities using in-memory cache when available"""
+    metrics.cache_lookup(CACHE_NAME, city_cache is not None)
     if city_cache is None:
         _load_city_cache()
-    return city_cache
+    return list(city_cache.values())
 
 
 def main():
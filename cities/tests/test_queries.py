@@ -89,6 +89,7 @@ def test_get_by_id(temp_city):
     city = qry.get_by_id(temp_city)
     assert city is not None
     assert qry.NAME in city
+    assert city[qry.dbc.MONGO_ID] == temp_city  # a str, like get_many's
 
 
 def test_get_by_id_invalid():
@@ -141,6 +142,142 @@ def test_read_sorted_descending():
     assert isinstance(cities, list)
 
 
+def test_read_sorted_no_ids(temp_city):
+    cities = qry.read_sorted(sort=qry.NAME)
+    assert all('_id' not in c for c in cities)
+
+
 def test_read_sorted_invalid_field():
     with pytest.raises(ValueError, match='Invalid sort field'):
         qry.read_sorted(sort='invalid_field')
+
+
+def test_read_page(temp_city):
+    cities, cursor = qry.read_page(limit=1)
+    assert len(cities) <= 1
+    if cursor is not None:
+        more, _ = qry.read_page(limit=1, cursor=cursor)
+        assert more != cities
+
+
+def test_read_page_bad_limit():
+    with pytest.raises(ValueError, match='limit'):
+        qry.read_page(limit=0)
+
+
+def test_read_page_invalid_sort():
+    with pytest.raises(ValueError, match='Invalid sort field'):
+        qry.read_page(sort='invalid_field', limit=1)
+
+
+def test_stream(temp_city):
+    cities = qry.stream()
+    assert not isinstance(cities, list)
+    assert get_temp_rec() in list(cities)
+
+
+def test_create_many():
+    old_count = qry.num_cities()
+    ret = qry.create_many([get_temp_rec(), {}, get_temp_rec()])
+    ids = ret[qry.dbc.BULK_IDS]
+    try:
+        assert qry.is_valid_id(ids[0]) and qry.is_valid_id(ids[2])
+        assert ids[1] is None
+        assert [e[qry.dbc.BULK_INDEX]
+                for e in ret[qry.dbc.BULK_ERRORS]] == [1]
+        assert qry.num_cities() == old_count + 2
+    finally:
+        for new_id in filter(None, ids):
+            qry.delete_by_id(new_id)
+
+
+def test_create_many_bad_type():
+    with pytest.raises(ValueError):
+        qry.create_many({})
+
+
+def test_writes_patch_cache_without_reload(monkeypatch):
+    qry.read()  # make sure the cache is loaded
+    new_id = qry.create(get_temp_rec())
+    monkeypatch.setattr(qry, '_load_city_cache', lambda: pytest.fail(
+        'cache should be patched, not reloaded'))
+    assert qry.city_cache[new_id] == get_temp_rec()
+    assert qry.update_by_id(new_id, {qry.NAME: 'Patched City'})
+    assert qry.city_cache[new_id][qry.NAME] == 'Patched City'
+    assert qry.delete_by_id(new_id)
+    assert new_id not in qry.city_cache
+
+
+def test_on_change(monkeypatch):
+    monkeypatch.setattr(qry, 'city_cache', {})
+    qry._on_change(qry.dbc.CHANGE_INSERT, 'id1', get_temp_rec())
+    assert qry.city_cache == {'id1': get_temp_rec()}
+    qry._on_change(qry.dbc.CHANGE_DELETE, 'id1', None)
+    qry._on_change(qry.dbc.CHANGE_DELETE, 'id1', None)
+    assert qry.city_cache == {}
+
+
+def test_get_many_cache_then_one_query(monkeypatch):
+    monkeypatch.setattr(qry, 'city_cache', {'a': {qry.NAME: 'A'}})
+    calls = []
+
+    def read_by_ids(coll, ids):
+        calls.append(ids)
+        return {'b': {qry.NAME: 'B', qry.dbc.MONGO_ID: 'b'}}
+    monkeypatch.setattr(qry.dbc, 'read_by_ids', read_by_ids)
+    got = qry.get_many(['b', 'x', 'a', 'b'])
+    assert calls == [['b', 'x', 'b']]
+    assert [doc and doc[qry.NAME] for doc in got] == ['B', None, 'A', 'B']
+    assert got[2] == {qry.NAME: 'A', qry.dbc.MONGO_ID: 'a'}
+
+
+def test_get_many_bad_ids():
+    with pytest.raises(ValueError):
+        qry.get_many([])
+    with pytest.raises(ValueError):
+        qry.get_many('a,b')
+    with pytest.raises(ValueError):
+        qry.get_many(['x'] * (qry.MAX_IDS + 1))
+
+
+def test_suggest_follows_cache_writes(monkeypatch):
+    monkeypatch.setattr(qry, 'city_cache', {
+        'a': {qry.NAME: 'New York', qry.STATE_CODE: 'NY'},
+        'b': {qry.NAME: 'Newark', qry.STATE_CODE: 'NJ'},
+    })
+    monkeypatch.setattr(qry, 'name_index', None)
+    monkeypatch.setattr(qry, '_load_city_cache', lambda: pytest.fail(
+        'suggest should not reload'))
+    assert [c[qry.NAME] for c in qry.suggest('new')] == ['New York',
+                                                         'Newark']
+    assert qry.suggest('NEW', state_code='NJ') == [
+        {qry.NAME: 'Newark', qry.STATE_CODE: 'NJ', qry.dbc.MONGO_ID: 'b'}]
+    qry._cache_put('c', {qry.NAME: 'New Haven', qry.STATE_CODE: 'CT'})
+    assert qry.suggest('new h')[0][qry.dbc.MONGO_ID] == 'c'
+    qry._cache_drop('a')
+    qry._on_change(qry.dbc.CHANGE_DELETE, 'b', None)
+    assert [c[qry.NAME] for c in qry.suggest('new')] == ['New Haven']
+    for bad in ({'q': ''}, {'q': None}, {'q': 'a', 'limit': 0},
+                {'q': 'a', 'limit': qry.MAX_SUGGEST + 1}):
+        with pytest.raises(ValueError):
+            qry.suggest(**bad)
+
+
+def test_suggest_build_racing_a_write(monkeypatch):
+    """A city written while the name index is built still shows up."""
+    monkeypatch.setattr(qry, 'city_cache', {
+        'a': {qry.NAME: 'New York', qry.STATE_CODE: 'NY'}})
+    monkeypatch.setattr(qry, 'name_index', None)
+    real_index = qry.prefix_index.PrefixIndex
+
+    def index_with_write(items):
+        index = real_index(items)
+        if 'b' not in qry.city_cache:
+            qry._cache_put('b', {qry.NAME: 'Newark', qry.STATE_CODE: 'NJ'})
+        return index
+    monkeypatch.setattr(qry.prefix_index, 'PrefixIndex', index_with_write)
+    qry.suggest('new')
+    assert qry.name_index is None
+    assert [c[qry.NAME] for c in qry.suggest('new')] == ['New York',
+                                                         'Newark']
+    assert 'b' in qry.name_index
@@ -1,11 +1,24 @@
 """
 This file deals with our country-level data.
 """
+import base64
+import binascii
+import hashlib
+import json
+from bisect import bisect_right
 
 ID = "id"
 NAME = "name"
 CAPITAL = "capital"
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+
+# Digest of country_cache, refreshed on every change; used for HTTP
+# ETags. Being content-based, it agrees across worker processes holding
+# the same countries.
+_version = None
+
 # Example seed data
 country_cache = {
     "1": {NAME: "United States", CAPITAL: "Washington, D.C."},
@@ -14,11 +27,52 @@ country_cache = {
 }
 
 
+def version() -> str:
+    """Return a digest that changes whenever the countries change."""
+    if _version is None:
+        _touch()
+    return _version
+
+
+def _touch():
+    global _version
+    raw = json.dumps(country_cache, sort_keys=True, default=str)
+    _version = hashlib.sha1(raw.encode()).hexdigest()
+
+
 def read() -> dict:
     """Return all countries (in-memory)."""
     return country_cache
 
 
+def _encode_cursor(country_id: str) -> str:
+    return base64.urlsafe_b64encode(country_id.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(cursor.encode()).decode()
+    except (ValueError, binascii.Error):
+        raise ValueError("Invalid cursor")
+
+
+def read_page(limit: int = DEFAULT_PAGE_SIZE, cursor: str = None) -> tuple:
+    """
+    Return (countries, next_cursor): up to `limit` countries ordered by id,
+    starting after the id encoded in `cursor`.
+    """
+    if not isinstance(limit, int) or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    ids = sorted(country_cache)
+    if cursor:
+        ids = ids[bisect_right(ids, _decode_cursor(cursor)):]
+    page_ids = ids[:limit]
+    next_cursor = None
+    if len(ids) > limit:
+        next_cursor = _encode_cursor(page_ids[-1])
+    return {cid: country_cache[cid] for cid in page_ids}, next_cursor
+
+
 def get_country_by_id(country_id: str) -> dict:
     if country_id not in country_cache:
         raise ValueError("No such country")
@@ -38,4 +92,21 @@ def create(country_data: dict) -> str:
         NAME: country_data[NAME],
         CAPITAL: country_data[CAPITAL],
     }
+    _touch()
     return new_id
+
+
+def update(country_id: str, country_data: dict):
+    """Merge country_data into an existing country."""
+    if country_id not in country_cache:
+        raise ValueError("No such country")
+    country_cache[country_id].update(country_data or {})
+    _touch()
+
+
+def delete(country_id: str):
+    """Remove a country."""
+    if country_id not in country_cache:
+        raise ValueError("No such country")
+    del country_cache[country_id]
+    _touch()
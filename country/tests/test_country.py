@@ -26,6 +26,25 @@ def test_read_returns_all_countries():
     assert "3" in countries
 
 
+def test_read_page_walks_all_countries():
+    """Test that following cursors visits every country once."""
+    seen = []
+    cursor = None
+    while True:
+        page, cursor = country.read_page(limit=2, cursor=cursor)
+        assert len(page) <= 2
+        seen.extend(page)
+        if cursor is None:
+            break
+    assert sorted(seen) == sorted(country.country_cache)
+
+
+def test_read_page_bad_limit():
+    """Test that an out-of-range limit raises ValueError."""
+    with pytest.raises(ValueError, match="limit"):
+        country.read_page(limit=0)
+
+
 def test_create_country_success():
     """Test creating a new country successfully."""
     initial_count = len(country.country_cache)
@@ -86,3 +105,20 @@ def test_create_multiple_countries():
     assert len(country.country_cache) == initial_count + 2
     assert country.country_cache[id1][country.NAME] == "Germany"
     assert country.country_cache[id2][country.NAME] == "Spain"
+
+
+def test_update_and_delete_bump_version():
+    """Test that writes move the version used for ETags."""
+    new_id = country.create({country.NAME: "Peru", country.CAPITAL: "Lima"})
+    v = country.version()
+    country.update(new_id, {country.CAPITAL: "Lima!"})
+    v2 = country.version()
+    assert v2 != v
+    country.delete(new_id)
+    assert country.version() not in (v, v2)
+    # content-based, so the same countries give the same version
+    new_id = country.create({country.NAME: "Peru", country.CAPITAL: "Lima"})
+    assert country.version() == v
+    country.delete(new_id)
+    with pytest.raises(ValueError):
+        country.delete(new_id)
@@ -5,17 +5,36 @@ We may be required to use a new database at any point.
 import os
 import time
 import re
+import json
+import base64
+import binascii
+import contextvars
+import inspect
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 # import certifi
 
 import pymongo as pm
+import bson
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
 from contextlib import contextmanager
+from pymongo import monitoring
+from types import GeneratorType
+
+import data.metrics as metrics
+import data.slow_queries as slow_queries
+import data.tracing as tracing
 
 LOCAL = "0"
 CLOUD = "1"
 
-GEO_DB = 'geo2025DB'
+DEFAULT_GEO_DB = 'geo2025DB'
+# MONGO_DB points every module at another database (benchmarks, tests)
+GEO_DB = os.environ.get('MONGO_DB', DEFAULT_GEO_DB)
 
 client = None
 
@@ -43,6 +62,139 @@ logger = logging.getLogger(__name__)
 CONNECT_RETRIES = int(os.environ.get('DB_CONNECT_RETRIES', '3'))
 RETRY_DELAY_SECONDS = float(os.environ.get('DB_CONNECT_RETRY_DELAY', '1'))
 
+# Background heartbeat and circuit breaker. After BREAKER_FAILURES
+# connection failures in a row, calls fail fast for BREAKER_RESET_SECONDS
+# before one trial call is let through.
+HEARTBEAT_SECONDS = float(os.environ.get('DB_HEARTBEAT_SECONDS', '5'))
+BREAKER_FAILURES = int(os.environ.get('DB_BREAKER_FAILURES', '3'))
+BREAKER_RESET_SECONDS = float(os.environ.get('DB_BREAKER_RESET', '10'))
+
+_breaker_lock = threading.Lock()
+_failures = 0
+_opened_at = None  # monotonic time the circuit opened; None when closed
+_monitor = None
+_monitor_stop = threading.Event()
+
+# Connection pool tuning; unset values keep pymongo's defaults.
+# DB_COMPRESSORS is a comma list in preference order, e.g. 'zstd,snappy,zlib'
+# (zstd/snappy need their optional python packages installed).
+POOL_ENV_OPTIONS = {
+    'DB_MAX_POOL_SIZE': ('maxPoolSize', int),
+    'DB_MIN_POOL_SIZE': ('minPoolSize', int),
+    'DB_MAX_IDLE_TIME_MS': ('maxIdleTimeMS', int),
+    'DB_WAIT_QUEUE_TIMEOUT_MS': ('waitQueueTimeoutMS', int),
+    'DB_COMPRESSORS': ('compressors', str),
+}
+# Open this many connections as soon as a process connects
+# (defaults to DB_MIN_POOL_SIZE).
+WARM_POOL_SIZE = int(os.environ.get(
+    'DB_WARM_POOL_SIZE', os.environ.get('DB_MIN_POOL_SIZE', '0')))
+# Connect (and warm) in the background right after a worker is forked.
+CONNECT_AFTER_FORK = os.environ.get('DB_CONNECT_AFTER_FORK', '0') == '1'
+
+_client_pid = None
+_connect_lock = threading.Lock()
+
+# Read-through query result cache: LRU, bounded by entries and by the
+# approximate (BSON) size of the results, with a TTL. 0 entries disables.
+QUERY_CACHE_ENTRIES = int(os.environ.get('DB_QUERY_CACHE_ENTRIES', '1024'))
+QUERY_CACHE_BYTES = int(os.environ.get(
+    'DB_QUERY_CACHE_BYTES', str(64 * 1024 * 1024)))
+QUERY_CACHE_TTL = float(os.environ.get('DB_QUERY_CACHE_TTL', '60'))
+
+# {key: (result, size, expires_at)}; key starts with (db, collection)
+QUERY_CACHE = 'query'  # cache label in app_cache_requests_total
+_query_cache = OrderedDict()
+_query_cache_lock = threading.Lock()
+_query_cache_bytes = 0
+query_cache_counters = {'hits': 0, 'misses': 0, 'evictions': 0,
+                        'invalidations': 0}
+# {(db, collection): n}, bumped on every write to that collection
+_collection_versions = {}
+
+# Metrics (see data/metrics.py), served at /metrics
+OP_OK = 'ok'
+OP_ERROR = 'error'
+OP_REJECTED = 'rejected'  # refused by the open circuit breaker
+db_operations = metrics.counter(
+    'db_operations_total', 'dbc operations by collection and outcome',
+    ('op', 'collection', 'status'))
+db_duration = metrics.histogram(
+    'db_operation_duration_seconds', 'dbc operation latency',
+    ('op', 'collection'))
+pool_checkouts = metrics.counter(
+    'db_pool_checkouts_total', 'Connection pool checkouts by outcome',
+    ('status',))
+pool_checkout_wait = metrics.histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting for a connection')
+pool_open = metrics.gauge(
+    'db_pool_connections', 'Open connections across pools')
+pool_in_use = metrics.gauge(
+    'db_pool_connections_in_use', 'Connections currently checked out')
+query_cache_size = metrics.gauge(
+    'db_query_cache_size', 'Query cache entries and bytes', ('unit',))
+
+# Documents sent per insert_many/bulk_write round trip.
+BULK_BATCH_SIZE = int(os.environ.get('DB_BULK_BATCH_SIZE', '1000'))
+
+# Keys of the result dicts returned by the bulk write functions.
+BULK_IDS = 'ids'
+BULK_ERRORS = 'errors'
+BULK_INDEX = 'index'
+BULK_CODE = 'code'
+BULK_MESSAGE = 'message'
+BULK_UPSERTED_IDS = 'upserted_ids'
+BULK_COUNTS = ('inserted', 'matched', 'modified', 'upserted', 'deleted')
+
+# Case-insensitive ordering, matching the `.upper()` sorts done in Python.
+CASE_INSENSITIVE = {'locale': 'en', 'strength': 2}
+
+# Reconcile registered indexes whenever a new client connects.
+ENSURE_INDEXES = os.environ.get('DB_ENSURE_INDEXES', '1') == '1'
+
+# Indexes declared by the query modules: {(db, collection): {name: spec}}
+index_registry = {}
+
+IDX_CREATED = 'created'
+IDX_FAILED = 'failed'
+IDX_MISSING = 'missing'
+IDX_UNREGISTERED = 'unregistered'
+IDX_UNUSED = 'unused'
+
+# Cross-process cache sync: 'off', 'stream' (change streams, falling back
+# to polling where unsupported) or 'poll' (version documents only).
+SYNC_OFF = 'off'
+SYNC_STREAM = 'stream'
+SYNC_POLL = 'poll'
+CACHE_SYNC = os.environ.get('DB_CACHE_SYNC', SYNC_OFF)
+SYNC_POLL_SECONDS = float(os.environ.get('DB_SYNC_POLL_SECONDS', '2'))
+VERSION_COLLECTION = 'collection_versions'
+
+# Change kinds passed to subscribe_changes() handlers.
+CHANGE_INSERT = 'insert'
+CHANGE_UPDATE = 'update'
+CHANGE_DELETE = 'delete'
+CHANGE_RELOAD = 'reload'
+
+# Server error codes for change stream set-up/resume problems.
+CHANGE_STREAM_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+INVALID_RESUME_TOKEN = 260
+
+# Called as hook(db, collection) after every write made through this
+# file, before the shared version moves. In-memory work only.
+write_hooks = []
+
+# {(db, collection): [handler]}; see subscribe_changes()
+change_handlers = {}
+_sync_mode = None  # mode actually running in this process
+_sync_thread = None
+_sync_stop = threading.Event()
+_resume_token = None
+_seen_versions = {}  # {(db, collection): last version acted on}
+# [(db, collection, version)] of writes made inside a @patches_cache call
+_own_writes = contextvars.ContextVar('own_writes', default=None)
+
 
 def is_valid_id(s) -> bool:
     """Return True if s looks like a MongoDB ObjectId (24 hex chars)."""
@@ -52,33 +204,8 @@ def is_valid_id(s) -> bool:
 
 
 def measure_performance(fn):
-    """Track performance metrics for database operations."""
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        start_memory = None
-
-        try:
-            import psutil
-            process = psutil.Process(os.getpid())
-            start_memory = process.memory_info().rss / 1024 / 1024  # MB
-        except ImportError:
-            pass
-
-        result = fn(*args, **kwargs)
-
-        elapsed = time.time() - start_time
-        logger.info(f'{fn.__name__} took {elapsed:.3f}s')
-
-        if start_memory:
-            end_memory = process.memory_info().rss / 1024 / 1024
-            logger.info(
-                f'{fn.__name__} memory delta:'
-                f' {end_memory - start_memory:.2f}MB')
-
-        return result
-
-    return wrapper
+    """Time fn as a tracing span (see data/tracing.py) when traced."""
+    return tracing.traced(fn)
 
 
 def retry_on_failure(max_retries=3, delay=1, backoff=2):
@@ -140,38 +267,6 @@ def validate_inputs(fn):
     return wrapper
 
 
-def cache_results(ttl_seconds=60):
-    """Cache database read results for a specified time."""
-    cache = {}
-
-    def decorator(fn):
-        @wraps(fn)
-        def wrapper(*args, **kwargs):
-            # Create a cache key from function name and arguments
-            cache_key = (f"{fn.__name__}:{str(args)}:"
-                         f"{str(sorted(kwargs.items()))}")
-            current_time = time.time()
-
-            # Check if we have a cached result that's still valid
-            if cache_key in cache:
-                result, timestamp = cache[cache_key]
-                if current_time - timestamp < ttl_seconds:
-                    logger.debug(f'Cache hit for {fn.__name__}')
-                    return result
-
-            # Call the function and cache the result
-            result = fn(*args, **kwargs)
-            cache[cache_key] = (result, current_time)
-
-            return result
-
-        # Add a method to clear cache
-        wrapper.clear_cache = lambda: cache.clear()
-
-        return wrapper
-    return decorator
-
-
 def handle_mongo_errors(fn):
     """Convert MongoDB exceptions to more user-friendly error messages."""
     @wraps(fn)
@@ -286,20 +381,15 @@ def convert_empty_to_none(fn):
 
 
 def ensure_connection_health(fn):
-    """Verify connection health before operation and log status."""
+    """Connect if needed and fail fast while the circuit is open."""
     @wraps(fn)
     def wrapper(*args, **kwargs):
+        if not _circuit_allows():
+            raise ConnectionError('Database unavailable')
         if client is None:
             logger.warning(
                 f'{fn.__name__} called with no client, connecting...')
             connect_db()
-
-        try:
-            # Quick health check
-            client.admin.command('ping')
-        except Exception as e:
-            logger.error(f'Connection health check failed: {e}')
-            connect_db()
         return fn(*args, **kwargs)
 
     return wrapper
@@ -345,32 +435,282 @@ def audit_operation(fn):
     return wrapper
 
 
+def _circuit_allows() -> bool:
+    """
+    True if a call may go to the DB. While open, lets one trial call
+    through every BREAKER_RESET_SECONDS (half-open).
+    """
+    global _opened_at
+    if _opened_at is None:
+        return True
+    with _breaker_lock:
+        if _opened_at is None:
+            return True
+        if time.monotonic() - _opened_at >= BREAKER_RESET_SECONDS:
+            _opened_at = time.monotonic()
+            return True
+        return False
+
+
+def _record_failure(force_open=False):
+    global _failures, _opened_at
+    with _breaker_lock:
+        _failures += 1
+        if force_open or _failures >= BREAKER_FAILURES:
+            if _opened_at is None:
+                logger.error('MongoDB unreachable; opening circuit')
+            _opened_at = time.monotonic()
+
+
+def _record_success():
+    global _failures, _opened_at
+    if _failures == 0 and _opened_at is None:
+        return
+    with _breaker_lock:
+        if _opened_at is not None:
+            logger.info('MongoDB reachable again; closing circuit')
+        _failures = 0
+        _opened_at = None
+
+
+def is_db_up() -> bool:
+    """Current view of DB health, as kept by calls and the heartbeat."""
+    return _opened_at is None
+
+
+def _heartbeat():
+    while not _monitor_stop.wait(HEARTBEAT_SECONDS):
+        if client is None:
+            continue
+        try:
+            client.admin.command('ping')
+        except pm.errors.PyMongoError as e:
+            logger.warning(f'Heartbeat ping failed: {e}')
+            _record_failure(force_open=True)
+        else:
+            _record_success()
+
+
+def start_health_monitor():
+    """Start the heartbeat thread unless it is already running."""
+    global _monitor
+    if _monitor is not None and _monitor.is_alive():
+        return
+    _monitor_stop.clear()
+    _monitor = threading.Thread(
+        target=_heartbeat, name='db-heartbeat', daemon=True)
+    _monitor.start()
+
+
+def stop_health_monitor():
+    _monitor_stop.set()
+
+
+def _observe_op(op: str, collection: str, start_ns: int, status: str,
+                parent=None, error: BaseException = None):
+    """Record one finished DB call in the metrics and, if traced, as a
+    span under `parent`."""
+    db_operations.inc(op, collection, status)
+    db_duration.observe((time.perf_counter_ns() - start_ns) / 1e9,
+                        op, collection)
+    if parent is not None:
+        tracing.record_span(f'dbc.{op}', parent, start_ns, {
+            'db.system': 'mongodb',
+            'db.operation.name': op,
+            'db.collection.name': collection,
+        }, error)
+
+
 def needs_db(fn):
+    op = fn.__name__.lstrip('_')
+
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        """Ensure a live MongoDB client exists before calling fn.
-        If the client is not set, or if the server is unreachable
-        (server_info raises), try to (re)connect. """
+        """Ensure a MongoDB client exists before calling fn.
+        There is no per-call liveness check: the heartbeat thread and
+        the outcome of each call keep the circuit breaker current, and
+        while it is open calls raise ConnectionError without touching
+        the network. Each call is counted, timed per collection and
+        traced; lazy results (find) are timed by _iter_docs instead. """
+        collection = kwargs.get('collection', args[0] if args else '')
+        if not _circuit_allows():
+            db_operations.inc(op, collection, OP_REJECTED)
+            raise ConnectionError('Database unavailable')
+        parent = tracing.current()
+        start = time.perf_counter_ns()
         try:
             if client is None:
                 connect_db()
-            else:
-                client.server_info()
-        except Exception:
-            # Attempt to reconnect once
-            connect_db()
-        return fn(*args, **kwargs)
+            ret = fn(*args, **kwargs)
+        except pm.errors.ConnectionFailure as e:
+            _record_failure()
+            _observe_op(op, collection, start, OP_ERROR, parent, e)
+            raise ConnectionError(f'Database unavailable: {e}') from e
+        except Exception as e:
+            _observe_op(op, collection, start, OP_ERROR, parent, e)
+            raise
+        if isinstance(ret, GeneratorType):
+            # nothing has been sent yet; _iter_docs reports the outcome
+            return ret
+        _record_success()
+        _observe_op(op, collection, start, OP_OK, parent)
+        return ret
     return wrapper
 
 
+class _PoolMetrics(monitoring.ConnectionPoolListener):
+    """Feeds connection pool events into the metrics registry."""
+    def connection_checked_out(self, event):
+        pool_checkouts.inc(OP_OK)
+        pool_checkout_wait.observe(event.duration)
+        pool_in_use.inc()
+
+    def connection_check_out_failed(self, event):
+        pool_checkouts.inc(OP_ERROR)
+        pool_checkout_wait.observe(event.duration)
+
+    def connection_checked_in(self, event):
+        pool_in_use.dec()
+
+    def connection_created(self, event):
+        pool_open.inc()
+
+    def connection_closed(self, event):
+        pool_open.dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+pool_listener = _PoolMetrics()
+
+
+def pool_options() -> dict:
+    """MongoClient pool/compression kwargs taken from POOL_ENV_OPTIONS."""
+    opts = {}
+    for env_var, (opt, conv) in POOL_ENV_OPTIONS.items():
+        val = os.environ.get(env_var)
+        if val:
+            opts[opt] = conv(val)
+    return opts
+
+
+def warm_pool(size: int = None):
+    """
+    Check out `size` connections at once so later requests find them
+    already open, instead of paying the TCP/TLS/auth handshake.
+    """
+    size = WARM_POOL_SIZE if size is None else size
+    if client is None or size < 1:
+        return
+    with ThreadPoolExecutor(max_workers=size) as pool:
+        for _ in range(size):
+            pool.submit(client.admin.command, 'ping')
+    logger.info('Warmed MongoDB pool with %d connections', size)
+
+
+def _reset_after_fork():
+    """
+    Runs in a freshly forked child. A MongoClient (its sockets and monitor
+    threads) must not be shared across processes, so drop the parent's
+    and let this process build its own.
+    """
+    global client, _client_pid, _monitor, _failures, _opened_at
+    global _breaker_lock, _connect_lock, _sync_thread, _sync_mode
+    global _query_cache_lock
+    client = None
+    _client_pid = None
+    _monitor = None
+    _sync_thread = None
+    _sync_mode = None
+    _failures = 0
+    _opened_at = None
+    # the parent may have held these at fork time
+    _breaker_lock = threading.Lock()
+    _connect_lock = threading.Lock()
+    _query_cache_lock = threading.Lock()
+    # the parent's connections aren't ours: count from the new client's
+    pool_open.set(value=0)
+    pool_in_use.set(value=0)
+    if CONNECT_AFTER_FORK:
+        threading.Thread(
+            target=_connect_quietly, name='db-connect', daemon=True).start()
+
+
+def _connect_quietly():
+    try:
+        connect_db()
+    except Exception as e:
+        logger.error(f'Background connect after fork failed: {e}')
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def event_listeners() -> list:
+    """pymongo monitoring listeners every client is built with."""
+    return [pool_listener, slow_queries.listener]
+
+
+def client_settings() -> tuple:
+    """
+    The (uri, kwargs) to build a client with, local or cloud per
+    CLOUD_MONGO. Shared by the sync client and the async one in
+    data.db_connect_async.
+    """
+    if os.environ.get('CLOUD_MONGO', LOCAL) == CLOUD:
+        password = os.environ.get('MONGO_PASSWORD')
+        if not password:
+            raise ValueError(
+                'You must set your password to use Mongo in the cloud.'
+            )
+        logger.debug('Using cloud Mongo configuration')
+        # Using the new cloud connection format with certifi
+        return (f'mongodb+srv://ss15580_db_user:{password}'
+                + '@geo2025-cluster.jooae0o.mongodb.net/'
+                + '?appName=geo2025-cluster',
+                {'event_listeners': event_listeners(), **pool_options()})
+    logger.debug('Using local Mongo configuration')
+    return (os.environ.get("MONGO_URI", "mongodb://localhost:27017"),
+            {'serverSelectionTimeoutMS': 2000,
+             'event_listeners': event_listeners(), **pool_options()})
+
+
 def connect_db():
     """
     This provides a uniform way to connect to the DB across all uses.
-    Returns a mongo client object.
+    Returns a mongo client object, created in (and owned by) the
+    current process.
     """
-    global client
-    if client is not None:
+    if client is not None and _client_pid == os.getpid():
         return client
+    with _connect_lock:
+        return _connect_db()
+
+
+def _connect_db():
+    global client, _client_pid
+    if client is not None:
+        if _client_pid == os.getpid():
+            return client
+        # inherited across a fork without the at-fork hook running
+        client = None
 
     last_exc = None
     for attempt in range(1, CONNECT_RETRIES + 1):
@@ -379,42 +719,25 @@ def connect_db():
                 'Connecting to MongoDB (attempt %d/%d)',
                 attempt, CONNECT_RETRIES)
 
-            if os.environ.get('CLOUD_MONGO', LOCAL) == CLOUD:
-                username = os.environ.get('MONGO_USER_NM', 'ss15580_db_user')
-                password = os.environ.get('MONGO_PASSWORD')
-                host = os.environ.get(
-                    'MONGO_HOST',
-                    'geo2025-cluster.jooae0o.mongodb.net'
-                )
-                if not password:
-                    raise ValueError(
-                        'You must set your password to use Mongo in the cloud.'
-                    )
-
-                logger.debug('Using cloud Mongo configuration')
-
-                # Using the new cloud connection format with certifi
-                cloud_mdb = 'mongodb+srv'
-                user_nm = 'ss15580_db_user'
-                cloud_svc = 'geo2025-cluster.jooae0o.mongodb.net'
-                db_params = 'appName=geo2025-cluster'
-                client_candidate = pm.MongoClient(
-                    f'mongodb+srv://ss15580_db_user:{password}'
-                    + '@geo2025-cluster.jooae0o.mongodb.net/'
-                    + '?appName=geo2025-cluster')
-            else:
-                logger.debug('Using local Mongo configuration')
-                client_candidate = pm.MongoClient(
-                    os.environ.get("MONGO_URI", "mongodb://localhost:27017"),
-                    serverSelectionTimeoutMS=2000
-                )
+            uri, opts = client_settings()
+            client_candidate = pm.MongoClient(uri, **opts)
 
             # Verify connection
             client_candidate.server_info()
 
             # Success: set global and return
             client = client_candidate
+            _client_pid = os.getpid()
             logger.info('Connected to MongoDB successfully')
+            start_health_monitor()
+            warm_pool()
+            if CACHE_SYNC != SYNC_OFF:
+                start_cache_sync()
+            if ENSURE_INDEXES:
+                try:
+                    ensure_indexes()
+                except pm.errors.PyMongoError as e:
+                    logger.error('Index reconciliation failed: %s', e)
             return client
 
         except Exception as e:
@@ -440,6 +763,278 @@ def connect_db():
     raise last_exc
 
 
+def _run_write_hooks(db: str, collection: str):
+    for hook in write_hooks:
+        try:
+            hook(db, collection)
+        except Exception as e:
+            logger.error(f'Write hook {hook.__name__} failed: {e}')
+
+
+def _after_write(db: str, collection: str):
+    """
+    Drop what this process cached for the collection, then move its
+    shared version: never the new version with the old data.
+    """
+    _run_write_hooks(db, collection)
+    try:
+        _bump_version(db, collection)
+    except pm.errors.PyMongoError as e:
+        logger.error(f'Version bump for {collection} failed: {e}')
+
+
+def subscribe_changes(collection: str, handler, db: str = GEO_DB):
+    """
+    Have handler(kind, doc_id, doc) called for changes to the collection
+    made by *any* process, once cache sync is running. kind is one of
+    CHANGE_INSERT/UPDATE/DELETE, with doc the new doc minus _id (None on
+    delete, or if it has since gone), or CHANGE_RELOAD when the caller
+    must reload everything (doc_id and doc are then None).
+    Handlers also see this process's own writes, so must be idempotent.
+    """
+    change_handlers.setdefault((db, collection), []).append(handler)
+
+
+def _dispatch(db, collection, kind, doc_id=None, doc=None):
+    # another process wrote: drop our cached query results too
+    _invalidate_collection(db, collection)
+    for handler in change_handlers.get((db, collection), []):
+        try:
+            handler(kind, doc_id, doc)
+        except Exception as e:
+            logger.error(f'Change handler for {collection} failed: {e}')
+
+
+def _reload_all():
+    for db, collection in change_handlers:
+        _dispatch(db, collection, CHANGE_RELOAD)
+
+
+def _apply_change(change: dict):
+    """Turn one change stream event into handler calls."""
+    op = change.get('operationType')
+    ns = change.get('ns', {})
+    db, collection = ns.get('db'), ns.get('coll')
+    if collection == VERSION_COLLECTION:
+        _see_version(db, change)
+        return
+    if op in ('insert', 'update', 'replace'):
+        doc_id = str(change['documentKey'][MONGO_ID])
+        doc = change.get('fullDocument')
+        if doc is None:
+            # deleted again before the update could be looked up
+            _dispatch(db, collection, CHANGE_DELETE, doc_id)
+            return
+        doc = {k: v for k, v in doc.items() if k != MONGO_ID}
+        kind = CHANGE_INSERT if op == 'insert' else CHANGE_UPDATE
+        _dispatch(db, collection, kind, doc_id, doc)
+    elif op == 'delete':
+        _dispatch(db, collection, CHANGE_DELETE,
+                  str(change['documentKey'][MONGO_ID]))
+    elif op in ('drop', 'rename'):
+        _dispatch(db, collection, CHANGE_RELOAD)
+    elif op in ('dropDatabase', 'invalidate'):
+        _reload_all()
+
+
+def _see_version(db: str, change: dict):
+    """
+    Take up a version document's new value. It follows the changes it
+    counts in the stream, so they have been applied by now.
+    """
+    doc = change.get('fullDocument') or {}
+    if 'v' not in doc:
+        return
+    key = (db, doc[MONGO_ID])
+    if doc['v'] > _seen_versions.get(key, 0):
+        _seen_versions[key] = doc['v']
+
+
+def _watch_pipeline() -> list:
+    watched = [{'ns.db': db, 'ns.coll': coll}
+               for db, coll in change_handlers]
+    watched += [{'ns.db': db, 'ns.coll': VERSION_COLLECTION}
+                for db in sorted({db for db, _ in change_handlers})]
+    return [{'$match': {'$or': watched}}]
+
+
+def _watch_changes():
+    """
+    Tail a change stream over the subscribed collections, resuming from
+    the last token after transient errors. Switches to polling if the
+    server can't provide change streams (e.g. a standalone mongod).
+    """
+    global _resume_token, _sync_mode
+    _seen_versions.update(_read_versions_quietly())
+    while not _sync_stop.is_set():
+        try:
+            with client.watch(_watch_pipeline(),
+                              full_document='updateLookup',
+                              resume_after=_resume_token,
+                              max_await_time_ms=1000) as stream:
+                while not _sync_stop.is_set():
+                    change = stream.try_next()
+                    _resume_token = stream.resume_token
+                    if change is not None:
+                        _apply_change(change)
+        except pm.errors.OperationFailure as e:
+            if e.code == CHANGE_STREAM_UNSUPPORTED:
+                logger.warning(
+                    'Change streams unavailable; polling versions instead')
+                _sync_mode = SYNC_POLL
+                _poll_versions()
+                return
+            if e.code in (CHANGE_STREAM_HISTORY_LOST, INVALID_RESUME_TOKEN):
+                logger.warning(f'Change stream cannot resume: {e}')
+                _resume_token = None
+                # versions read first are covered by the reload after
+                versions = _read_versions_quietly()
+                _reload_all()
+                _seen_versions.update(versions)
+                continue
+            logger.error(f'Change stream failed: {e}')
+            _sync_stop.wait(SYNC_POLL_SECONDS)
+        except pm.errors.PyMongoError as e:
+            logger.warning(f'Change stream interrupted, resuming: {e}')
+            _sync_stop.wait(SYNC_POLL_SECONDS)
+
+
+def counts_versions() -> bool:
+    """
+    Whether writes keep the shared version documents: only needed when
+    cache sync runs, here or (by configuration) in the other workers.
+    """
+    return CACHE_SYNC != SYNC_OFF or _sync_mode is not None
+
+
+def _bump_version(db: str, collection: str):
+    """
+    Count a write in the collection's shared version document, which
+    polling processes reload on and every synced process tags its HTTP
+    responses with (see shared_version()).
+    """
+    if client is None or not counts_versions():
+        return
+    doc = client[db][VERSION_COLLECTION].find_one_and_update(
+        {MONGO_ID: collection}, {'$inc': {'v': 1}}, upsert=True,
+        return_document=pm.ReturnDocument.AFTER)
+    _note_own_write(db, collection, doc['v'])
+
+
+def _note_own_write(db: str, collection: str, version: int):
+    """
+    Take up our own write's version once our caches hold the write:
+    now, or when the @patches_cache function making it returns.
+    """
+    pending = _own_writes.get()
+    if pending is None:
+        _saw_own_write(db, collection, version)
+    else:
+        pending.append((db, collection, version))
+
+
+def _saw_own_write(db: str, collection: str, version: int):
+    """
+    Our own write is already in our caches; if nobody else wrote in
+    between, don't make this process reload for it.
+    """
+    key = (db, collection)
+    if _seen_versions.get(key, 0) == version - 1:
+        _seen_versions[key] = version
+
+
+def _take_own_writes(pending: list):
+    for db, collection, version in pending:
+        _saw_own_write(db, collection, version)
+
+
+@contextmanager
+def _deferred_own_writes():
+    """Collect own writes' versions; an outer collector takes nested ones."""
+    if _own_writes.get() is not None:
+        yield []
+        return
+    pending = []
+    token = _own_writes.set(pending)
+    try:
+        yield pending
+    finally:
+        _own_writes.reset(token)
+
+
+def patches_cache(fn):
+    """
+    For query functions (sync or async) that write through this file and
+    then patch their in-memory caches: the write's shared version, which
+    responses are tagged with, is only taken up once they return.
+    """
+    if inspect.iscoroutinefunction(fn):
+        @wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            with _deferred_own_writes() as pending:
+                ret = await fn(*args, **kwargs)
+            _take_own_writes(pending)
+            return ret
+        return async_wrapper
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with _deferred_own_writes() as pending:
+            ret = fn(*args, **kwargs)
+        _take_own_writes(pending)
+        return ret
+    return wrapper
+
+
+def _read_versions() -> dict:
+    versions = {}
+    for db in {db for db, _ in change_handlers}:
+        for doc in client[db][VERSION_COLLECTION].find():
+            versions[(db, doc[MONGO_ID])] = doc.get('v')
+    return versions
+
+
+def _poll_versions():
+    """Reload a collection's caches whenever its version document moves."""
+    _seen_versions.clear()
+    _seen_versions.update(_read_versions_quietly())
+    while not _sync_stop.wait(SYNC_POLL_SECONDS):
+        versions = _read_versions_quietly()
+        for key in change_handlers:
+            if key in versions and versions[key] != _seen_versions.get(key):
+                _dispatch(*key, CHANGE_RELOAD)
+                # only now may responses carry it
+                _seen_versions[key] = versions[key]
+
+
+def _read_versions_quietly() -> dict:
+    try:
+        return _read_versions()
+    except pm.errors.PyMongoError as e:
+        logger.warning(f'Version poll failed: {e}')
+        return {}
+
+
+def start_cache_sync(mode: str = None):
+    """
+    Start keeping subscribed caches in step with other processes' writes,
+    in a daemon thread. Called by connect_db() unless DB_CACHE_SYNC=off.
+    """
+    global _sync_thread, _sync_mode
+    if _sync_thread is not None and _sync_thread.is_alive():
+        return
+    _sync_mode = mode or CACHE_SYNC
+    _sync_stop.clear()
+    target = _poll_versions if _sync_mode == SYNC_POLL else _watch_changes
+    _sync_thread = threading.Thread(
+        target=target, name='db-cache-sync', daemon=True)
+    _sync_thread.start()
+
+
+def stop_cache_sync():
+    _sync_stop.set()
+
+
 def convert_mongo_id(doc: dict):
     if MONGO_ID in doc:
         # Convert mongo ID to a string so it works as JSON
@@ -453,18 +1048,20 @@ def create(collection: str, doc: dict, db: str = GEO_DB) -> str:
     """
     print(f'{doc=}')
     ret = client[db][collection].insert_one(doc)
+    _after_write(db, collection)
     return str(ret.inserted_id)
 
 
 @needs_db
-def read_one(collection: str, filt: dict, db: str = GEO_DB):
+def read_one(collection: str, filt: dict, db: str = GEO_DB,
+             projection: dict = None):
     """
-    Find with a filter and return on the first doc found.
-    Return None if not found.
+    Return the first doc matching the filter, or None if not found.
     """
-    for doc in client[db][collection].find(filt):
+    doc = client[db][collection].find_one(filt, projection)
+    if doc is not None:
         convert_mongo_id(doc)
-        return doc
+    return doc
 
 
 @needs_db
@@ -474,41 +1071,665 @@ def delete(collection: str, filt: dict, db=GEO_DB):
     """
     print(f'{filt=}')
     del_result = client[db][collection].delete_one(filt)
+    _after_write(db, collection)
     return del_result.deleted_count
 
 
 @needs_db
 def update(collection, filters, update_dict, db=GEO_DB):
-    return client[db][collection].update_one(filters, {'$set': update_dict})
+    ret = client[db][collection].update_one(filters, {'$set': update_dict})
+    _after_write(db, collection)
+    return ret
+
+
+@needs_db
+def update_and_fetch(collection, filters, update_dict, db=GEO_DB):
+    """
+    $set update_dict on the first doc matching filters and return that
+    doc as it was *before* the update (None if nothing matched), so
+    callers can patch caches without re-reading the collection.
+    """
+    doc = client[db][collection].find_one_and_update(
+        filters, {'$set': update_dict})
+    _after_write(db, collection)
+    if doc is not None:
+        convert_mongo_id(doc)
+    return doc
 
 
 @needs_db
+def delete_and_fetch(collection, filt, db=GEO_DB):
+    """
+    Delete the first doc matching filt and return it (None if nothing
+    matched), so callers know exactly which record went away.
+    """
+    doc = client[db][collection].find_one_and_delete(filt)
+    _after_write(db, collection)
+    if doc is not None:
+        convert_mongo_id(doc)
+    return doc
+
+
+@needs_db
+def find(collection, filt=None, projection=None, sort=None, skip=0,
+         limit=0, batch_size=0, hint=None, collation=None, db=GEO_DB,
+         no_id=True):
+    """
+    Lazily yield docs matching `filt` as the pymongo cursor delivers them.
+    Filtering, projection, sort (a list of (field, direction) pairs),
+    skip and limit all run in Mongo, so callers only move the bytes
+    they need. With no_id the _id field is projected away on the server;
+    otherwise it is returned as a string.
+    """
+    if no_id:
+        projection = {**(projection or {}), MONGO_ID: 0}
+    cursor = client[db][collection].find(
+        filt or {},
+        projection,
+        skip=skip,
+        limit=limit,
+        sort=sort,
+        batch_size=batch_size,
+        hint=hint,
+        collation=collation,
+    )
+    return _iter_docs(cursor, collection=collection)
+
+
+def _iter_docs(cursor, collection=''):
+    """
+    Yield the cursor's docs. The query only reaches Mongo once iteration
+    starts, so connection failures are mapped to ConnectionError and fed
+    to the circuit breaker here rather than in needs_db.
+    """
+    parent = tracing.current()
+    start = time.perf_counter_ns()
+    status = OP_ERROR
+    answered = False
+    try:
+        for doc in cursor:
+            if not answered:
+                answered = True
+                _record_success()
+            convert_mongo_id(doc)
+            yield doc
+        if not answered:
+            _record_success()
+        status = OP_OK
+    except pm.errors.ConnectionFailure as e:
+        _record_failure()
+        raise ConnectionError(f'Database unavailable: {e}') from e
+    finally:
+        cursor.close()
+        _observe_op('find', collection, start, status, parent)
+
+
 def read(collection, db=GEO_DB, no_id=True) -> list:
     """
     Returns a list from the db.
+    Doesn't need db decorator because find() has it.
     """
-    ret = []
-    for doc in client[db][collection].find():
-        if no_id:
-            del doc[MONGO_ID]
-        else:
-            convert_mongo_id(doc)
-        ret.append(doc)
-    return ret
+    return list(find(collection, db=db, no_id=no_id))
 
 
 def read_dict(collection, key, db=GEO_DB, no_id=True) -> dict:
     """
-    Doesn't need db decorator because read() has it.
+    Doesn't need db decorator because find() has it.
     """
-    # Ensure there is a live connection for callers that may bypass read()
-    # by calling this function directly.
-    @needs_db
-    def _inner_read():
-        return read(collection, db=db, no_id=no_id)
-
-    recs = _inner_read()
     recs_as_dict = {}
-    for rec in recs:
+    for rec in find(collection, db=db, no_id=no_id):
         recs_as_dict[rec[key]] = rec
     return recs_as_dict
+
+
+def check_id_list(ids, max_ids: int) -> list:
+    """Raise ValueError unless ids is a list of 1..max_ids strings."""
+    if not isinstance(ids, list) or not ids:
+        raise ValueError('ids must be a non-empty list')
+    if len(ids) > max_ids:
+        raise ValueError(f'At most {max_ids} ids per request')
+    if not all(isinstance(i, str) for i in ids):
+        raise ValueError('ids must be strings')
+    return ids
+
+
+def ids_filter(ids) -> dict:
+    """
+    {_id: {$in: [...]}} over the distinct ObjectId strings in ids, or
+    None if there are none. Other ids can never match, so are dropped.
+    """
+    oids = [ObjectId(i) for i in dict.fromkeys(ids) if is_valid_id(i)]
+    if not oids:
+        return None
+    return {MONGO_ID: {'$in': oids}}
+
+
+def read_by_ids(collection, ids, db=GEO_DB) -> dict:
+    """
+    {id string: doc} for those of ids that exist, in one $in round trip.
+    Doesn't need db decorator because find() has it.
+    """
+    filt = ids_filter(ids)
+    if filt is None:
+        return {}
+    return {doc[MONGO_ID]: doc
+            for doc in find(collection, filt, db=db, no_id=False)}
+
+
+def _batches(items: list, size: int):
+    """Yield (offset, chunk) pairs of at most size items."""
+    size = max(1, size)
+    for offset in range(0, len(items), size):
+        yield offset, items[offset:offset + size]
+
+
+def _write_errors(exc: pm.errors.BulkWriteError, offset: int) -> list:
+    """Per-document errors from a BulkWriteError, with input indexes."""
+    return [
+        {
+            BULK_INDEX: offset + err['index'],
+            BULK_CODE: err.get('code'),
+            BULK_MESSAGE: err.get('errmsg', ''),
+        }
+        for err in exc.details.get('writeErrors', [])
+    ]
+
+
+def _prepare_inserts(docs: list, validate) -> tuple:
+    """
+    (docs to send, their input positions, validation errors) for
+    create_many() and upsert_many(); see create_many().
+    """
+    errors = []
+    to_send = []
+    positions = []
+    for i, doc in enumerate(docs):
+        if validate is not None:
+            try:
+                validate(doc)
+            except ValueError as e:
+                errors.append(
+                    {BULK_INDEX: i, BULK_CODE: None, BULK_MESSAGE: str(e)})
+                continue
+        # insert_many sets _id on what it is given; keep callers' dicts clean
+        to_send.append(dict(doc))
+        positions.append(i)
+    return to_send, positions, errors
+
+
+def _inserted(batch: list, offset: int, positions: list, ids: list,
+              errors: list, exc: pm.errors.BulkWriteError = None):
+    """Record one insert_many batch's ids and errors by input index."""
+    failed = set()
+    if exc is not None:
+        batch_errors = _write_errors(exc, offset)
+        for err in batch_errors:
+            failed.add(err[BULK_INDEX])
+            err[BULK_INDEX] = positions[err[BULK_INDEX]]
+        errors.extend(batch_errors)
+    for j, doc in enumerate(batch, start=offset):
+        if j not in failed:
+            ids[positions[j]] = str(doc[MONGO_ID])
+
+
+@needs_db
+def create_many(collection: str, docs: list, db: str = GEO_DB,
+                batch_size: int = BULK_BATCH_SIZE, validate=None) -> dict:
+    """
+    Insert docs with unordered insert_many, batch_size docs per round trip.
+    A failing doc doesn't stop the rest. Returns
+    {BULK_IDS: [id or None per input doc], BULK_ERRORS: [...]}, where each
+    error names the input index. If `validate` is given it is called per
+    doc first; a ValueError there is reported and the doc is not sent.
+    """
+    ids = [None] * len(docs)
+    to_send, positions, errors = _prepare_inserts(docs, validate)
+    coll = client[db][collection]
+    for offset, batch in _batches(to_send, batch_size):
+        try:
+            coll.insert_many(batch, ordered=False)
+        except pm.errors.BulkWriteError as e:
+            _inserted(batch, offset, positions, ids, errors, e)
+        else:
+            _inserted(batch, offset, positions, ids, errors)
+    if to_send:
+        _after_write(db, collection)
+    errors.sort(key=lambda err: err[BULK_INDEX])
+    return {BULK_IDS: ids, BULK_ERRORS: errors}
+
+
+@needs_db
+def bulk_write(collection: str, requests: list, db: str = GEO_DB,
+               batch_size: int = BULK_BATCH_SIZE) -> dict:
+    """
+    Run pymongo write requests (InsertOne, UpdateOne, DeleteOne, ...)
+    unordered, batch_size per round trip. Returns the summed counts
+    (see BULK_COUNTS) plus BULK_ERRORS indexed by request position and
+    BULK_UPSERTED_IDS, {request position: new id}, for upserts that
+    inserted.
+    """
+    ret = {key: 0 for key in BULK_COUNTS}
+    ret[BULK_ERRORS] = []
+    ret[BULK_UPSERTED_IDS] = {}
+    coll = client[db][collection]
+    for offset, batch in _batches(requests, batch_size):
+        try:
+            res = coll.bulk_write(batch, ordered=False)
+            counts = res.bulk_api_result
+        except pm.errors.BulkWriteError as e:
+            counts = e.details
+            ret[BULK_ERRORS].extend(_write_errors(e, offset))
+        ret['inserted'] += counts.get('nInserted', 0)
+        ret['matched'] += counts.get('nMatched', 0)
+        ret['modified'] += counts.get('nModified', 0)
+        ret['upserted'] += counts.get('nUpserted', 0)
+        ret['deleted'] += counts.get('nRemoved', 0)
+        for up in counts.get('upserted', []):
+            ret[BULK_UPSERTED_IDS][offset + up['index']] = str(up[MONGO_ID])
+    if requests:
+        _after_write(db, collection)
+    return ret
+
+
+def _upsert_update(doc: dict, clear: tuple) -> dict:
+    """$set doc, and $unset the fields of clear that doc lacks."""
+    update = {'$set': doc}
+    unset = {fld: '' for fld in clear if fld not in doc}
+    if unset:
+        update['$unset'] = unset
+    return update
+
+
+def upsert_many(collection: str, docs: list, key_fields: tuple,
+                db: str = GEO_DB, batch_size: int = BULK_BATCH_SIZE,
+                clear: tuple = (), validate=None) -> dict:
+    """
+    Insert or update each doc, matched on key_fields, through bulk_write.
+    Fields in clear that a doc lacks are removed from the stored record,
+    so a reload can drop a value, not just replace it. As in
+    create_many(), a doc failing `validate` is reported and not sent;
+    error and upserted id indexes are input positions.
+    Doesn't need db decorator because bulk_write() has it.
+    """
+    to_send, positions, errors = _prepare_inserts(docs, validate)
+    requests = [
+        pm.UpdateOne({fld: doc.get(fld) for fld in key_fields},
+                     _upsert_update(doc, clear), upsert=True)
+        for doc in to_send
+    ]
+    ret = bulk_write(collection, requests, db=db, batch_size=batch_size)
+    for err in ret[BULK_ERRORS]:
+        err[BULK_INDEX] = positions[err[BULK_INDEX]]
+    ret[BULK_ERRORS] = sorted(errors + ret[BULK_ERRORS],
+                              key=lambda err: err[BULK_INDEX])
+    ret[BULK_UPSERTED_IDS] = {positions[i]: new_id for i, new_id
+                              in ret[BULK_UPSERTED_IDS].items()}
+    return ret
+
+
+def encode_cursor(sort_key: str, desc: bool, value, last_id) -> str:
+    """
+    Build an opaque page cursor from the last document of a page.
+    The sort spec is embedded so a cursor can't be replayed on another sort.
+    """
+    raw = json.dumps([sort_key, desc, value, str(last_id)])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str, sort_key: str, desc: bool) -> tuple:
+    """
+    Return (value, ObjectId) from a cursor made by encode_cursor().
+    Raises ValueError if the cursor is malformed or for a different sort.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        key, cur_desc, value, last_id = json.loads(raw)
+        last_id = ObjectId(last_id)
+    except (ValueError, TypeError, binascii.Error, InvalidId):
+        raise ValueError('Invalid cursor')
+    if key != sort_key or cur_desc != desc:
+        raise ValueError('Cursor does not match sort')
+    return value, last_id
+
+
+def _keyset_filter(sort_key: str, value, last_id, desc: bool) -> dict:
+    """
+    Filter selecting documents strictly after (value, last_id) in
+    (sort_key, _id) order. Nulls sort first ascending, last descending.
+    """
+    id_op = '$lt' if desc else '$gt'
+    if value is None:
+        after = [{sort_key: None, MONGO_ID: {id_op: last_id}}]
+        if not desc:
+            after.append({sort_key: {'$ne': None}})
+        return {'$or': after}
+    after = [
+        {sort_key: {id_op: value}},
+        {sort_key: value, MONGO_ID: {id_op: last_id}},
+    ]
+    if desc:
+        after.append({sort_key: None})
+    return {'$or': after}
+
+
+def read_page(collection, sort_key, limit, cursor=None, desc=False,
+              db=GEO_DB, no_id=True) -> tuple:
+    """
+    Return (docs, next_cursor) for one page ordered by (sort_key, _id).
+    The sort and the keyset filter run in Mongo, so a page costs
+    O(limit) rather than a full collection read.
+    next_cursor is None on the last page.
+    """
+    direction = pm.DESCENDING if desc else pm.ASCENDING
+    filt = {}
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort_key, desc)
+        filt = _keyset_filter(sort_key, value, last_id, desc)
+    # _id is needed to build the next cursor; drop it afterwards
+    docs = cached_find(
+        collection, filt,
+        sort=[(sort_key, direction), (MONGO_ID, direction)],
+        limit=limit + 1,
+        collation=CASE_INSENSITIVE,
+        db=db,
+        no_id=False,
+    )
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        last = docs[-1]
+        next_cursor = encode_cursor(
+            sort_key, desc, last.get(sort_key), last[MONGO_ID])
+    if no_id:
+        for doc in docs:
+            del doc[MONGO_ID]
+    return docs, next_cursor
+
+
+def collection_version(collection: str, db: str = GEO_DB) -> int:
+    """
+    Counter bumped by every write to the collection seen by this process
+    (its own writes, plus other processes' when cache sync is on).
+    """
+    return _collection_versions.get((db, collection), 0)
+
+
+def shared_version(collection: str, db: str = GEO_DB):
+    """
+    The collection's write counter as all processes see it (its
+    VERSION_COLLECTION document), as far as this process has applied
+    the writes it counts. None while cache sync isn't running: this
+    process then can't know about other processes' writes.
+    """
+    if _sync_thread is None or not _sync_thread.is_alive():
+        return None
+    return _seen_versions.get((db, collection), 0)
+
+
+def _invalidate_collection(db: str, collection: str):
+    """Bump the collection's version and drop its cached query results."""
+    global _query_cache_bytes
+    with _query_cache_lock:
+        _collection_versions[(db, collection)] = (
+            _collection_versions.get((db, collection), 0) + 1)
+        stale = [key for key in _query_cache
+                 if key[0] == db and key[1] == collection]
+        for key in stale:
+            _query_cache_bytes -= _query_cache.pop(key)[1]
+        query_cache_counters['invalidations'] += len(stale)
+
+
+write_hooks.append(_invalidate_collection)
+
+
+def _canon(obj) -> str:
+    """Stable text form of a filter/projection/sort for cache keys."""
+    return json_util.dumps(obj, sort_keys=True)
+
+
+def _result_size(result) -> int:
+    if isinstance(result, list):
+        return sum(len(bson.encode(doc)) for doc in result)
+    return 64
+
+
+def _cache_lookup(db: str, collection: str, key: tuple) -> tuple:
+    """
+    (True, result) on a query cache hit; (False, version) on a miss,
+    where version is what _cache_store() must see to keep the result.
+    """
+    global _query_cache_bytes
+    key = (db, collection) + key
+    with _query_cache_lock:
+        entry = _query_cache.get(key)
+        if entry is not None and entry[2] > time.monotonic():
+            _query_cache.move_to_end(key)
+            query_cache_counters['hits'] += 1
+            metrics.cache_lookup(QUERY_CACHE, True)
+            return True, _copy_result(entry[0])
+        if entry is not None:
+            _query_cache_bytes -= _query_cache.pop(key)[1]
+        query_cache_counters['misses'] += 1
+        metrics.cache_lookup(QUERY_CACHE, False)
+        return False, _collection_versions.get((db, collection), 0)
+
+
+def _cache_store(db: str, collection: str, key: tuple, result, version):
+    """
+    Store a loaded result unless a write to the collection happened
+    while it was being loaded. Returns what the caller should hand out.
+    """
+    global _query_cache_bytes
+    size = _result_size(result)
+    if size > QUERY_CACHE_BYTES:
+        return result
+    key = (db, collection) + key
+    with _query_cache_lock:
+        if _collection_versions.get((db, collection), 0) != version:
+            return result
+        old = _query_cache.pop(key, None)
+        if old is not None:
+            _query_cache_bytes -= old[1]
+        _query_cache[key] = (result, size,
+                             time.monotonic() + QUERY_CACHE_TTL)
+        _query_cache_bytes += size
+        while (len(_query_cache) > QUERY_CACHE_ENTRIES
+               or _query_cache_bytes > QUERY_CACHE_BYTES):
+            _query_cache_bytes -= _query_cache.popitem(last=False)[1][1]
+            query_cache_counters['evictions'] += 1
+    return _copy_result(result)
+
+
+def _cached(db: str, collection: str, key: tuple, loader):
+    """
+    Return loader()'s result from the query cache, calling it on a miss.
+    A result is only stored if no write to the collection happened while
+    it was being loaded. Lists come back as fresh lists of shallow doc
+    copies so callers may mutate them.
+    """
+    if QUERY_CACHE_ENTRIES < 1:
+        return loader()
+    hit, val = _cache_lookup(db, collection, key)
+    if hit:
+        return val
+    return _cache_store(db, collection, key, loader(), val)
+
+
+def _copy_result(result):
+    if isinstance(result, list):
+        return [dict(doc) for doc in result]
+    if isinstance(result, dict):
+        return dict(result)
+    return result
+
+
+def cached_find(collection, filt=None, projection=None, sort=None, skip=0,
+                limit=0, collation=None, db=GEO_DB, no_id=True) -> list:
+    """
+    find() through the query cache, as a list. Repeat queries are served
+    from memory until a write to the collection or the TTL expires them.
+    """
+    key = ('find', _canon(filt), _canon(projection), _canon(sort), skip,
+           limit, _canon(collation), no_id)
+    return _cached(db, collection, key, lambda: list(find(
+        collection, filt, projection, sort=sort, skip=skip, limit=limit,
+        collation=collation, db=db, no_id=no_id)))
+
+
+def clear_query_cache():
+    global _query_cache_bytes
+    with _query_cache_lock:
+        _query_cache.clear()
+        _query_cache_bytes = 0
+
+
+def query_cache_info() -> dict:
+    """Hit/miss/eviction/invalidation counters plus current size."""
+    with _query_cache_lock:
+        return {
+            **query_cache_counters,
+            'entries': len(_query_cache),
+            'bytes': _query_cache_bytes,
+        }
+
+
+def _collect_query_cache():
+    info = query_cache_info()
+    query_cache_size.set('entries', value=info['entries'])
+    query_cache_size.set('bytes', value=info['bytes'])
+
+
+metrics.collectors.append(_collect_query_cache)
+
+
+@needs_db
+def _estimated_count(collection, db=GEO_DB) -> int:
+    return client[db][collection].estimated_document_count()
+
+
+@needs_db
+def _count_documents(collection, filt, db=GEO_DB) -> int:
+    return client[db][collection].count_documents(filt)
+
+
+def count(collection, filt=None, db=GEO_DB) -> int:
+    """
+    Documents in collection: from collection metadata when there is no
+    filter, else count_documents(filt). Goes through the query cache, so
+    repeat counts are free until the next write to the collection.
+    """
+    if not filt:
+        return _cached(db, collection, ('count',),
+                       lambda: _estimated_count(collection, db=db))
+    return _cached(db, collection, ('count', _canon(filt)),
+                   lambda: _count_documents(collection, filt, db=db))
+
+
+def _group_pipeline(field: str, filt) -> list:
+    if not isinstance(field, str) or not field or field.startswith('$'):
+        raise ValueError(f'Bad group field: {field!r}')
+    pipeline = [{'$match': filt}] if filt else []
+    pipeline.append({'$group': {MONGO_ID: f'${field}', 'n': {'$sum': 1}}})
+    return pipeline
+
+
+@needs_db
+def _group_counts(collection, pipeline, db=GEO_DB) -> dict:
+    return {doc[MONGO_ID]: doc['n']
+            for doc in client[db][collection].aggregate(pipeline)}
+
+
+def count_by(collection, field, filt=None, db=GEO_DB) -> dict:
+    """
+    {value of field: number of documents} over the collection (or the
+    docs matching filt), grouped in the DB and cached like count().
+    Documents missing the field are counted under None.
+    """
+    pipeline = _group_pipeline(field, filt)
+    return _cached(db, collection, ('count_by', field, _canon(filt)),
+                   lambda: _group_counts(collection, pipeline, db=db))
+
+
+def register_index(collection: str, keys: list, name: str,
+                   unique: bool = False, collation: dict = None,
+                   db: str = GEO_DB):
+    """
+    Declare an index a query module relies on. keys is a list of
+    (field, direction) pairs. Registering the same name again replaces
+    the earlier declaration, so module reloads are harmless.
+    """
+    spec = {'keys': list(keys), 'unique': unique, 'collation': collation}
+    index_registry.setdefault((db, collection), {})[name] = spec
+
+
+def _same_index(spec: dict, info: dict) -> bool:
+    """True if an existing index (index_information() entry) fits spec."""
+    if [tuple(k) for k in info.get('key', [])] != spec['keys']:
+        return False
+    if bool(info.get('unique')) != spec['unique']:
+        return False
+    existing = info.get('collation') or {}
+    wanted = spec['collation'] or {}
+    return all(existing.get(k) == v for k, v in wanted.items())
+
+
+def ensure_indexes() -> dict:
+    """
+    Create any registered index that is missing. Idempotent: indexes that
+    already exist are left alone, and one that exists under the same name
+    with a different spec is reported as failed rather than dropped.
+    Returns {collection: {IDX_CREATED: [...], IDX_FAILED: [...]}}.
+    """
+    report = {}
+    for (db, collection), specs in index_registry.items():
+        coll = client[db][collection]
+        existing = coll.index_information()
+        created, failed = [], []
+        for name, spec in specs.items():
+            if name in existing:
+                if not _same_index(spec, existing[name]):
+                    logger.warning(
+                        'Index %s.%s differs from its declaration',
+                        collection, name)
+                    failed.append(name)
+                continue
+            kwargs = {'name': name, 'unique': spec['unique']}
+            if spec['collation']:
+                kwargs['collation'] = spec['collation']
+            try:
+                coll.create_index(spec['keys'], **kwargs)
+                created.append(name)
+            except pm.errors.OperationFailure as e:
+                logger.error(
+                    'Could not create index %s.%s: %s', collection, name, e)
+                failed.append(name)
+        if created:
+            logger.info('Created indexes on %s: %s', collection, created)
+        report[collection] = {IDX_CREATED: created, IDX_FAILED: failed}
+    return report
+
+
+@needs_db
+def index_report() -> dict:
+    """
+    Compare registered indexes with what is in the DB:
+    IDX_MISSING are declared but absent, IDX_UNREGISTERED exist but are
+    not declared, IDX_UNUSED have seen no operations since the server
+    started (per $indexStats).
+    """
+    report = {}
+    for (db, collection), specs in index_registry.items():
+        coll = client[db][collection]
+        existing = coll.index_information()
+        ops = {
+            stat['name']: stat['accesses']['ops']
+            for stat in coll.aggregate([{'$indexStats': {}}])
+        }
+        report[collection] = {
+            IDX_MISSING: sorted(set(specs) - set(existing)),
+            IDX_UNREGISTERED: sorted(
+                set(existing) - set(specs) - {'_id_'}),
+            IDX_UNUSED: sorted(
+                name for name in existing if ops.get(name) == 0),
+        }
+    return report
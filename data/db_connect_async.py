@@ -0,0 +1,337 @@
+"""
+Async counterparts of the data/db_connect.py CRUD functions, for the
+ASGI app (server/asgi.py). They use pymongo's AsyncMongoClient and share
+db_connect's circuit breaker, query cache and write hooks, so both
+stacks see the same DB health, cached results and collection versions.
+"""
+import asyncio
+import os
+import time
+from functools import wraps
+
+import pymongo as pm
+
+import data.db_connect as dbc
+import data.tracing as tracing
+
+GEO_DB = dbc.GEO_DB
+MONGO_ID = dbc.MONGO_ID
+
+client = None
+_client_pid = None
+# so concurrent first requests build one client between them
+_connect_lock = asyncio.Lock()
+
+
+def needs_db(fn):
+    op = fn.__name__.lstrip('_')
+
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        """Async version of dbc.needs_db."""
+        collection = kwargs.get('collection', args[0] if args else '')
+        if not dbc._circuit_allows():
+            dbc.db_operations.inc(op, collection, dbc.OP_REJECTED)
+            raise ConnectionError('Database unavailable')
+        parent = tracing.current()
+        start = time.perf_counter_ns()
+        try:
+            if client is None or _client_pid != os.getpid():
+                await connect_db()
+            ret = await fn(*args, **kwargs)
+        except pm.errors.ConnectionFailure as e:
+            dbc._record_failure()
+            dbc._observe_op(op, collection, start, dbc.OP_ERROR, parent, e)
+            raise ConnectionError(f'Database unavailable: {e}') from e
+        except Exception as e:
+            dbc._observe_op(op, collection, start, dbc.OP_ERROR, parent, e)
+            raise
+        dbc._record_success()
+        if op != 'cursor':
+            dbc._observe_op(op, collection, start, dbc.OP_OK, parent)
+        return ret
+    return wrapper
+
+
+async def connect_db():
+    """
+    Build this process's AsyncMongoClient from the same settings as the
+    sync client. Must be called from the event loop that will use it.
+    """
+    global client, _client_pid
+    if client is not None and _client_pid == os.getpid():
+        return client
+    async with _connect_lock:
+        if client is not None and _client_pid == os.getpid():
+            return client
+        uri, opts = dbc.client_settings()
+        candidate = pm.AsyncMongoClient(uri, **opts)
+        try:
+            await candidate.admin.command('ping')
+        except Exception:
+            await candidate.close()
+            raise
+        client, _client_pid = candidate, os.getpid()
+    dbc.logger.info('Connected async MongoDB client')
+    return client
+
+
+async def close_db():
+    global client, _client_pid
+    if client is not None and _client_pid == os.getpid():
+        await client.close()
+    client, _client_pid = None, None
+
+
+def _reset_after_fork():
+    """A forked child builds its own client, and its own lock for it."""
+    global client, _client_pid, _connect_lock
+    client, _client_pid = None, None
+    _connect_lock = asyncio.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+async def _after_write(db: str, collection: str):
+    """
+    Async dbc._after_write: the in-memory write hooks, then the shared
+    version bump through this client, never a blocking sync call.
+    """
+    dbc._run_write_hooks(db, collection)
+    if not dbc.counts_versions():
+        return
+    try:
+        doc = await client[db][dbc.VERSION_COLLECTION].find_one_and_update(
+            {MONGO_ID: collection}, {'$inc': {'v': 1}}, upsert=True,
+            return_document=pm.ReturnDocument.AFTER)
+    except pm.errors.PyMongoError as e:
+        dbc.logger.error(f'Version bump for {collection} failed: {e}')
+        return
+    dbc._note_own_write(db, collection, doc['v'])
+
+
+@needs_db
+async def create(collection: str, doc: dict, db: str = GEO_DB) -> str:
+    """
+    Insert a single doc into collection.
+    """
+    ret = await client[db][collection].insert_one(doc)
+    await _after_write(db, collection)
+    return str(ret.inserted_id)
+
+
+@needs_db
+async def create_many(collection: str, docs: list, db: str = GEO_DB,
+                      batch_size: int = dbc.BULK_BATCH_SIZE,
+                      validate=None) -> dict:
+    """
+    Unordered bulk insert with per-doc results; see dbc.create_many().
+    """
+    ids = [None] * len(docs)
+    to_send, positions, errors = dbc._prepare_inserts(docs, validate)
+    coll = client[db][collection]
+    for offset, batch in dbc._batches(to_send, batch_size):
+        try:
+            await coll.insert_many(batch, ordered=False)
+        except pm.errors.BulkWriteError as e:
+            dbc._inserted(batch, offset, positions, ids, errors, e)
+        else:
+            dbc._inserted(batch, offset, positions, ids, errors)
+    if to_send:
+        await _after_write(db, collection)
+    errors.sort(key=lambda err: err[dbc.BULK_INDEX])
+    return {dbc.BULK_IDS: ids, dbc.BULK_ERRORS: errors}
+
+
+@needs_db
+async def read_one(collection: str, filt: dict, db: str = GEO_DB,
+                   projection: dict = None):
+    """
+    Return the first doc matching the filter, or None if not found.
+    """
+    doc = await client[db][collection].find_one(filt, projection)
+    if doc is not None:
+        dbc.convert_mongo_id(doc)
+    return doc
+
+
+@needs_db
+async def update_and_fetch(collection, filters, update_dict, db=GEO_DB):
+    """
+    $set update_dict on the first doc matching filters and return that
+    doc as it was before the update (None if nothing matched).
+    """
+    doc = await client[db][collection].find_one_and_update(
+        filters, {'$set': update_dict})
+    await _after_write(db, collection)
+    if doc is not None:
+        dbc.convert_mongo_id(doc)
+    return doc
+
+
+@needs_db
+async def delete_and_fetch(collection, filt, db=GEO_DB):
+    """
+    Delete the first doc matching filt and return it (None if nothing
+    matched).
+    """
+    doc = await client[db][collection].find_one_and_delete(filt)
+    await _after_write(db, collection)
+    if doc is not None:
+        dbc.convert_mongo_id(doc)
+    return doc
+
+
+@needs_db
+async def _cursor(collection, filt, projection, sort, skip, limit,
+                  batch_size, collation, db, no_id):
+    if no_id:
+        projection = {**(projection or {}), MONGO_ID: 0}
+    return client[db][collection].find(
+        filt or {}, projection, skip=skip, limit=limit, sort=sort,
+        batch_size=batch_size, collation=collation)
+
+
+async def find(collection, filt=None, projection=None, sort=None, skip=0,
+               limit=0, batch_size=0, collation=None, db=GEO_DB,
+               no_id=True):
+    """
+    Async generator over the docs matching `filt`; see dbc.find().
+    """
+    cursor = await _cursor(collection, filt, projection, sort, skip,
+                           limit, batch_size, collation, db, no_id)
+    parent = tracing.current()
+    start = time.perf_counter_ns()
+    status = dbc.OP_ERROR
+    answered = False
+    try:
+        async for doc in cursor:
+            if not answered:
+                answered = True
+                dbc._record_success()
+            dbc.convert_mongo_id(doc)
+            yield doc
+        if not answered:
+            dbc._record_success()
+        status = dbc.OP_OK
+    except pm.errors.ConnectionFailure as e:
+        dbc._record_failure()
+        raise ConnectionError(f'Database unavailable: {e}') from e
+    finally:
+        await cursor.close()
+        dbc._observe_op('find', collection, start, status, parent)
+
+
+async def read(collection, db=GEO_DB, no_id=True) -> list:
+    """
+    Returns a list from the db.
+    """
+    return [doc async for doc in find(collection, db=db, no_id=no_id)]
+
+
+async def read_by_ids(collection, ids, db=GEO_DB) -> dict:
+    """
+    {id string: doc} for those of ids that exist; see dbc.read_by_ids().
+    """
+    filt = dbc.ids_filter(ids)
+    if filt is None:
+        return {}
+    return {doc[MONGO_ID]: doc
+            async for doc in find(collection, filt, db=db, no_id=False)}
+
+
+async def cached_find(collection, filt=None, projection=None, sort=None,
+                      skip=0, limit=0, collation=None, db=GEO_DB,
+                      no_id=True) -> list:
+    """
+    find() through dbc's query cache, as a list; see dbc.cached_find().
+    """
+    async def load():
+        return [doc async for doc in find(
+            collection, filt, projection, sort=sort, skip=skip,
+            limit=limit, collation=collation, db=db, no_id=no_id)]
+
+    key = ('find', dbc._canon(filt), dbc._canon(projection),
+           dbc._canon(sort), skip, limit, dbc._canon(collation), no_id)
+    return await _cached(db, collection, key, load)
+
+
+async def read_page(collection, sort_key, limit, cursor=None, desc=False,
+                    db=GEO_DB, no_id=True) -> tuple:
+    """
+    Return (docs, next_cursor) for one page ordered by (sort_key, _id);
+    see dbc.read_page().
+    """
+    direction = pm.DESCENDING if desc else pm.ASCENDING
+    filt = {}
+    if cursor:
+        value, last_id = dbc.decode_cursor(cursor, sort_key, desc)
+        filt = dbc._keyset_filter(sort_key, value, last_id, desc)
+    docs = await cached_find(
+        collection, filt,
+        sort=[(sort_key, direction), (MONGO_ID, direction)],
+        limit=limit + 1,
+        collation=dbc.CASE_INSENSITIVE,
+        db=db,
+        no_id=False,
+    )
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        last = docs[-1]
+        next_cursor = dbc.encode_cursor(
+            sort_key, desc, last.get(sort_key), last[MONGO_ID])
+    if no_id:
+        for doc in docs:
+            del doc[MONGO_ID]
+    return docs, next_cursor
+
+
+@needs_db
+async def _estimated_count(collection, db=GEO_DB) -> int:
+    return await client[db][collection].estimated_document_count()
+
+
+@needs_db
+async def _count_documents(collection, filt, db=GEO_DB) -> int:
+    return await client[db][collection].count_documents(filt)
+
+
+async def _cached(db, collection, key, load):
+    """Await load() on a query cache miss; see dbc._cached()."""
+    if dbc.QUERY_CACHE_ENTRIES < 1:
+        return await load()
+    hit, val = dbc._cache_lookup(db, collection, key)
+    if hit:
+        return val
+    return dbc._cache_store(db, collection, key, await load(), val)
+
+
+async def count(collection, filt=None, db=GEO_DB) -> int:
+    """
+    Documents in collection, through dbc's query cache; see dbc.count().
+    """
+    if not filt:
+        return await _cached(db, collection, ('count',),
+                             lambda: _estimated_count(collection, db=db))
+    return await _cached(db, collection, ('count', dbc._canon(filt)),
+                         lambda: _count_documents(collection, filt, db=db))
+
+
+@needs_db
+async def _group_counts(collection, pipeline, db=GEO_DB) -> dict:
+    cursor = await client[db][collection].aggregate(pipeline)
+    return {doc[MONGO_ID]: doc['n'] async for doc in cursor}
+
+
+async def count_by(collection, field, filt=None, db=GEO_DB) -> dict:
+    """
+    {value of field: number of documents}, grouped in the DB and cached;
+    see dbc.count_by().
+    """
+    pipeline = dbc._group_pipeline(field, filt)
+    return await _cached(db, collection,
+                         ('count_by', field, dbc._canon(filt)),
+                         lambda: _group_counts(collection, pipeline, db=db))
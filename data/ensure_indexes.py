@@ -0,0 +1,23 @@
+"""
+Admin command: create any missing declared indexes and report on
+missing, undeclared and unused ones.
+Usage: python -m data.ensure_indexes
+"""
+import json
+
+import data.db_connect as dbc
+# Importing the query modules registers their indexes.
+import cities.queries  # noqa: F401
+import states.queries  # noqa: F401
+
+
+def main():
+    dbc.connect_db()
+    print(json.dumps({
+        'ensured': dbc.ensure_indexes(),
+        'report': dbc.index_report(),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+GeoJSON helpers for the spatial queries: building and checking points,
+the $near/$geoWithin filters the query modules send to Mongo (which
+answers them from a 2dsphere index), and great-circle distance.
+Coordinates are taken as (lat, lon), the order clients use; GeoJSON
+itself stores [lon, lat].
+"""
+import math
+
+GEOSPHERE = '2dsphere'
+POINT = 'Point'
+POLYGON = 'Polygon'
+TYPE = 'type'
+COORDINATES = 'coordinates'
+
+# mean Earth radius (IUGG), as used for $centerSphere radians
+EARTH_RADIUS_KM = 6371.0088
+
+
+def check_lat_lon(lat, lon) -> tuple:
+    """(lat, lon) as floats; ValueError if either is not a coordinate."""
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        raise ValueError(f'Bad coordinates: {lat=}, {lon=}') from None
+    if not -90 <= lat <= 90:
+        raise ValueError(f'Latitude out of range: {lat}')
+    if not -180 <= lon <= 180:
+        raise ValueError(f'Longitude out of range: {lon}')
+    return lat, lon
+
+
+def point(lat, lon) -> dict:
+    """A GeoJSON Point."""
+    lat, lon = check_lat_lon(lat, lon)
+    return {TYPE: POINT, COORDINATES: [lon, lat]}
+
+
+def lat_lon(location: dict) -> tuple:
+    """(lat, lon) of a GeoJSON Point."""
+    lon, lat = location[COORDINATES]
+    return lat, lon
+
+
+def _check_km(km, name: str) -> float:
+    try:
+        km = float(km)
+    except (TypeError, ValueError):
+        raise ValueError(f'Bad value for {name}: {km}') from None
+    if km < 0:
+        raise ValueError(f'{name} must not be negative')
+    return km
+
+
+def near_filter(lat, lon, max_km=None) -> dict:
+    """$near a point (closest first), optionally within max_km."""
+    ret = {'$geometry': point(lat, lon)}
+    if max_km is not None:
+        ret['$maxDistance'] = _check_km(max_km, 'max_km') * 1000
+    return {'$near': ret}
+
+
+def radius_filter(lat, lon, km) -> dict:
+    """$geoWithin the spherical cap of radius km around a point."""
+    lat, lon = check_lat_lon(lat, lon)
+    radians = _check_km(km, 'km') / EARTH_RADIUS_KM
+    return {'$geoWithin': {'$centerSphere': [[lon, lat], radians]}}
+
+
+def polygon_filter(points: list) -> dict:
+    """
+    $geoWithin a polygon given as (lat, lon) pairs; the ring is closed
+    for the caller. Edges are great-circle arcs, as for any GeoJSON
+    polygon on a 2dsphere index.
+    """
+    if not isinstance(points, (list, tuple)):
+        raise ValueError('Polygon must be a list of (lat, lon) pairs')
+    ring = []
+    for pair in points:
+        if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+            raise ValueError(f'Bad polygon point: {pair}')
+        lat, lon = check_lat_lon(*pair)
+        ring.append([lon, lat])
+    if ring and ring[0] != ring[-1]:
+        ring.append(ring[0])
+    if len(ring) < 4:
+        raise ValueError('Polygon needs at least 3 distinct points')
+    return {'$geoWithin': {'$geometry': {TYPE: POLYGON,
+                                         COORDINATES: [ring]}}}
+
+
+def box_filter(sw_lat, sw_lon, ne_lat, ne_lon) -> dict:
+    """$geoWithin the box between a south-west and north-east corner."""
+    sw_lat, sw_lon = check_lat_lon(sw_lat, sw_lon)
+    ne_lat, ne_lon = check_lat_lon(ne_lat, ne_lon)
+    if sw_lat >= ne_lat or sw_lon >= ne_lon:
+        raise ValueError('Box corners must be south-west, then north-east')
+    return polygon_filter([(sw_lat, sw_lon), (sw_lat, ne_lon),
+                           (ne_lat, ne_lon), (ne_lat, sw_lon)])
+
+
+def haversine_km(lat1, lon1, lat2, lon2) -> float:
+    """Great-circle distance between two points, in km."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlam = math.radians(lon2 - lon1)
+    a = (math.sin(dphi / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(dlam / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
@@ -0,0 +1,91 @@
+"""
+Batch great-circle distances from many query points to a fixed set of
+located points (the state centroids). The fixed side is kept as a
+columnar copy (radian latitude/longitude arrays plus cos(latitude)), so
+each request is one vectorized haversine over a points x columns matrix.
+"""
+import math
+
+import numpy as np
+
+import data.geo as geo
+
+# query points per vectorized block; bounds the temporaries' memory
+BLOCK_ROWS = 1024
+
+
+class Columns:
+    """Keys and coordinates of located points, column by column."""
+    __slots__ = ('keys', 'lat', 'lon', 'cos_lat')
+
+    def __init__(self, items=()):
+        """items: (key, lat, lon) triples."""
+        items = list(items)
+        self.keys = [key for key, _, _ in items]
+        lat = [math.radians(lat) for _, lat, _ in items]
+        lon = [math.radians(lon) for _, _, lon in items]
+        self.lat, self.lon = np.array(lat), np.array(lon)
+        self.cos_lat = np.cos(self.lat)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+
+def _bad_points():
+    return ValueError('points must be a non-empty list of [lat, lon] pairs')
+
+
+def to_radians(points) -> tuple:
+    """Validated [(lat, lon), ...] query points as radian columns."""
+    if not isinstance(points, (list, tuple)) or not points:
+        raise _bad_points()
+    try:
+        arr = np.asarray(points, dtype=float)
+    except (TypeError, ValueError):
+        raise _bad_points() from None
+    if arr.ndim != 2 or arr.shape[1] != 2:
+        raise _bad_points()
+    lat, lon = arr[:, 0], arr[:, 1]
+    # written so NaN fails too
+    if not (np.all(np.abs(lat) <= 90) and np.all(np.abs(lon) <= 180)):
+        raise ValueError('Coordinates out of range')
+    return np.radians(lat), np.radians(lon)
+
+
+def _km_blocks(cols: Columns, lat, lon):
+    """Yield (first row, km matrix) per block of query points."""
+    for start in range(0, len(lat), BLOCK_ROWS):
+        plat = lat[start:start + BLOCK_ROWS, None]
+        plon = lon[start:start + BLOCK_ROWS, None]
+        a = (np.sin((plat - cols.lat) / 2) ** 2
+             + np.cos(plat) * cols.cos_lat
+             * np.sin((plon - cols.lon) / 2) ** 2)
+        yield start, (2 * geo.EARTH_RADIUS_KM
+                      * np.arcsin(np.sqrt(np.minimum(a, 1.0))))
+
+
+def distance_matrix(cols: Columns, points, digits: int = 3) -> list:
+    """[[km to each column] per query point], rounded to digits."""
+    lat, lon = to_radians(points)
+    ret = []
+    for _, block in _km_blocks(cols, lat, lon):
+        ret.extend(np.round(block, digits).tolist())
+    return ret
+
+
+def within(cols: Columns, points, km: float, digits: int = 3) -> list:
+    """
+    For each query point, [(column index, km), ...] for the columns
+    within km of it, nearest first.
+    """
+    if not isinstance(km, (int, float)) or km < 0:
+        raise ValueError('km must be a non-negative number')
+    lat, lon = to_radians(points)
+    ret = []
+    for _, block in _km_blocks(cols, lat, lon):
+        for row in block:
+            idx = np.flatnonzero(row <= km)
+            idx = idx[np.argsort(row[idx], kind='stable')]
+            ret.append(list(zip(idx.tolist(),
+                                np.round(row[idx], digits).tolist())))
+    return ret
@@ -0,0 +1,136 @@
+"""
+A 3-d KD-tree over points on the globe, for nearest-neighbour lookups
+without a DB round trip. Points are stored as unit vectors: straight-line
+(chord) distance between them orders neighbours exactly as great-circle
+distance does, so poles and the antimeridian need no special cases.
+
+Updates are incremental. add() descends to a leaf and remove() leaves a
+tombstone; once tombstones and unbalanced inserts together outnumber
+the live points, the tree rebuilds itself balanced from the live points.
+"""
+import heapq
+import math
+
+from data.geo import EARTH_RADIUS_KM, check_lat_lon
+
+# node layout (lists, for speed)
+_POINT, _KEY, _AXIS, _LEFT, _RIGHT, _ALIVE = range(6)
+
+# rebuild no more often than every this many changes
+MIN_REBUILD = 16
+
+
+def to_xyz(lat, lon) -> tuple:
+    """Unit vector for a (lat, lon) in degrees."""
+    lat, lon = check_lat_lon(lat, lon)
+    phi, lam = math.radians(lat), math.radians(lon)
+    return (math.cos(phi) * math.cos(lam),
+            math.cos(phi) * math.sin(lam),
+            math.sin(phi))
+
+
+def chord_to_km(chord: float) -> float:
+    """Great-circle distance for a chord between two unit vectors."""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def _build(points: list, depth: int, nodes: dict):
+    """Balanced subtree over [(xyz, key), ...]; fills nodes by key."""
+    if not points:
+        return None
+    axis = depth % 3
+    points.sort(key=lambda p: p[0][axis])
+    mid = len(points) // 2
+    point, key = points[mid]
+    node = [point, key, axis,
+            _build(points[:mid], depth + 1, nodes),
+            _build(points[mid + 1:], depth + 1, nodes),
+            True]
+    nodes[key] = node
+    return node
+
+
+class KDTree:
+    """Points keyed by any hashable; one point per key."""
+
+    def __init__(self, items=()):
+        """items: (key, lat, lon) triples; a later key replaces earlier."""
+        points = {key: to_xyz(lat, lon) for key, lat, lon in items}
+        self._rebuild([(xyz, key) for key, xyz in points.items()])
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, key) -> bool:
+        return key in self._nodes
+
+    def _rebuild(self, points: list):
+        nodes = {}
+        root = _build(points, 0, nodes)
+        self._root, self._nodes = root, nodes
+        self._changes = 0
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes > max(MIN_REBUILD, len(self._nodes)):
+            self._rebuild([(node[_POINT], key)
+                           for key, node in self._nodes.items()])
+
+    def add(self, key, lat, lon):
+        """Insert a point, replacing any earlier point for key."""
+        point = to_xyz(lat, lon)
+        old = self._nodes.get(key)
+        if old is not None:
+            old[_ALIVE] = False
+        node = [point, key, 0, None, None, True]
+        parent = self._root
+        if parent is None:
+            self._root = node
+        while parent is not None:
+            axis = parent[_AXIS]
+            side = _LEFT if point[axis] < parent[_POINT][axis] else _RIGHT
+            if parent[side] is None:
+                node[_AXIS] = (axis + 1) % 3
+                parent[side] = node
+                break
+            parent = parent[side]
+        self._nodes[key] = node
+        self._changed()
+
+    def remove(self, key) -> bool:
+        """Drop key's point; False if it had none."""
+        node = self._nodes.pop(key, None)
+        if node is None:
+            return False
+        node[_ALIVE] = False
+        self._changed()
+        return True
+
+    def nearest(self, lat, lon, k: int = 1) -> list:
+        """[(key, km), ...] for the k points closest to (lat, lon)."""
+        target = to_xyz(lat, lon)
+        best = []  # max-heap of (-squared chord, tiebreak, key)
+        tiebreak = 0
+        stack = [(self._root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if node is None or (len(best) == k and bound >= -best[0][0]):
+                continue
+            point = node[_POINT]
+            if node[_ALIVE]:
+                d2 = ((target[0] - point[0]) ** 2
+                      + (target[1] - point[1]) ** 2
+                      + (target[2] - point[2]) ** 2)
+                tiebreak += 1
+                if len(best) < k:
+                    heapq.heappush(best, (-d2, tiebreak, node[_KEY]))
+                elif d2 < -best[0][0]:
+                    heapq.heapreplace(best, (-d2, tiebreak, node[_KEY]))
+            diff = target[node[_AXIS]] - point[node[_AXIS]]
+            near, far = ((node[_LEFT], node[_RIGHT]) if diff < 0
+                         else (node[_RIGHT], node[_LEFT]))
+            # far side first, so the near side is searched first
+            stack.append((far, diff * diff))
+            stack.append((near, 0.0))
+        return [(key, chord_to_km(math.sqrt(-neg)))
+                for neg, _, key in sorted(best, reverse=True)]
@@ -0,0 +1,190 @@
+"""
+In-process metrics registry: counters, gauges and histograms keyed by
+label values, rendered in the Prometheus text exposition format (served
+at /metrics). Recording is a dict update under a per-metric lock, cheap
+enough for every request and every DB call.
+"""
+import bisect
+import threading
+
+# Seconds; covers sub-millisecond cache hits to multi-second scans
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+TEXT_MIME = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = {}
+_registry_lock = threading.Lock()
+# callables run at render time, for stats kept elsewhere (e.g. dbc's
+# query cache counters), so the hot path doesn't pay for them
+collectors = []
+
+
+def _escape(val) -> str:
+    return (str(val).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _fmt(val) -> str:
+    if val == float('inf'):
+        return '+Inf'
+    return repr(float(val)) if isinstance(val, float) else str(val)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, doc: str, labelnames: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> list:
+        """[(suffix, label values, extra label, value)] for rendering."""
+        with self._lock:
+            return [('', key, '', val) for key, val in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.doc}',
+                 f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, val in self.samples():
+            lines.append(f'{self.name}{suffix}'
+                         f'{_labels(self.labelnames, key, extra)} '
+                         f'{_fmt(val)}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = COUNTER
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Counter):
+    kind = GAUGE
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = HISTOGRAM
+
+    def __init__(self, name: str, doc: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # per-bucket (non-cumulative) counts, then sum
+                entry = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            entry[0][idx] += 1
+            entry[1] += value
+
+    def count(self, *labels) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def samples(self) -> list:
+        with self._lock:
+            items = [(key, list(counts), total)
+                     for key, (counts, total) in self._values.items()]
+        ret = []
+        bounds = self.buckets + (float('inf'),)
+        for key, counts, total in items:
+            running = 0
+            for bound, n in zip(bounds, counts):
+                running += n
+                ret.append(('_bucket', key, f'le="{_fmt(bound)}"', running))
+            ret.append(('_sum', key, '', total))
+            ret.append(('_count', key, '', running))
+        return ret
+
+
+def _register(cls, name, doc, labelnames, **kwargs):
+    with _registry_lock:
+        metric = registry.get(name)
+        if metric is None:
+            metric = registry[name] = cls(name, doc, labelnames, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f'{name} is already a {metric.kind}')
+        return metric
+
+
+def counter(name: str, doc: str, labelnames: tuple = ()) -> Counter:
+    """Get or create the named counter."""
+    return _register(Counter, name, doc, labelnames)
+
+
+def gauge(name: str, doc: str, labelnames: tuple = ()) -> Gauge:
+    """Get or create the named gauge."""
+    return _register(Gauge, name, doc, labelnames)
+
+
+def histogram(name: str, doc: str, labelnames: tuple = (),
+              buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    """Get or create the named histogram."""
+    return _register(Histogram, name, doc, labelnames, buckets=buckets)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    for collect in collectors:
+        collect()
+    with _registry_lock:
+        metrics = sorted(registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Shared metrics, recorded by the query modules and the servers
+cache_requests = counter(
+    'app_cache_requests_total',
+    'In-memory cache lookups by cache and result (hit/miss)',
+    ('cache', 'result'))
+http_requests = counter(
+    'http_requests_total', 'HTTP requests by method, route and status',
+    ('method', 'route', 'status'))
+http_duration = histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route',
+    ('method', 'route'))
+
+HIT = 'hit'
+MISS = 'miss'
+
+
+def cache_lookup(cache: str, hit: bool):
+    cache_requests.inc(cache, HIT if hit else MISS)
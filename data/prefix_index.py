@@ -0,0 +1,96 @@
+"""
+In-memory prefix search over names, for autocomplete. Names are
+normalized (accents stripped, case folded, whitespace collapsed) and
+kept in sorted lists of (name, key), so a prefix lookup is one bisect
+plus a walk over the matches. An entry may carry a scope (e.g. a state
+code); each scope gets its own sorted list, so scoped lookups never walk
+past other scopes' names. add() and remove() keep the lists sorted in
+place, so the index can follow cache writes without a rebuild.
+"""
+import bisect
+import unicodedata
+
+
+def normalize(text: str) -> str:
+    """Name as searched: no accents, case folded, single spaces."""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(text.casefold().split())
+
+
+def normalize_prefix(text: str) -> str:
+    """normalize(), keeping one trailing space ("new " != "new")."""
+    norm = normalize(text)
+    if norm and text[-1:].isspace():
+        norm += ' '
+    return norm
+
+
+class PrefixIndex:
+    """Keys (all of one comparable type) searchable by name prefix."""
+
+    def __init__(self, items=()):
+        """items: (key, name, scope) triples; scope may be None."""
+        self._entries = {}  # key -> (normalized name, scope)
+        self._all = []
+        self._scoped = {}
+        for key, name, scope in items:
+            if isinstance(name, str) and key not in self._entries:
+                self._entries[key] = (normalize(name), scope)
+        for key, (norm, scope) in self._entries.items():
+            self._all.append((norm, key))
+            self._scoped.setdefault(scope, []).append((norm, key))
+        self._all.sort()
+        for entries in self._scoped.values():
+            entries.sort()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def add(self, key, name, scope=None):
+        """Index key under name (replacing its old entry, if any)."""
+        if not isinstance(name, str):
+            self.remove(key)
+            return
+        entry = (normalize(name), scope)
+        if self._entries.get(key) == entry:
+            return
+        self.remove(key)
+        self._entries[key] = entry
+        bisect.insort(self._all, (entry[0], key))
+        bisect.insort(self._scoped.setdefault(scope, []), (entry[0], key))
+
+    def remove(self, key) -> bool:
+        """Drop key's entry; False if it had none."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        norm, scope = entry
+        for entries in (self._all, self._scoped[scope]):
+            i = bisect.bisect_left(entries, (norm, key))
+            if i < len(entries) and entries[i] == (norm, key):
+                del entries[i]
+        if not self._scoped[scope]:
+            del self._scoped[scope]
+        return True
+
+    def search(self, prefix: str, limit: int = 10, scope=None,
+               scoped: bool = False) -> list:
+        """
+        Up to limit keys whose normalized name starts with prefix, in
+        name order. With scoped=True only entries added under scope.
+        """
+        prefix = normalize_prefix(prefix)
+        entries = self._scoped.get(scope, []) if scoped else self._all
+        ret = []
+        i = bisect.bisect_left(entries, (prefix,))
+        while i < len(entries) and len(ret) < limit:
+            norm, key = entries[i]
+            if not norm.startswith(prefix):
+                break
+            ret.append(key)
+            i += 1
+        return ret
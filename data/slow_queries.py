@@ -0,0 +1,319 @@
+"""
+Slow query log. A pymongo CommandListener (registered on every client
+dbc builds) times each command. Commands slower than SLOW_QUERY_MS are
+queued (up to SLOW_QUERY_QUEUE_SIZE; the excess is dropped and counted)
+for a background thread, which writes one JSON line per command to a
+rotating log with:
+- the query shape (the filter with its values blanked);
+- the plan summary (e.g. COLLSCAN, or IXSCAN with the index name);
+- the docs and keys examined versus returned.
+explain(executionStats) runs the query again, so each shape is explained
+at most once per SLOW_QUERY_EXPLAIN_SECONDS. Per-shape totals back the
+top-N admin summary.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+from pymongo import monitoring
+
+import data.metrics as metrics
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'slow_queries.log')
+LOG_MAX_BYTES = int(os.environ.get('SLOW_QUERY_LOG_BYTES', '10000000'))
+LOG_BACKUPS = int(os.environ.get('SLOW_QUERY_LOG_BACKUPS', '5'))
+EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', '1') == '1'
+EXPLAIN_SECONDS = float(os.environ.get('SLOW_QUERY_EXPLAIN_SECONDS', '300'))
+QUEUE_SIZE = int(os.environ.get('SLOW_QUERY_QUEUE_SIZE', '100'))
+# cap on distinct shapes kept for the summary
+MAX_SHAPES = int(os.environ.get('SLOW_QUERY_MAX_SHAPES', '1000'))
+
+# Commands explain can run, mapped to the field that holds the filter
+EXPLAINABLE = {
+    'find': 'filter',
+    'aggregate': 'pipeline',
+    'count': 'query',
+    'distinct': 'query',
+    'findAndModify': 'query',
+    'update': 'updates',
+    'delete': 'deletes',
+}
+# Driver/session fields explain must not be sent
+_GENERIC_FIELDS = {'lsid', 'txnNumber', 'autocommit', 'startTransaction',
+                   'readConcern', 'writeConcern', 'cursor'}
+
+TOTAL_MS = 'total_ms'
+MAX_MS = 'max_ms'
+COUNT = 'count'
+SORT_KEYS = (TOTAL_MS, MAX_MS, COUNT)
+# when a shape was last explained (monotonic); kept out of top()
+EXPLAINED_AT = 'explained_at'
+
+logger = logging.getLogger(__name__)
+
+_log = None
+_log_lock = threading.Lock()
+
+_pending = {}
+_shapes = {}
+_shapes_lock = threading.Lock()
+_queue = None
+_explainer = None
+_explainer_pid = None
+_explainer_lock = threading.Lock()
+
+command_duration = metrics.histogram(
+    'db_command_duration_seconds', 'Mongo command latency (driver view)',
+    ('command', 'collection'))
+slow_commands = metrics.counter(
+    'db_slow_commands_total', 'Commands slower than SLOW_QUERY_MS',
+    ('command', 'collection'))
+slow_dropped = metrics.counter(
+    'db_slow_commands_dropped_total',
+    'Slow commands not logged because the queue was full')
+
+
+def shape(value):
+    """A filter/pipeline with every literal replaced by '?'."""
+    if isinstance(value, dict):
+        return {k: shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(v, dict) for v in value):
+            return [shape(v) for v in value]
+        return ['?'] if value else []
+    return '?'
+
+
+def _command_shape(name: str, cmd: dict) -> dict:
+    ret = {'filter': shape(cmd.get(EXPLAINABLE[name]))}
+    if cmd.get('sort'):
+        ret['sort'] = dict(cmd['sort'])
+    if cmd.get('projection'):
+        ret['projection'] = dict(cmd['projection'])
+    return ret
+
+
+def _find_key(doc, key):
+    """First value stored under key anywhere in a nested explain doc."""
+    if isinstance(doc, dict):
+        if key in doc:
+            return doc[key]
+        children = doc.values()
+    elif isinstance(doc, list):
+        children = doc
+    else:
+        return None
+    for child in children:
+        found = _find_key(child, key)
+        if found is not None:
+            return found
+    return None
+
+
+def _stages(plan) -> list:
+    """Stage names down the winning plan, with index names on scans."""
+    ret = []
+    while isinstance(plan, dict):
+        stage = plan.get('stage', '?')
+        if plan.get('indexName'):
+            stage = f'{stage}({plan["indexName"]})'
+        ret.append(stage)
+        plan = (plan.get('inputStage')
+                or (plan.get('inputStages') or [None])[0])
+    return ret
+
+
+def summarize_plan(explain: dict) -> dict:
+    """Plan summary plus examined/returned counts from explain output."""
+    planner = _find_key(explain, 'queryPlanner') or {}
+    winning = planner.get('winningPlan', {})
+    # SBE plans nest the classic tree under queryPlan
+    stages = _stages(winning.get('queryPlan', winning))
+    stats = _find_key(explain, 'executionStats') or {}
+    return {
+        'plan': ' <- '.join(stages),
+        'collscan': 'COLLSCAN' in stages,
+        'docs_examined': stats.get('totalDocsExamined'),
+        'keys_examined': stats.get('totalKeysExamined'),
+        'returned': stats.get('nReturned'),
+        'execution_ms': stats.get('executionTimeMillis'),
+    }
+
+
+def _write(record: dict):
+    global _log
+    with _log_lock:
+        if _log is None:
+            _log = logging.getLogger('slow_queries.file')
+            _log.propagate = False
+            _log.setLevel(logging.INFO)
+            _log.addHandler(RotatingFileHandler(
+                SLOW_QUERY_LOG, maxBytes=LOG_MAX_BYTES,
+                backupCount=LOG_BACKUPS))
+    _log.info(json.dumps(record, default=str, separators=(',', ':')))
+
+
+def _entry(key: tuple, record: dict):
+    """The shape's summary entry (None once MAX_SHAPES are kept)."""
+    entry = _shapes.get(key)
+    if entry is None and len(_shapes) < MAX_SHAPES:
+        entry = _shapes[key] = {
+            'command': record['command'],
+            'collection': record['collection'],
+            'shape': record['shape'],
+            COUNT: 0, TOTAL_MS: 0.0, MAX_MS: 0.0,
+        }
+    return entry
+
+
+def _claim_explain(key: tuple, record: dict) -> bool:
+    """
+    True if the shape is due an explain, which is then counted as done.
+    Shapes past MAX_SHAPES have nowhere to record that: never.
+    """
+    now = time.monotonic()
+    with _shapes_lock:
+        entry = _entry(key, record)
+        if entry is None:
+            return False
+        last = entry.get(EXPLAINED_AT)
+        if last is not None and now - last < EXPLAIN_SECONDS:
+            return False
+        entry[EXPLAINED_AT] = now
+        return True
+
+
+def _remember(key: tuple, record: dict):
+    with _shapes_lock:
+        entry = _entry(key, record)
+        if entry is None:
+            return
+        entry[COUNT] += 1
+        entry[TOTAL_MS] += record['duration_ms']
+        entry[MAX_MS] = max(entry[MAX_MS], record['duration_ms'])
+        if 'plan' in record:
+            for fld in ('plan', 'collscan', 'docs_examined', 'returned'):
+                entry[fld] = record[fld]
+
+
+def _explain(db: str, name: str, cmd: dict) -> dict:
+    """Run explain for cmd through dbc's client."""
+    import data.db_connect as dbc
+    body = {k: v for k, v in cmd.items()
+            if not k.startswith('$') and k not in _GENERIC_FIELDS}
+    return dbc.connect_db()[db].command(
+        'explain', body, verbosity='executionStats')
+
+
+def _handle_slow(db: str, name: str, cmd: dict, duration_ms: float):
+    record = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'db': db,
+        'command': name,
+        'collection': cmd.get(name),
+        'duration_ms': round(duration_ms, 3),
+        'shape': _command_shape(name, cmd),
+    }
+    key = (name, record['collection'],
+           json.dumps(record['shape'], sort_keys=True, default=str))
+    if EXPLAIN and _claim_explain(key, record):
+        try:
+            record.update(summarize_plan(_explain(db, name, cmd)))
+        except Exception as e:
+            record['explain_error'] = str(e)
+    _remember(key, record)
+    _write(record)
+
+
+def _ensure_explainer():
+    """Start the worker in this process (threads don't survive a fork)."""
+    global _queue, _explainer, _explainer_pid
+    with _explainer_lock:
+        if _explainer_pid == os.getpid():
+            return
+        _queue = queue.Queue(QUEUE_SIZE)
+        _explainer = threading.Thread(target=_handle_queue, args=(_queue,),
+                                      name='slow-query', daemon=True)
+        _explainer_pid = os.getpid()
+        _explainer.start()
+
+
+def _handle_queue(q):
+    while True:
+        args = q.get()
+        try:
+            _handle_slow(*args)
+        except Exception as e:
+            logger.error(f'Slow query log failed: {e}')
+        finally:
+            q.task_done()
+
+
+def _submit(*args):
+    """Queue _handle_slow for the worker (never blocks the driver)."""
+    _ensure_explainer()
+    try:
+        _queue.put_nowait(args)
+    except queue.Full:
+        slow_dropped.inc()
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """Times every command; hands the slow, explainable ones off."""
+    def started(self, event):
+        if event.command_name in EXPLAINABLE:
+            _pending[(event.connection_id, event.request_id)] = (
+                event.database_name, event.command)
+
+    def succeeded(self, event):
+        name = event.command_name
+        started = _pending.pop((event.connection_id, event.request_id),
+                               None)
+        collection = started[1].get(name, '') if started else ''
+        seconds = event.duration_micros / 1e6
+        command_duration.observe(seconds, name, str(collection))
+        if started is None or seconds * 1000 < SLOW_QUERY_MS:
+            return
+        slow_commands.inc(name, str(collection))
+        _submit(started[0], name, started[1], seconds * 1000)
+
+    def failed(self, event):
+        _pending.pop((event.connection_id, event.request_id), None)
+        command_duration.observe(event.duration_micros / 1e6,
+                                 event.command_name, '')
+
+
+listener = SlowQueryListener()
+
+
+def top(n: int = 10, sort: str = TOTAL_MS) -> list:
+    """The n slowest query shapes, ordered by sort (see SORT_KEYS)."""
+    if sort not in SORT_KEYS:
+        raise ValueError(f'sort must be one of {SORT_KEYS}')
+    if not isinstance(n, int) or n < 1:
+        raise ValueError('n must be a positive integer')
+    with _shapes_lock:
+        entries = [dict(entry) for entry in _shapes.values()
+                   if entry[COUNT]]
+    for entry in entries:
+        entry.pop(EXPLAINED_AT, None)
+        entry['avg_ms'] = round(entry[TOTAL_MS] / entry[COUNT], 3)
+        entry[TOTAL_MS] = round(entry[TOTAL_MS], 3)
+    entries.sort(key=lambda e: e[sort], reverse=True)
+    return entries[:n]
+
+
+def reset():
+    with _shapes_lock:
+        _shapes.clear()
+
+
+def flush():
+    """Wait for queued explains to finish (tests, shutdown)."""
+    if _explainer_pid == os.getpid():
+        _queue.join()
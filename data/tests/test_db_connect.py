@@ -1,3 +1,6 @@
+import pytest
+from bson import ObjectId
+
 import data.db_connect as dbc
 
 VALID_ID = '1' * dbc.MIN_ID_LEN
@@ -14,3 +17,569 @@ def test_is_not_valid_id():
 
 def test_is_not_valid_id_bad_type():
     assert not dbc.is_valid_id(17)
+
+
+def test_cursor_round_trip():
+    oid = ObjectId()
+    cursor = dbc.encode_cursor('name', False, 'Albany', oid)
+    assert dbc.decode_cursor(cursor, 'name', False) == ('Albany', oid)
+
+
+def test_decode_cursor_garbage():
+    with pytest.raises(ValueError, match='Invalid cursor'):
+        dbc.decode_cursor('not a cursor', 'name', False)
+
+
+def test_decode_cursor_other_sort():
+    cursor = dbc.encode_cursor('name', False, 'Albany', ObjectId())
+    with pytest.raises(ValueError, match='does not match'):
+        dbc.decode_cursor(cursor, 'name', True)
+
+
+def test_keyset_filter_desc_includes_nulls():
+    oid = ObjectId()
+    filt = dbc._keyset_filter('name', 'M', oid, desc=True)
+    assert {'name': None} in filt['$or']
+    assert {'name': {'$lt': 'M'}} in filt['$or']
+
+
+class _FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def close(self):
+        self.closed = True
+
+
+def test_iter_docs_converts_ids_and_closes():
+    oid = ObjectId()
+    cursor = _FakeCursor([{dbc.MONGO_ID: oid, 'name': 'x'}])
+    docs = list(dbc._iter_docs(cursor))
+    assert docs == [{dbc.MONGO_ID: str(oid), 'name': 'x'}]
+    assert cursor.closed
+
+
+def test_batches():
+    chunks = list(dbc._batches(list(range(5)), 2))
+    assert chunks == [(0, [0, 1]), (2, [2, 3]), (4, [4])]
+
+
+def test_write_errors_offsets_index():
+    exc = dbc.pm.errors.BulkWriteError({
+        'writeErrors': [{'index': 1, 'code': 11000, 'errmsg': 'dup'}],
+    })
+    errs = dbc._write_errors(exc, 100)
+    assert errs == [{dbc.BULK_INDEX: 101, dbc.BULK_CODE: 11000,
+                     dbc.BULK_MESSAGE: 'dup'}]
+
+
+def test_register_index(monkeypatch):
+    monkeypatch.setattr(dbc, 'index_registry', {})
+    dbc.register_index('coll', [('a', 1)], 'a_1', unique=True)
+    spec = dbc.index_registry[(dbc.GEO_DB, 'coll')]['a_1']
+    assert spec == {'keys': [('a', 1)], 'unique': True, 'collation': None}
+
+
+def test_same_index():
+    spec = {'keys': [('a', 1)], 'unique': False,
+            'collation': dbc.CASE_INSENSITIVE}
+    info = {'key': [('a', 1)],
+            'collation': {**dbc.CASE_INSENSITIVE, 'caseLevel': False}}
+    assert dbc._same_index(spec, info)
+    assert not dbc._same_index(spec, {**info, 'unique': True})
+    assert not dbc._same_index(spec, {'key': [('a', 1)]})
+
+
+def test_query_modules_register_indexes():
+    import cities.queries as cqry
+    import states.queries as sqry
+    city_idx = dbc.index_registry[(dbc.GEO_DB, cqry.CITY_COLLECTION)]
+    assert 'name_state_code' in city_idx
+    state_idx = dbc.index_registry[(dbc.GEO_DB, sqry.STATE_COLLECTION)]
+    assert state_idx['code_country_code']['unique']
+
+
+@pytest.fixture
+def closed_circuit(monkeypatch):
+    """A fake connected client with a fresh, closed circuit breaker."""
+    monkeypatch.setattr(dbc, 'client', object())
+    monkeypatch.setattr(dbc, '_failures', 0)
+    monkeypatch.setattr(dbc, '_opened_at', None)
+
+
+def test_needs_db_opens_circuit(closed_circuit):
+    @dbc.needs_db
+    def down():
+        raise dbc.pm.errors.AutoReconnect('down')
+
+    calls = []
+
+    @dbc.needs_db
+    def up():
+        calls.append(1)
+
+    for _ in range(dbc.BREAKER_FAILURES):
+        with pytest.raises(ConnectionError):
+            down()
+    assert not dbc.is_db_up()
+    with pytest.raises(ConnectionError, match='unavailable'):
+        up()
+    assert calls == []
+
+
+class FakeCursor:
+    """A find() cursor whose batches fail while `down` is set."""
+    def __init__(self, docs, down=False):
+        self.docs, self.down = docs, down
+
+    def __iter__(self):
+        if self.down:
+            raise dbc.pm.errors.ServerSelectionTimeoutError('no server')
+        return iter(self.docs)
+
+    def close(self):
+        pass
+
+
+class FakeCollection:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def find(self, *args, **kwargs):
+        return self.cursor
+
+    def find_one(self, *args, **kwargs):
+        return next(iter(self.cursor), None)
+
+
+def test_find_failure_reaches_breaker(closed_circuit, monkeypatch):
+    """Failures while iterating find() count, and become ConnectionError."""
+    cursor = FakeCursor([{'name': 'a'}], down=True)
+    monkeypatch.setattr(dbc, 'client',
+                        {dbc.GEO_DB: {'coll': FakeCollection(cursor)}})
+    docs = dbc.find('coll')
+    assert dbc._failures == 0  # nothing sent until iterated
+    with pytest.raises(ConnectionError):
+        list(docs)
+    assert dbc._failures == 1
+    with pytest.raises(ConnectionError):
+        dbc.read('coll')
+    assert dbc._failures == 2
+    cursor.down = False
+    assert dbc.read('coll') == [{'name': 'a'}]
+    assert dbc._failures == 0
+
+
+def test_reads_return_str_ids(closed_circuit, monkeypatch):
+    oid = ObjectId()
+    cursor = FakeCursor([{dbc.MONGO_ID: oid, 'name': 'a'}])
+    monkeypatch.setattr(dbc, 'client',
+                        {dbc.GEO_DB: {'coll': FakeCollection(cursor)}})
+    assert dbc.read_one('coll', {})[dbc.MONGO_ID] == str(oid)
+    cursor.docs = [{dbc.MONGO_ID: oid, 'name': 'a'}]
+    assert next(dbc.find('coll', no_id=False))[dbc.MONGO_ID] == str(oid)
+
+
+def test_circuit_half_open_trial_closes(closed_circuit, monkeypatch):
+    dbc._record_failure(force_open=True)
+    monkeypatch.setattr(dbc, 'BREAKER_RESET_SECONDS', 0)
+
+    @dbc.needs_db
+    def up():
+        return 'ok'
+
+    assert up() == 'ok'
+    assert dbc.is_db_up()
+
+
+def test_pool_options(monkeypatch):
+    for env_var in dbc.POOL_ENV_OPTIONS:
+        monkeypatch.delenv(env_var, raising=False)
+    assert dbc.pool_options() == {}
+    monkeypatch.setenv('DB_MAX_POOL_SIZE', '20')
+    monkeypatch.setenv('DB_COMPRESSORS', 'zstd,zlib')
+    assert dbc.pool_options() == {'maxPoolSize': 20,
+                                  'compressors': 'zstd,zlib'}
+
+
+def test_reset_after_fork_drops_client(monkeypatch):
+    monkeypatch.setattr(dbc, 'client', object())
+    monkeypatch.setattr(dbc, '_client_pid', 1)
+    monkeypatch.setattr(dbc, 'CONNECT_AFTER_FORK', False)
+    monkeypatch.setattr(dbc.pool_open, '_values', {(): 4})
+    monkeypatch.setattr(dbc.pool_in_use, '_values', {(): 2})
+    held = dbc._query_cache_lock
+    monkeypatch.setattr(dbc, '_query_cache_lock', held)
+    held.acquire()  # as if another parent thread held it at fork time
+    try:
+        dbc._reset_after_fork()
+    finally:
+        held.release()
+    assert dbc.client is None
+    assert dbc.is_db_up()
+    assert dbc._query_cache_lock is not held
+    assert not dbc._query_cache_lock.locked()
+    assert dbc.pool_open.value() == 0
+    assert dbc.pool_in_use.value() == 0
+
+
+def test_apply_change_dispatches(monkeypatch):
+    monkeypatch.setattr(dbc, 'change_handlers', {})
+    seen = []
+    dbc.subscribe_changes('coll', lambda *args: seen.append(args))
+    oid = ObjectId()
+    ns = {'db': dbc.GEO_DB, 'coll': 'coll'}
+    dbc._apply_change({'operationType': 'insert', 'ns': ns,
+                       'documentKey': {dbc.MONGO_ID: oid},
+                       'fullDocument': {dbc.MONGO_ID: oid, 'a': 1}})
+    dbc._apply_change({'operationType': 'delete', 'ns': ns,
+                       'documentKey': {dbc.MONGO_ID: oid}})
+    dbc._apply_change({'operationType': 'drop', 'ns': ns})
+    dbc._apply_change({'operationType': 'insert',
+                       'ns': {'db': dbc.GEO_DB, 'coll': 'other'},
+                       'documentKey': {dbc.MONGO_ID: oid},
+                       'fullDocument': {'a': 2}})
+    assert seen == [
+        (dbc.CHANGE_INSERT, str(oid), {'a': 1}),
+        (dbc.CHANGE_DELETE, str(oid), None),
+        (dbc.CHANGE_RELOAD, None, None),
+    ]
+
+
+class LiveThread:
+    def is_alive(self):
+        return True
+
+
+def test_shared_version_follows_version_docs(monkeypatch):
+    monkeypatch.setattr(dbc, 'change_handlers', {})
+    monkeypatch.setattr(dbc, '_seen_versions', {})
+    monkeypatch.setattr(dbc, '_sync_thread', None)
+    seen = []
+    dbc.subscribe_changes('coll', lambda *args: seen.append(args))
+    assert dbc.shared_version('coll') is None  # no sync, no shared view
+    monkeypatch.setattr(dbc, '_sync_thread', LiveThread())
+    assert dbc.shared_version('coll') == 0
+    ns = {'db': dbc.GEO_DB, 'coll': dbc.VERSION_COLLECTION}
+    for v in (2, 1):  # never moves backwards
+        dbc._apply_change({'operationType': 'update', 'ns': ns,
+                           'documentKey': {dbc.MONGO_ID: 'coll'},
+                           'fullDocument': {dbc.MONGO_ID: 'coll', 'v': v}})
+    assert dbc.shared_version('coll') == 2
+    assert seen == []
+    dbc._saw_own_write(dbc.GEO_DB, 'coll', 3)
+    assert dbc.shared_version('coll') == 3
+    dbc._saw_own_write(dbc.GEO_DB, 'coll', 5)  # someone else wrote 4
+    assert dbc.shared_version('coll') == 3
+    assert {'ns.db': dbc.GEO_DB, 'ns.coll': dbc.VERSION_COLLECTION} in \
+        dbc._watch_pipeline()[0]['$match']['$or']
+
+
+@pytest.fixture
+def versions(monkeypatch):
+    """A synced process with no handlers and nothing seen yet."""
+    monkeypatch.setattr(dbc, 'change_handlers', {})
+    monkeypatch.setattr(dbc, '_seen_versions', {})
+    monkeypatch.setattr(dbc, '_sync_thread', LiveThread())
+    monkeypatch.setattr(dbc, '_sync_stop', dbc.threading.Event())
+    return dbc._seen_versions
+
+
+def _reads(monkeypatch, *results):
+    """Version reads returning results in turn, then stopping the sync."""
+    results = iter(results)
+
+    def read():
+        ret = next(results, None)
+        if ret is None:
+            dbc._sync_stop.set()
+            return {}
+        return {(dbc.GEO_DB, 'coll'): ret}
+    monkeypatch.setattr(dbc, '_read_versions_quietly', read)
+
+
+def _version_at_reload() -> list:
+    during = []
+    dbc.subscribe_changes(
+        'coll', lambda *args: during.append(dbc.shared_version('coll')))
+    return during
+
+
+def test_poll_moves_version_after_reload(versions, monkeypatch):
+    """No response gets the new version while the cache is still old."""
+    during = _version_at_reload()
+    _reads(monkeypatch, 1, 2)
+    monkeypatch.setattr(dbc, 'SYNC_POLL_SECONDS', 0)
+    dbc._poll_versions()
+    assert during == [1]
+    assert dbc.shared_version('coll') == 2
+
+
+def test_lost_stream_moves_versions_after_reload(versions, monkeypatch):
+    during = _version_at_reload()
+    _reads(monkeypatch, 3, 4)
+
+    class LostClient:
+        def watch(self, *args, **kwargs):
+            if during:
+                dbc._sync_stop.set()
+                raise dbc.pm.errors.PyMongoError('stopped')
+            raise dbc.pm.errors.OperationFailure(
+                'history lost', code=dbc.CHANGE_STREAM_HISTORY_LOST)
+    monkeypatch.setattr(dbc, 'client', LostClient())
+    dbc._watch_changes()
+    assert during == [3]
+    assert dbc.shared_version('coll') == 4
+
+
+def test_own_write_version_waits_for_cache_patch(versions):
+    @dbc.patches_cache
+    def write():
+        dbc._note_own_write(dbc.GEO_DB, 'coll', 1)
+        inner()
+        assert dbc.shared_version('coll') == 0  # cache not patched yet
+        return 'id'
+
+    @dbc.patches_cache
+    def inner():
+        dbc._note_own_write(dbc.GEO_DB, 'coll', 2)
+    assert write() == 'id'
+    assert dbc.shared_version('coll') == 2
+
+
+def test_own_write_version_dropped_if_patch_fails(versions):
+    @dbc.patches_cache
+    def write():
+        dbc._note_own_write(dbc.GEO_DB, 'coll', 1)
+        raise ValueError('patch failed')
+    with pytest.raises(ValueError):
+        write()
+    assert dbc.shared_version('coll') == 0
+    dbc._note_own_write(dbc.GEO_DB, 'coll', 1)  # outside: taken at once
+    assert dbc.shared_version('coll') == 1
+
+
+def test_async_own_write_version_waits_for_cache_patch(versions):
+    import asyncio
+
+    @dbc.patches_cache
+    async def write():
+        dbc._note_own_write(dbc.GEO_DB, 'coll', 1)
+        await asyncio.sleep(0)
+        assert dbc.shared_version('coll') == 0
+    asyncio.run(write())
+    assert dbc.shared_version('coll') == 1
+
+
+def test_write_hooks_run_before_version_bump(monkeypatch):
+    calls = []
+    monkeypatch.setattr(dbc, 'write_hooks',
+                        [lambda db, coll: calls.append('hook')])
+    monkeypatch.setattr(dbc, '_bump_version',
+                        lambda db, coll: calls.append('bump'))
+    dbc._after_write(dbc.GEO_DB, 'coll')
+    assert calls == ['hook', 'bump']
+
+
+def test_no_version_bump_without_cache_sync(monkeypatch):
+    """With sync off nobody reads the counter: no extra round trip."""
+    monkeypatch.setattr(dbc, 'client', object())  # any use would fail
+    monkeypatch.setattr(dbc, 'CACHE_SYNC', dbc.SYNC_OFF)
+    monkeypatch.setattr(dbc, '_sync_mode', None)
+    dbc._bump_version(dbc.GEO_DB, 'coll')
+    monkeypatch.setattr(dbc, 'CACHE_SYNC', dbc.SYNC_POLL)
+    with pytest.raises(TypeError):
+        dbc._bump_version(dbc.GEO_DB, 'coll')
+
+
+def test_update_without_full_document_is_delete(monkeypatch):
+    monkeypatch.setattr(dbc, 'change_handlers', {})
+    seen = []
+    dbc.subscribe_changes('coll', lambda *args: seen.append(args[0]))
+    dbc._apply_change({'operationType': 'update',
+                       'ns': {'db': dbc.GEO_DB, 'coll': 'coll'},
+                       'documentKey': {dbc.MONGO_ID: ObjectId()},
+                       'fullDocument': None})
+    assert seen == [dbc.CHANGE_DELETE]
+
+
+def test_write_hooks_errors_are_contained(monkeypatch):
+    def bad_hook(db, collection):
+        raise RuntimeError('boom')
+    monkeypatch.setattr(dbc, 'write_hooks', [bad_hook])
+    dbc._after_write(dbc.GEO_DB, 'coll')
+
+
+def test_bulk_insert_bookkeeping():
+    def validate(doc):
+        if 'name' not in doc:
+            raise ValueError('no name')
+
+    docs = [{'name': 'a'}, {}, {'name': 'b'}, {'name': 'c'}]
+    to_send, positions, errors = dbc._prepare_inserts(docs, validate)
+    assert positions == [0, 2, 3]
+    assert [err[dbc.BULK_INDEX] for err in errors] == [1]
+    for doc in to_send:
+        doc[dbc.MONGO_ID] = ObjectId()
+    assert '_id' not in docs[0]
+    exc = dbc.pm.errors.BulkWriteError({'writeErrors': [
+        {'index': 1, 'code': 11000, 'errmsg': 'dup'}]})
+    ids = [None] * len(docs)
+    dbc._inserted(to_send, 0, positions, ids, errors, exc)
+    assert ids[0] and ids[3] and ids[1] is None and ids[2] is None
+    assert errors[-1] == {dbc.BULK_INDEX: 2, dbc.BULK_CODE: 11000,
+                          dbc.BULK_MESSAGE: 'dup'}
+
+
+def test_ids_filter_dedupes_and_drops_invalid():
+    oid = ObjectId()
+    filt = dbc.ids_filter([str(oid), 'nope', str(oid)])
+    assert filt == {dbc.MONGO_ID: {'$in': [oid]}}
+    assert dbc.ids_filter(['nope']) is None
+
+
+@pytest.fixture
+def query_cache(monkeypatch):
+    """An empty query cache with fresh counters."""
+    monkeypatch.setattr(dbc, '_query_cache', dbc.OrderedDict())
+    monkeypatch.setattr(dbc, '_query_cache_bytes', 0)
+    monkeypatch.setattr(dbc, 'query_cache_counters', {
+        'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0})
+    monkeypatch.setattr(dbc, 'QUERY_CACHE_ENTRIES', 2)
+    return dbc
+
+
+def _loader(calls, result):
+    def load():
+        calls.append(1)
+        return result
+    return load
+
+
+def test_query_cache_hit_and_copy(query_cache):
+    calls = []
+    first = dbc._cached('db', 'c', ('q',), _loader(calls, [{'a': 1}]))
+    first[0]['a'] = 'mutated'
+    second = dbc._cached('db', 'c', ('q',), _loader(calls, [{'a': 1}]))
+    assert second == [{'a': 1}]
+    assert len(calls) == 1
+    info = dbc.query_cache_info()
+    assert (info['hits'], info['misses'], info['entries']) == (1, 1, 1)
+
+
+def test_query_cache_write_invalidates(query_cache):
+    calls = []
+    dbc._cached('db', 'c', ('q',), _loader(calls, [{'a': 1}]))
+    dbc._cached('db', 'other', ('q',), _loader(calls, [{'a': 1}]))
+    version = dbc.collection_version('c', db='db')
+    dbc._after_write('db', 'c')
+    assert dbc.collection_version('c', db='db') == version + 1
+    dbc._cached('db', 'c', ('q',), _loader(calls, [{'a': 1}]))
+    dbc._cached('db', 'other', ('q',), _loader(calls, [{'a': 1}]))
+    assert len(calls) == 3
+    assert dbc.query_cache_info()['invalidations'] == 1
+
+
+def test_query_cache_lru_eviction(query_cache):
+    calls = []
+    for q in ('q1', 'q2', 'q1', 'q3'):
+        dbc._cached('db', 'c', (q,), _loader(calls, [{'q': q}]))
+    info = dbc.query_cache_info()
+    assert info['entries'] == 2 and info['evictions'] == 1
+    # q1 was used more recently than q2, so q2 was evicted
+    dbc._cached('db', 'c', ('q1',), _loader(calls, []))
+    assert len(calls) == 3
+
+
+def test_query_cache_ttl(query_cache, monkeypatch):
+    monkeypatch.setattr(dbc, 'QUERY_CACHE_TTL', 0)
+    calls = []
+    dbc._cached('db', 'c', ('q',), _loader(calls, 5))
+    dbc._cached('db', 'c', ('q',), _loader(calls, 5))
+    assert len(calls) == 2
+
+
+def test_count_estimated_or_filtered(query_cache, monkeypatch):
+    calls = []
+    monkeypatch.setattr(dbc, '_estimated_count',
+                        lambda coll, db: calls.append('est') or 10)
+    monkeypatch.setattr(dbc, '_count_documents',
+                        lambda coll, filt, db: calls.append(filt) or 3)
+    assert dbc.count('c', db='db') == 10
+    assert dbc.count('c', {'code': 'NY'}, db='db') == 3
+    assert dbc.count('c', db='db') == 10
+    assert dbc.count('c', {'code': 'NY'}, db='db') == 3
+    assert calls == ['est', {'code': 'NY'}]
+    dbc._after_write('db', 'c')
+    dbc.count('c', db='db')
+    assert calls[-1] == 'est'
+
+
+def test_count_by_cached_copy(query_cache, monkeypatch):
+    pipelines = []
+
+    def group_counts(coll, pipeline, db):
+        pipelines.append(pipeline)
+        return {'NY': 2, None: 1}
+
+    monkeypatch.setattr(dbc, '_group_counts', group_counts)
+    first = dbc.count_by('c', 'state_code', {'x': 1}, db='db')
+    first['NY'] = 99
+    assert dbc.count_by('c', 'state_code', {'x': 1}, db='db') == {
+        'NY': 2, None: 1}
+    assert pipelines == [[{'$match': {'x': 1}},
+                          {'$group': {'_id': '$state_code',
+                                      'n': {'$sum': 1}}}]]
+
+
+@pytest.mark.parametrize('field', ['', '$code', None])
+def test_count_by_bad_field(field):
+    with pytest.raises(ValueError):
+        dbc.count_by('c', field)
+
+
+def test_canon_ignores_key_order():
+    assert dbc._canon({'a': 1, 'b': 2}) == dbc._canon({'b': 2, 'a': 1})
+
+
+def test_upsert_many_skips_invalid_docs(monkeypatch):
+    """Bad docs are reported by input index; the rest are still sent."""
+    def validate(doc):
+        if 'code' not in doc:
+            raise ValueError('no code')
+
+    def bulk_write(coll, requests, **kw):
+        assert len(requests) == 2
+        return {dbc.BULK_ERRORS: [{dbc.BULK_INDEX: 1, dbc.BULK_CODE: 11000,
+                                   dbc.BULK_MESSAGE: 'dup'}],
+                dbc.BULK_UPSERTED_IDS: {0: 'new'}}
+    monkeypatch.setattr(dbc, 'bulk_write', bulk_write)
+    ret = dbc.upsert_many('states', [{}, {'code': 'NY'}, {'code': 'CA'}],
+                          ('code',), validate=validate)
+    assert [err[dbc.BULK_INDEX] for err in ret[dbc.BULK_ERRORS]] == [0, 2]
+    assert ret[dbc.BULK_ERRORS][0][dbc.BULK_MESSAGE] == 'no code'
+    assert ret[dbc.BULK_UPSERTED_IDS] == {1: 'new'}
+
+
+def test_upsert_many_unsets_cleared_fields(monkeypatch):
+    sent = []
+
+    def bulk_write(coll, requests, **kw):
+        sent.extend(requests)
+        return {dbc.BULK_ERRORS: [], dbc.BULK_UPSERTED_IDS: {}}
+    monkeypatch.setattr(dbc, 'bulk_write', bulk_write)
+    docs = [{'code': 'NY', 'location': 1}, {'code': 'XX'}]
+    dbc.upsert_many('states', docs, ('code',), clear=('location', 'lat'))
+    assert sent == [
+        dbc.pm.UpdateOne({'code': 'NY'},
+                         {'$set': docs[0], '$unset': {'lat': ''}},
+                         upsert=True),
+        dbc.pm.UpdateOne({'code': 'XX'},
+                         {'$set': docs[1],
+                          '$unset': {'location': '', 'lat': ''}},
+                         upsert=True),
+    ]
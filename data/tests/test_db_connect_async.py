@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+import data.db_connect as dbc
+import data.db_connect_async as adbc
+
+
+class FakeAsyncClient:
+    built = []
+
+    def __init__(self, uri, **opts):
+        self.built.append(self)
+        self.admin = self
+        self.closed = False
+
+    async def command(self, name):
+        await asyncio.sleep(0)  # let the other callers in
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    monkeypatch.setattr(adbc, 'client', None)
+    monkeypatch.setattr(adbc, '_connect_lock', asyncio.Lock())
+    monkeypatch.setattr(adbc.pm, 'AsyncMongoClient', FakeAsyncClient)
+    monkeypatch.setattr(FakeAsyncClient, 'built', [])
+    monkeypatch.setattr(dbc, 'client_settings', lambda: ('uri', {}))
+    return FakeAsyncClient
+
+
+def test_concurrent_connects_build_one_client(fake_client):
+    async def connect_many():
+        return await asyncio.gather(*(adbc.connect_db() for _ in range(5)))
+    clients = asyncio.run(connect_many())
+    assert len(fake_client.built) == 1
+    assert all(c is fake_client.built[0] for c in clients)
+
+
+class FakeVersions:
+    def __init__(self):
+        self.calls = 0
+
+    def __getitem__(self, name):
+        return self
+
+    async def find_one_and_update(self, *args, **kwargs):
+        self.calls += 1
+        return {'v': self.calls}
+
+
+def test_after_write_bumps_through_async_client(monkeypatch):
+    """Hooks run first; the version bump never goes through dbc.client."""
+    calls = []
+    versions = FakeVersions()
+    monkeypatch.setattr(adbc, 'client', versions)
+    monkeypatch.setattr(dbc, 'client', object())  # any use would fail
+    monkeypatch.setattr(dbc, 'CACHE_SYNC', dbc.SYNC_POLL)
+    monkeypatch.setattr(dbc, 'write_hooks',
+                        [lambda db, coll: calls.append(versions.calls)])
+    monkeypatch.setattr(dbc, '_seen_versions', {})
+    asyncio.run(adbc._after_write(dbc.GEO_DB, 'coll'))
+    assert calls == [0]
+    assert versions.calls == 1
+    assert dbc._seen_versions == {(dbc.GEO_DB, 'coll'): 1}
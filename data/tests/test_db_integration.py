@@ -34,3 +34,48 @@ def test_connect_and_basic_ops():
     assert deleted.deleted_count == 1
     # Emit a clear success message for manual runs
     print('successful')
+
+
+def test_ensure_indexes_is_idempotent():
+    """Registered indexes exist after connect and a second run is a no-op."""
+    from data import db_connect as dbc
+    import cities.queries  # noqa: F401
+
+    dbc.connect_db()
+    dbc.ensure_indexes()
+    report = dbc.ensure_indexes()
+    for coll_report in report.values():
+        assert coll_report[dbc.IDX_CREATED] == []
+    for coll_report in dbc.index_report().values():
+        assert coll_report[dbc.IDX_MISSING] == []
+
+
+def test_change_stream_updates_other_process_cache():
+    """
+    A write made through a separate client reaches the cities cache via
+    the change stream. Needs a replica set, e.g. a single node started
+    with `mongod --replSet rs0` and `rs.initiate()` run once.
+    """
+    import time
+    import pymongo as pm
+    from data import db_connect as dbc
+    import cities.queries as cqry
+
+    dbc.connect_db()
+    dbc.start_cache_sync(dbc.SYNC_STREAM)
+    cqry.read()  # load the cache
+    time.sleep(1)  # let the stream open
+
+    other = pm.MongoClient(os.environ.get('MONGO_URI',
+                                          'mongodb://localhost:27017'))
+    coll = other[dbc.GEO_DB][cqry.CITY_COLLECTION]
+    new_id = str(coll.insert_one({cqry.NAME: 'Elsewhere'}).inserted_id)
+    try:
+        for _ in range(50):
+            if new_id in cqry.city_cache:
+                break
+            time.sleep(0.1)
+        assert cqry.city_cache[new_id][cqry.NAME] == 'Elsewhere'
+    finally:
+        coll.delete_one({'_id': dbc.ObjectId(new_id)})
+        other.close()
@@ -0,0 +1,53 @@
+import pytest
+
+import data.geo as geo
+
+
+def test_point_is_lon_lat():
+    assert geo.point('40.7', -74) == {'type': 'Point',
+                                      'coordinates': [-74.0, 40.7]}
+    assert geo.lat_lon(geo.point(40.7, -74)) == (40.7, -74.0)
+
+
+@pytest.mark.parametrize('lat, lon', [(91, 0), (0, -181), ('x', 0),
+                                      (None, 0)])
+def test_bad_coordinates(lat, lon):
+    with pytest.raises(ValueError):
+        geo.point(lat, lon)
+
+
+def test_near_filter_meters():
+    filt = geo.near_filter(1, 2, max_km=1.5)
+    assert filt['$near']['$maxDistance'] == 1500
+    assert '$maxDistance' not in geo.near_filter(1, 2)['$near']
+    with pytest.raises(ValueError):
+        geo.near_filter(1, 2, max_km=-1)
+
+
+def test_radius_filter_radians():
+    filt = geo.radius_filter(10, 20, geo.EARTH_RADIUS_KM)
+    assert filt == {'$geoWithin': {'$centerSphere': [[20.0, 10.0], 1.0]}}
+
+
+def test_box_is_closed_polygon():
+    filt = geo.box_filter(1, 2, 3, 4)
+    ring = filt['$geoWithin']['$geometry']['coordinates'][0]
+    assert ring == [[2, 1], [4, 1], [4, 3], [2, 3], [2, 1]]
+    with pytest.raises(ValueError):
+        geo.box_filter(3, 2, 1, 4)
+
+
+def test_polygon_needs_three_points():
+    with pytest.raises(ValueError):
+        geo.polygon_filter([(0, 0), (1, 1)])
+    with pytest.raises(ValueError):
+        geo.polygon_filter([(0, 0), (1, 1), (0, 0)])
+    with pytest.raises(ValueError):
+        geo.polygon_filter([(0, 0), (1,), (2, 2)])
+
+
+def test_haversine_km():
+    # New York to Los Angeles is about 3936 km
+    assert geo.haversine_km(40.7128, -74.0060, 34.0522, -118.2437) == (
+        pytest.approx(3936, rel=0.01))
+    assert geo.haversine_km(10, 10, 10, 10) == 0
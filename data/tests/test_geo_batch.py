@@ -0,0 +1,41 @@
+import pytest
+
+import data.geo as geo
+import data.geo_batch as gb
+
+CENTROIDS = [('NY', 43.0, -75.0), ('CA', 37.0, -120.0), ('FL', 28.0, -82.0)]
+POINTS = [[40.7, -74.0], [34.0, -118.2]]
+
+
+@pytest.fixture
+def cols():
+    return gb.Columns(CENTROIDS)
+
+
+def test_distance_matrix(cols):
+    km = gb.distance_matrix(cols, POINTS)
+    assert len(km) == 2 and len(km[0]) == 3
+    for row, (lat, lon) in zip(km, POINTS):
+        for dist, (_, s_lat, s_lon) in zip(row, CENTROIDS):
+            assert dist == pytest.approx(
+                geo.haversine_km(lat, lon, s_lat, s_lon), abs=1e-3)
+
+
+def test_within_nearest_first(cols):
+    hits = gb.within(cols, POINTS, 3000)
+    assert [i for i, _ in hits[0]] == [0, 2]
+    assert [i for i, _ in hits[1]] == [1]
+    assert hits[0][0][1] < hits[0][1][1]
+    assert gb.within(cols, POINTS, 0) == [[], []]
+
+
+@pytest.mark.parametrize('points', [[], [[1]], [[1, 'x']], [[91, 0]],
+                                    [[0, float('nan')]], 'nope'])
+def test_bad_points(cols, points):
+    with pytest.raises(ValueError):
+        gb.distance_matrix(cols, points)
+
+
+def test_bad_km(cols):
+    with pytest.raises(ValueError):
+        gb.within(cols, POINTS, -1)
@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+import data.geo as geo
+from data.kdtree import KDTree
+
+
+def brute(points: dict, lat, lon, k: int) -> list:
+    return [key for _, key in sorted(
+        (geo.haversine_km(lat, lon, *pt), key)
+        for key, pt in points.items())[:k]]
+
+
+def random_point():
+    return random.uniform(-90, 90), random.uniform(-180, 180)
+
+
+def test_matches_brute_force_through_updates():
+    random.seed(7)
+    points = {i: random_point() for i in range(300)}
+    tree = KDTree((key, *pt) for key, pt in points.items())
+    for i in range(300, 400):
+        points[i] = random_point()
+        tree.add(i, *points[i])
+    for i in range(0, 200, 3):
+        del points[i]
+        assert tree.remove(i)
+    for i in range(1, 50, 3):  # move existing points
+        points[i] = random_point()
+        tree.add(i, *points[i])
+    assert len(tree) == len(points)
+    for _ in range(100):
+        lat, lon = random_point()
+        got = tree.nearest(lat, lon, 4)
+        assert [key for key, _ in got] == brute(points, lat, lon, 4)
+
+
+def test_distance_and_antimeridian():
+    tree = KDTree([('east', 0, 179.5), ('west', 0, -170)])
+    (key, km), = tree.nearest(0, -179.9, 1)
+    assert key == 'east'
+    assert km == pytest.approx(geo.haversine_km(0, -179.9, 0, 179.5))
+
+
+def test_empty_and_missing():
+    tree = KDTree()
+    assert tree.nearest(0, 0, 3) == []
+    assert not tree.remove('x')
+    tree.add('x', 1, 1)
+    assert 'x' in tree
+    assert tree.nearest(0, 0, 3)[0][0] == 'x'
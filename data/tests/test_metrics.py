@@ -0,0 +1,66 @@
+import pytest
+
+import data.db_connect as dbc
+import data.metrics as metrics
+
+
+def test_counter_render():
+    c = metrics.counter('test_things_total', 'Things', ('kind',))
+    c.clear()
+    c.inc('a')
+    c.inc('a', amount=2)
+    c.inc('b"q')
+    assert c.value('a') == 3
+    lines = c.render()
+    assert lines[:2] == ['# HELP test_things_total Things',
+                         '# TYPE test_things_total counter']
+    assert 'test_things_total{kind="a"} 3' in lines
+    assert 'test_things_total{kind="b\\"q"} 1' in lines
+
+
+def test_register_returns_same_metric():
+    c = metrics.counter('test_same_total', 'Same')
+    assert metrics.counter('test_same_total', 'Same') is c
+    with pytest.raises(ValueError):
+        metrics.gauge('test_same_total', 'Same')
+
+
+def test_histogram_buckets_are_cumulative():
+    h = metrics.histogram('test_latency_seconds', 'Latency', ('op',),
+                          buckets=(0.1, 1.0))
+    h.clear()
+    for val in (0.05, 0.5, 5.0):
+        h.observe(val, 'x')
+    assert h.count('x') == 3
+    lines = h.render()
+    assert 'test_latency_seconds_bucket{op="x",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{op="x",le="1.0"} 2' in lines
+    assert 'test_latency_seconds_bucket{op="x",le="+Inf"} 3' in lines
+    assert 'test_latency_seconds_count{op="x"} 3' in lines
+    assert 'test_latency_seconds_sum{op="x"} 5.55' in lines
+
+
+def test_render_runs_collectors():
+    text = metrics.render()
+    assert 'db_query_cache_size{unit="entries"}' in text
+    assert text.endswith('\n')
+
+
+def test_needs_db_records_operations(monkeypatch):
+    monkeypatch.setattr(dbc, 'client', object())
+
+    @dbc.needs_db
+    def fake_op(collection):
+        return 1
+
+    before = dbc.db_operations.value('fake_op', 'coll', dbc.OP_OK)
+    assert fake_op('coll') == 1
+    assert dbc.db_operations.value('fake_op', 'coll', dbc.OP_OK) == (
+        before + 1)
+    assert dbc.db_duration.count('fake_op', 'coll') >= 1
+
+
+def test_cache_lookup_counts():
+    before = metrics.cache_requests.value('test', metrics.HIT)
+    metrics.cache_lookup('test', True)
+    assert metrics.cache_requests.value('test', metrics.HIT) == before + 1
@@ -0,0 +1,64 @@
+import pytest
+
+from data.prefix_index import PrefixIndex, normalize, normalize_prefix
+
+CITIES = [
+    (1, 'New York', 'NY'),
+    (2, 'Newark', 'NJ'),
+    (3, 'New Haven', 'CT'),
+    (4, 'Newport', 'RI'),
+    (5, 'Albany', 'NY'),
+    (6, 'São Paulo', 'SP'),
+    (7, 'New  Rochelle', 'NY'),
+]
+
+
+def test_normalize():
+    assert normalize('  São   PAULO ') == 'sao paulo'
+    assert normalize('Straße') == 'strasse'
+    assert normalize_prefix('New ') == 'new '
+    assert normalize_prefix('New') == 'new'
+    assert normalize_prefix('   ') == ''
+
+
+def test_search_in_name_order():
+    index = PrefixIndex(CITIES)
+    assert index.search('new') == [3, 7, 1, 2, 4]
+    assert index.search('NEW ') == [3, 7, 1]
+    assert index.search('new', limit=2) == [3, 7]
+    assert index.search('sao p') == [6]
+    assert index.search('newz') == []
+    assert index.search('zzz') == []
+
+
+@pytest.mark.parametrize('scope, expected', [
+    ('NY', [7, 1]),
+    ('NJ', [2]),
+    ('TX', []),
+])
+def test_scoped_search(scope, expected):
+    index = PrefixIndex(CITIES)
+    assert index.search('new', scope=scope, scoped=True) == expected
+
+
+def test_add_replace_remove():
+    index = PrefixIndex(CITIES)
+    index.add(8, 'Newcastle', 'NY')
+    assert index.search('newc', scope='NY', scoped=True) == [8]
+    index.add(8, 'Buffalo', 'NY')  # rename
+    assert index.search('newc') == []
+    assert index.search('buf') == [8]
+    index.add(2, 'Newark', 'DE')  # moves scope
+    assert index.search('new', scope='NJ', scoped=True) == []
+    assert 'NJ' not in index._scoped
+    assert index.remove(8)
+    assert not index.remove(8)
+    assert 8 not in index
+    index.add(5, None)  # no usable name: dropped
+    assert 5 not in index
+    assert len(index) == len(CITIES) - 1
+
+
+def test_empty_prefix_lists_everything():
+    index = PrefixIndex(CITIES)
+    assert index.search('', limit=100) == [5, 3, 7, 1, 2, 4, 6]
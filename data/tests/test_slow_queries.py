@@ -0,0 +1,144 @@
+import json
+import os
+import queue
+from types import SimpleNamespace
+
+import pytest
+
+import data.slow_queries as sq
+
+EXPLAIN = {
+    'queryPlanner': {'winningPlan': {
+        'stage': 'FETCH',
+        'inputStage': {'stage': 'IXSCAN', 'indexName': 'name_id_ci'},
+    }},
+    'executionStats': {'nReturned': 5, 'totalDocsExamined': 5,
+                       'totalKeysExamined': 6, 'executionTimeMillis': 1},
+}
+
+
+def test_shape_blanks_values():
+    filt = {'name': 'Ithaca', '$or': [{'a': {'$gt': 3}}, {'b': [1, 2]}]}
+    assert sq.shape(filt) == {
+        'name': '?', '$or': [{'a': {'$gt': '?'}}, {'b': ['?']}]}
+
+
+def test_summarize_plan():
+    summary = sq.summarize_plan(EXPLAIN)
+    assert summary['plan'] == 'FETCH <- IXSCAN(name_id_ci)'
+    assert not summary['collscan']
+    assert summary['docs_examined'] == 5
+    assert summary['returned'] == 5
+
+
+def test_summarize_plan_collscan_in_aggregate():
+    explain = {'stages': [{'$cursor': {
+        'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}},
+        'executionStats': {'nReturned': 1, 'totalDocsExamined': 900}}}]}
+    summary = sq.summarize_plan(explain)
+    assert summary['collscan']
+    assert summary['docs_examined'] == 900
+
+
+def _events(duration_micros, filt):
+    cmd = {'find': 'cities', 'filter': filt, 'lsid': {}, '$db': 'geo'}
+    ids = dict(connection_id=('h', 1), request_id=7)
+    return (SimpleNamespace(command_name='find', database_name='geo',
+                            command=cmd, **ids),
+            SimpleNamespace(command_name='find',
+                            duration_micros=duration_micros, **ids))
+
+
+@pytest.fixture
+def slow_log(monkeypatch, tmp_path):
+    path = tmp_path / 'slow.log'
+    monkeypatch.setattr(sq, 'SLOW_QUERY_LOG', str(path))
+    monkeypatch.setattr(sq, '_log', None)
+    monkeypatch.setattr(sq, 'SLOW_QUERY_MS', 10)
+    monkeypatch.setattr(sq, '_explain', lambda db, name, cmd: EXPLAIN)
+    sq.reset()
+    yield path
+    sq.reset()
+
+
+def test_listener_logs_slow_commands(slow_log):
+    started, succeeded = _events(50_000, {'name': 'X'})
+    sq.listener.started(started)
+    sq.listener.succeeded(succeeded)
+    sq.flush()
+    record = json.loads(slow_log.read_text().splitlines()[-1])
+    assert record['collection'] == 'cities'
+    assert record['shape'] == {'filter': {'name': '?'}}
+    assert record['plan'] == 'FETCH <- IXSCAN(name_id_ci)'
+    assert record['duration_ms'] == 50.0
+
+
+def test_listener_ignores_fast_commands(slow_log):
+    started, succeeded = _events(1_000, {'name': 'X'})
+    sq.listener.started(started)
+    sq.listener.succeeded(succeeded)
+    sq.flush()
+    assert not slow_log.exists()
+    assert sq.top() == []
+
+
+def test_top_groups_by_shape(slow_log):
+    for micros, name in ((20_000, 'A'), (40_000, 'B')):
+        started, succeeded = _events(micros, {'name': name})
+        sq.listener.started(started)
+        sq.listener.succeeded(succeeded)
+    started, succeeded = _events(30_000, {'state_code': 'NY'})
+    sq.listener.started(started)
+    sq.listener.succeeded(succeeded)
+    sq.flush()
+    top = sq.top(5)
+    assert [entry['count'] for entry in top] == [2, 1]
+    assert top[0]['total_ms'] == 60.0
+    assert top[0]['max_ms'] == 40.0
+    assert sq.top(1, sq.MAX_MS)[0]['max_ms'] == 40.0
+
+
+def _explain_counter(monkeypatch) -> list:
+    calls = []
+    monkeypatch.setattr(sq, '_explain',
+                        lambda db, name, cmd: calls.append(name) or EXPLAIN)
+    return calls
+
+
+def _run_slow(filt: dict, times: int = 1):
+    for _ in range(times):
+        started, succeeded = _events(50_000, filt)
+        sq.listener.started(started)
+        sq.listener.succeeded(succeeded)
+    sq.flush()
+
+
+def test_shape_explained_once_per_interval(slow_log, monkeypatch):
+    """Explain re-runs the query: not for every slow repeat."""
+    calls = _explain_counter(monkeypatch)
+    _run_slow({'name': 'X'}, times=3)
+    _run_slow({'state_code': 'NY'})
+    assert len(calls) == 2
+    assert sq.top(1)[0]['count'] == 3
+    assert sq.top(1)[0]['plan'] == 'FETCH <- IXSCAN(name_id_ci)'
+    assert sq.EXPLAINED_AT not in sq.top(1)[0]
+    monkeypatch.setattr(sq, 'EXPLAIN_SECONDS', 0)
+    _run_slow({'name': 'X'})
+    assert len(calls) == 3
+
+
+def test_full_queue_drops_and_counts(slow_log, monkeypatch):
+    monkeypatch.setattr(sq, '_queue', queue.Queue(1))
+    monkeypatch.setattr(sq, '_explainer_pid', os.getpid())  # no worker
+    dropped = sq.slow_dropped.value()
+    for _ in range(3):
+        started, succeeded = _events(50_000, {'name': 'X'})
+        sq.listener.started(started)
+        sq.listener.succeeded(succeeded)
+    assert sq._queue.qsize() == 1
+    assert sq.slow_dropped.value() == dropped + 2
+
+
+def test_top_rejects_bad_sort():
+    with pytest.raises(ValueError):
+        sq.top(5, 'nope')
@@ -0,0 +1,97 @@
+import json
+
+import pytest
+
+import data.tracing as tracing
+
+
+@pytest.fixture
+def sampled(monkeypatch, tmp_path):
+    monkeypatch.setattr(tracing, 'SAMPLE_RATE', 1.0)
+    monkeypatch.setattr(tracing, 'TRACE_FILE', str(tmp_path / 't.jsonl'))
+    return tmp_path / 't.jsonl'
+
+
+@tracing.traced
+def inner():
+    return 'x'
+
+
+@tracing.traced(name='outer')
+def outer():
+    return inner()
+
+
+@tracing.traced
+def fails():
+    raise ValueError('boom')
+
+
+def test_untraced_calls_make_no_spans():
+    assert tracing.current() is None
+    assert outer() == 'x'
+    assert tracing.start_trace('GET /') is None
+
+
+def test_nested_spans(sampled):
+    root = tracing.start_trace('GET /x')
+    assert tracing.current() is root
+    assert outer() == 'x'
+    with pytest.raises(ValueError):
+        fails()
+    tracing.record_span('dbc.find', root, root.start_ns)
+    tracing.end_trace(root)
+    assert tracing.current() is None
+    spans = {span.name: span for span in root.trace.spans}
+    assert spans['outer'].parent_id == root.span_id
+    assert spans[f'{__name__}.inner'].parent_id == spans['outer'].span_id
+    assert spans[f'{__name__}.fails'].error == 'ValueError: boom'
+    assert spans['dbc.find'].parent_id == root.span_id
+
+
+def test_export_writes_otlp_json(sampled):
+    root = tracing.start_trace('GET /x', attrs={'http.route': '/x'})
+    outer()
+    tracing.end_trace(root)
+    tracing.flush()
+    line = json.loads(sampled.read_text().splitlines()[-1])
+    rs = line['resourceSpans'][0]
+    assert {'key': 'service.name',
+            'value': {'stringValue': tracing.SERVICE_NAME}} in (
+        rs['resource']['attributes'])
+    spans = rs['scopeSpans'][0]['spans']
+    assert len(spans) == 3
+    assert {s['traceId'] for s in spans} == {root.trace.trace_id}
+    by_name = {s['name']: s for s in spans}
+    server = by_name['GET /x']
+    assert server['kind'] == tracing.KIND_SERVER
+    assert 'parentSpanId' not in server
+    assert int(server['endTimeUnixNano']) >= int(
+        by_name['outer']['endTimeUnixNano'])
+
+
+def test_traceparent_forces_sampling(monkeypatch):
+    monkeypatch.setattr(tracing, 'SAMPLE_RATE', 0)
+    trace_id, parent = 'a' * 32, 'b' * 16
+    root = tracing.start_trace('GET /', f'00-{trace_id}-{parent}-01')
+    try:
+        assert root.trace.trace_id == trace_id
+        assert root.parent_id == parent
+    finally:
+        tracing.end_span(root)
+    assert tracing.start_trace('GET /', f'00-{trace_id}-{parent}-00') is None
+
+
+@pytest.mark.parametrize('header', [
+    f"00-{'a' * 32}-{'b' * 16}-zz",
+    f"00-{'g' * 32}-{'b' * 16}-01",
+    f"00-{'a' * 32}-{'x' * 16}-01",
+    f"00-{'0' * 32}-{'b' * 16}-01",
+    f"ff-{'a' * 32}-{'b' * 16}-01",
+    f"00-{'a' * 32}-{'b' * 16}-1",
+    'garbage',
+])
+def test_bad_traceparent_is_ignored(monkeypatch, header):
+    monkeypatch.setattr(tracing, 'SAMPLE_RATE', 0)
+    assert tracing._parse_traceparent(header) is None
+    assert tracing.start_trace('GET /', header) is None
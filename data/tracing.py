@@ -0,0 +1,301 @@
+"""
+Lightweight request tracing. A sampled HTTP request opens a root span;
+decorated query-module functions and dbc calls add nested spans beneath
+it, timed with perf_counter_ns. When the root span ends, the whole trace
+is queued and a background thread appends it to TRACE_FILE as one line
+of OTLP/JSON (an ExportTraceServiceRequest), which OpenTelemetry
+collectors and viewers can read.
+
+Unsampled requests pay one ContextVar lookup per decorated call.
+"""
+import contextvars
+import inspect
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from functools import wraps
+
+import data.metrics as metrics
+
+SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.jsonl')
+SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'geo-api')
+QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', '1000'))
+
+SCOPE_NAME = 'data.tracing'
+
+# OTLP enum values
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+KIND_CLIENT = 3
+STATUS_ERROR = 2
+
+TRACE_HEADER = 'X-Trace-Id'
+TRACEPARENT = 'traceparent'
+
+_current = contextvars.ContextVar('current_span', default=None)
+
+_queue = None
+_writer = None
+_writer_pid = None
+
+traces_dropped = metrics.counter(
+    'trace_export_dropped_total', 'Traces dropped because the queue was full')
+
+
+class Trace:
+    """Spans of one request, plus the clock anchor for their timestamps."""
+    __slots__ = ('trace_id', 'spans', 'epoch_ns', 'perf0_ns')
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans = []
+        self.epoch_ns = time.time_ns()
+        self.perf0_ns = time.perf_counter_ns()
+
+    def unix_ns(self, perf_ns: int) -> int:
+        return self.epoch_ns + perf_ns - self.perf0_ns
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind',
+                 'start_ns', 'end_ns', 'attrs', 'error', 'token')
+
+    def __init__(self, trace, name, parent_id=None, kind=KIND_INTERNAL,
+                 attrs=None):
+        self.trace = trace
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs or {}
+        self.error = None
+        self.token = None
+        self.end_ns = None
+        self.start_ns = time.perf_counter_ns()
+
+    def set(self, key: str, value):
+        self.attrs[key] = value
+
+
+# version-trace_id-parent_id-flags, all lowercase hex
+_TRACEPARENT = re.compile(
+    r'([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})')
+
+
+def _new_id(nbytes: int) -> str:
+    return random.getrandbits(nbytes * 8).to_bytes(nbytes, 'big').hex()
+
+
+def _parse_traceparent(header: str):
+    """
+    (trace_id, parent span id) from a sampled W3C traceparent; None if
+    the header is absent, malformed or not sampled.
+    """
+    match = _TRACEPARENT.fullmatch(header or '')
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == 'ff' or not int(trace_id, 16) or not int(parent_id, 16):
+        return None
+    if not int(flags, 16) & 1:
+        return None
+    return trace_id, parent_id
+
+
+def current():
+    """The active span in this context, or None when not tracing."""
+    return _current.get()
+
+
+def start_trace(name: str, traceparent: str = None, attrs: dict = None):
+    """
+    Open a root (server) span and make it current, if this request is
+    sampled: either the caller's traceparent says so or we roll under
+    SAMPLE_RATE. Returns the span, or None.
+    """
+    parent = _parse_traceparent(traceparent)
+    if parent is None and (SAMPLE_RATE <= 0
+                           or random.random() >= SAMPLE_RATE):
+        return None
+    trace_id, parent_id = parent or (_new_id(16), None)
+    span = Span(Trace(trace_id), name, parent_id, KIND_SERVER, attrs)
+    span.token = _current.set(span)
+    return span
+
+
+def end_trace(span, error: BaseException = None):
+    """Close a root span opened by start_trace and export its trace."""
+    if span is None:
+        return
+    _finish(span, error)
+    export(span.trace)
+
+
+def start_span(name: str, attrs: dict = None, kind: int = KIND_INTERNAL):
+    """Open a child of the current span and make it current (or None)."""
+    parent = _current.get()
+    if parent is None:
+        return None
+    span = Span(parent.trace, name, parent.span_id, kind, attrs)
+    span.token = _current.set(span)
+    return span
+
+
+def end_span(span, error: BaseException = None):
+    if span is not None:
+        _finish(span, error)
+
+
+def _finish(span, error):
+    span.end_ns = time.perf_counter_ns()
+    if error is not None:
+        span.error = f'{type(error).__name__}: {error}'
+    if span.token is not None:
+        try:
+            _current.reset(span.token)
+        except ValueError:  # ended from another context
+            pass
+        span.token = None
+    span.trace.spans.append(span)
+
+
+def record_span(name: str, parent, start_ns: int, attrs: dict = None,
+                error: BaseException = None, kind: int = KIND_CLIENT):
+    """
+    Add an already finished span under `parent` without making it
+    current: for work that is interleaved with other code, like
+    iterating a cursor.
+    """
+    if parent is None:
+        return
+    span = Span(parent.trace, name, parent.span_id, kind, attrs)
+    span.start_ns = start_ns
+    _finish(span, error)
+
+
+def traced(fn=None, *, name: str = None, kind: int = KIND_INTERNAL):
+    """
+    Decorator: run fn inside a span named after it whenever the caller
+    is being traced. Works for plain and async functions.
+    """
+    if fn is None:
+        return lambda f: traced(f, name=name, kind=kind)
+    span_name = name or f'{fn.__module__}.{fn.__qualname__}'
+
+    if inspect.iscoroutinefunction(fn):
+        @wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return await fn(*args, **kwargs)
+            span = start_span(span_name, kind=kind)
+            try:
+                ret = await fn(*args, **kwargs)
+            except BaseException as e:
+                end_span(span, e)
+                raise
+            end_span(span)
+            return ret
+        return async_wrapper
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _current.get() is None:
+            return fn(*args, **kwargs)
+        span = start_span(span_name, kind=kind)
+        try:
+            ret = fn(*args, **kwargs)
+        except BaseException as e:
+            end_span(span, e)
+            raise
+        end_span(span)
+        return ret
+    return wrapper
+
+
+def _attr(key: str, value) -> dict:
+    if isinstance(value, bool):
+        val = {'boolValue': value}
+    elif isinstance(value, int):
+        val = {'intValue': str(value)}
+    elif isinstance(value, float):
+        val = {'doubleValue': value}
+    else:
+        val = {'stringValue': str(value)}
+    return {'key': key, 'value': val}
+
+
+def _otlp_span(span) -> dict:
+    trace = span.trace
+    ret = {
+        'traceId': trace.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': span.kind,
+        'startTimeUnixNano': str(trace.unix_ns(span.start_ns)),
+        'endTimeUnixNano': str(trace.unix_ns(span.end_ns)),
+        'attributes': [_attr(k, v) for k, v in span.attrs.items()],
+        'status': ({'code': STATUS_ERROR, 'message': span.error}
+                   if span.error else {}),
+    }
+    if span.parent_id:
+        ret['parentSpanId'] = span.parent_id
+    return ret
+
+
+def to_otlp(trace) -> dict:
+    """One trace as an OTLP/JSON ExportTraceServiceRequest."""
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            _attr('service.name', SERVICE_NAME),
+            _attr('process.pid', os.getpid()),
+        ]},
+        'scopeSpans': [{
+            'scope': {'name': SCOPE_NAME},
+            'spans': [_otlp_span(span) for span in trace.spans],
+        }],
+    }]}
+
+
+def export(trace):
+    """Queue a finished trace for the writer thread (never blocks)."""
+    _ensure_writer()
+    try:
+        _queue.put_nowait(trace)
+    except queue.Full:
+        traces_dropped.inc()
+
+
+def _ensure_writer():
+    """Start the writer in this process (threads don't survive a fork)."""
+    global _queue, _writer, _writer_pid
+    if _writer_pid == os.getpid():
+        return
+    _queue = queue.Queue(QUEUE_SIZE)
+    _writer = threading.Thread(target=_write_traces, args=(_queue,),
+                               name='trace-writer', daemon=True)
+    _writer_pid = os.getpid()
+    _writer.start()
+
+
+def _write_traces(q):
+    while True:
+        traces = [q.get()]
+        while not q.empty() and len(traces) < 100:
+            traces.append(q.get_nowait())
+        with open(TRACE_FILE, 'a') as f:
+            for trace in traces:
+                f.write(json.dumps(to_otlp(trace),
+                                   separators=(',', ':')) + '\n')
+        for _ in traces:
+            q.task_done()
+
+
+def flush():
+    """Wait until every queued trace has been written."""
+    if _writer_pid == os.getpid():
+        _queue.join()
@@ -0,0 +1,19 @@
+#!/bin/bash
+# ==============================================================================
+# Local Async Server - WAAP Project
+# ==============================================================================
+# Starts the ASGI app (server/asgi.py) under uvicorn. It serves the same
+# routes as the Flask app started by ./local.sh, using the async Mongo
+# driver.
+#
+# Usage:
+#   ./local_async.sh [workers]
+#
+# The server will be accessible at:
+#   http://127.0.0.1:8001
+# ==============================================================================
+
+# Run our server locally with proper Python path
+PYTHONPATH=$(pwd):$PYTHONPATH
+export PYTHONPATH
+uvicorn server.asgi:app --host 127.0.0.1 --port 8001 --workers "${1:-1}"
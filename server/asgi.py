@@ -0,0 +1,676 @@
+"""
+ASGI entry point serving the same routes as server/endpoints.py, backed
+by the async query modules (cities.async_queries, states.async_queries)
+and pymongo's AsyncMongoClient, so a slow Mongo call no longer holds a
+worker thread. Run it with e.g.
+    uvicorn server.asgi:app --workers 4
+The Flask app in server/endpoints.py is unchanged and still the default.
+"""
+import hashlib
+import json
+import time
+from contextlib import asynccontextmanager
+from functools import wraps
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import cities.async_queries as cqry
+import country.country as cntry
+import data.db_connect as dbc
+import data.db_connect_async as adbc
+import data.metrics as metrics
+import data.slow_queries as slow_queries
+import data.tracing as tracing
+import server.compress as compress
+import server.endpoints as ep
+import server.json_repr as json_repr
+import states.async_queries as sqry
+
+TRUE_VALUES = {'true', '1', 'yes', 'on'}
+FALSE_VALUES = {'false', '0', 'no', 'off', ''}
+
+
+def json_response(data, status: int = 200, headers: dict = None):
+    return Response(json_repr.dumps(data), status_code=status,
+                    headers=headers, media_type=ep.JSON_MIME)
+
+
+def error(msg, status: int = 400):
+    return json_response({ep.ERROR: str(msg)}, status)
+
+
+def _flag(args, name: str) -> bool:
+    """Parse a boolean query arg the way flask_restx inputs.boolean does."""
+    val = args.get(name, '').lower()
+    if val in TRUE_VALUES:
+        return True
+    if val in FALSE_VALUES:
+        return False
+    raise ValueError(f'Invalid literal for boolean(): {val}')
+
+
+def _limit(args, name: str = 'limit'):
+    val = args.get(name)
+    if val is None:
+        return None
+    try:
+        return int(val)
+    except ValueError:
+        raise ValueError(f'Invalid {name}: {val}') from None
+
+
+def _float(args, name: str, required: bool = True):
+    val = args.get(name)
+    if val is None:
+        if required:
+            raise ValueError(f'Missing required parameter: {name}')
+        return None
+    try:
+        return float(val)
+    except ValueError:
+        raise ValueError(f'Invalid {name}: {val}') from None
+
+
+def wants_stream(request: Request) -> bool:
+    """True if the client asked for NDJSON via ?stream=1 or Accept."""
+    if _flag(request.query_params, 'stream'):
+        return True
+    accept = parse_accept_header(request.headers.get('accept'), MIMEAccept)
+    return accept.best_match([ep.JSON_MIME, ep.NDJSON_MIME]) == ep.NDJSON_MIME
+
+
+def ndjson_response(docs):
+    """Stream an async iterable of docs as NDJSON."""
+    async def generate():
+        async for doc in docs:
+            yield json_repr.dumps(doc) + b'\n'
+    return StreamingResponse(generate(), media_type=ep.NDJSON_MIME)
+
+
+async def _aiter(docs):
+    for doc in docs:
+        yield doc
+
+
+async def payload(request: Request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise ValueError('Request body must be JSON') from None
+
+
+async def batch_payload(request: Request) -> list:
+    """Async counterpart of endpoints.batch_payload."""
+    body = await request.body()
+    if request.headers.get('content-type', '').startswith(ep.NDJSON_MIME):
+        return ep.check_batch(ep.parse_ndjson(body))
+    try:
+        recs = json.loads(body)
+    except ValueError:
+        recs = None
+    return ep.check_batch(recs)
+
+
+async def batch_create(create_many, request: Request):
+    """Shared body of the /batch views."""
+    try:
+        ret = await create_many(await batch_payload(request))
+    except ValueError as e:
+        return error(e)
+    except ConnectionError as e:
+        return error(e, 500)
+    return json_response(*ep.batch_response(ret))
+
+
+async def ids_payload(request: Request) -> list:
+    """Async counterpart of endpoints.ids_payload."""
+    try:
+        body = json.loads(await request.body())
+    except ValueError:
+        body = None
+    if isinstance(body, dict):
+        body = body.get(ep.IDS)
+    if not isinstance(body, list):
+        raise ValueError(
+            f'Body must be a JSON array or {{"{ep.IDS}": [...]}}')
+    return body
+
+
+async def fetch_many(get_many, resp_key: str, request: Request):
+    """
+    Shared body of the multi-get views: ids come from ?ids= on GET and
+    from the JSON body on POST.
+    """
+    try:
+        if request.method == 'POST':
+            ids = await ids_payload(request)
+        elif ep.IDS in request.query_params:
+            ids = ep.parse_ids(request.query_params[ep.IDS])
+        else:
+            raise ValueError(f'Missing required parameter: {ep.IDS}')
+        docs = await get_many(ids)
+    except ValueError as e:
+        return error(e)
+    except ConnectionError as e:
+        return error(e, 500)
+    return json_response(ep.many_response(resp_key, ids, docs))
+
+
+def etag_for(request: Request, version) -> str:
+    """Strong ETag for this request's URL at a data version."""
+    raw = f'{version}:{request.url.path}?{request.url.query}'
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _if_none_match(request: Request) -> set:
+    header = request.headers.get('if-none-match', '')
+    return {tag.strip().removeprefix('W/').strip('"')
+            for tag in header.split(',') if tag.strip()}
+
+
+def conditional(source):
+    """Async counterpart of endpoints.conditional."""
+    def decorator(fn):
+        @wraps(fn)
+        async def wrapper(request):
+            version = source.version()
+            if version is None:
+                return await fn(request)
+            etag = etag_for(request, version)
+            headers = {'ETag': f'"{etag}"',
+                       'Cache-Control': ep.CACHE_CONTROL}
+            # compressed copies are tagged etag + encoding suffix
+            client_tags = _if_none_match(request)
+            for variant in [''] + [compress.etag_suffix(enc)
+                                   for enc in compress.supported()]:
+                if etag + variant in client_tags:
+                    headers['ETag'] = f'"{etag}{variant}"'
+                    return Response(status_code=304, headers=headers)
+            resp = await fn(request)
+            if (resp.status_code == 200
+                    and not isinstance(resp, StreamingResponse)):
+                resp.headers.update(headers)
+            return resp
+        return wrapper
+    return decorator
+
+
+def paged_response(resp_key, page, next_cursor, total):
+    ret = {resp_key: page, ep.NEXT_CURSOR: next_cursor}
+    if total is not None:
+        ret[ep.NUM_RECS] = total
+    return json_response(ret)
+
+
+@conditional(cqry)
+async def cities_read(request: Request):
+    args = request.query_params
+    try:
+        sort = args.get('sort')
+        limit = _limit(args)
+        if limit is not None:
+            cities, next_cursor = await cqry.read_page(
+                sort, limit, args.get('cursor'))
+            total = await cqry.total() if _flag(args, 'total') else None
+            return paged_response(ep.CITY_RESP, cities, next_cursor, total)
+        if wants_stream(request):
+            return ndjson_response(cqry.stream(sort))
+        cities = await cqry.read_sorted(sort)
+    except ValueError as e:
+        return error(e)
+    except ConnectionError as e:
+        return json_response({ep.ERROR: str(e)})
+    return json_response({ep.CITY_RESP: cities, ep.NUM_RECS: len(cities)})
+
+
+async def cities_create(request: Request):
+    try:
+        new_id = await cqry.create(await payload(request))
+    except ValueError as e:
+        return error(e)
+    return json_response({'id': str(new_id)}, 201)
+
+
+async def cities_many(request: Request):
+    return await fetch_many(cqry.get_many, ep.CITY_RESP, request)
+
+
+async def cities_batch(request: Request):
+    return await batch_create(cqry.create_many, request)
+
+
+async def suggest_response(query_fn, resp: str, scope: str,
+                           request: Request):
+    """Shared body of the name-prefix views; scope is the filter param."""
+    args = request.query_params
+    try:
+        kwargs = {scope: args.get(scope)}
+        limit = _limit(args)
+        if limit is not None:
+            kwargs['limit'] = limit
+        recs = await query_fn(args.get('q'), **kwargs)
+    except ValueError as e:
+        return error(e)
+    except ConnectionError as e:
+        return error(e, 500)
+    return json_response({resp: recs, ep.NUM_RECS: len(recs)})
+
+
+async def cities_suggest(request: Request):
+    return await suggest_response(cqry.suggest, ep.CITY_RESP, 'state_code',
+                                  request)
+
+
+@conditional(cqry)
+async def city_get(request: Request):
+    try:
+        city = await cqry.get_by_id(request.path_params['city_id'])
+    except ValueError as e:
+        return error(e, 404)
+    return json_response(city)
+
+
+async def city_put(request: Request):
+    try:
+        ok = await cqry.update_by_id(request.path_params['city_id'],
+                                     await payload(request))
+    except ValueError as e:
+        return error(e)
+    if not ok:
+        return error('No changes made or city not found', 404)
+    return json_response({ep.MESSAGE: 'Updated'})
+
+
+async def city_delete(request: Request):
+    try:
+        ok = await cqry.delete_by_id(request.path_params['city_id'])
+    except ValueError as e:
+        return error(e)
+    if not ok:
+        return error('City not found', 404)
+    return json_response({ep.MESSAGE: 'Deleted'})
+
+
+@conditional(sqry)
+async def states_read(request: Request):
+    args = request.query_params
+    try:
+        limit = _limit(args)
+        if limit is not None:
+            states, next_cursor = await sqry.read_page(
+                limit=limit, cursor=args.get('cursor'))
+            total = await sqry.total() if _flag(args, 'total') else None
+            return paged_response(ep.STATE_RESP, states, next_cursor, total)
+        if wants_stream(request):
+            return ndjson_response(sqry.stream())
+        states = await sqry.read()
+    except ValueError as e:
+        return error(e)
+    except ConnectionError as e:
+        return json_response({ep.ERROR: str(e)})
+    return json_response({ep.STATE_RESP: states, ep.NUM_RECS: len(states)})
+
+
+async def states_create(request: Request):
+    try:
+        new_id = await sqry.create(await payload(request))
+    except ValueError as e:
+        return error(e)
+    return json_response({'id': str(new_id)}, 201)
+
+
+async def states_many(request: Request):
+    return await fetch_many(sqry.get_many, ep.STATE_RESP, request)
+
+
+async def geo_response(query_fn, request: Request):
+    """
+    Shared body of the spatial views: query_fn(args, limit) awaits the
+    query for the parsed query string.
+    """
+    args = request.query_params
+    try:
+        limit = _limit(args)
+        states = await query_fn(
+            args, sqry.DEFAULT_PAGE_SIZE if limit is None else limit)
+    except ValueError as e:
+        return error(e)
+    except ConnectionError as e:
+        return error(e, 500)
+    return json_response({ep.STATE_RESP: states, ep.NUM_RECS: len(states)})
+
+
+async def states_near(request: Request):
+    return await geo_response(lambda args, limit: sqry.near(
+        _float(args, 'lat'), _float(args, 'lon'),
+        max_km=_float(args, 'max_km', required=False), limit=limit),
+        request)
+
+
+async def states_distances(request: Request):
+    try:
+        points, km = ep.distances_args(await payload(request))
+        if km is not None:
+            return json_response(
+                {ep.WITHIN_KM: await sqry.distances_within(points, km)})
+        states, matrix = await sqry.distances(points)
+    except ValueError as e:
+        return error(e)
+    except ConnectionError as e:
+        return error(e, 500)
+    return json_response({ep.STATE_RESP: states, ep.DISTANCES_KM: matrix})
+
+
+async def states_nearest(request: Request):
+    args = request.query_params
+    try:
+        k = _limit(args, 'k')
+        states = await sqry.nearest(_float(args, 'lat'), _float(args, 'lon'),
+                                    k=1 if k is None else k)
+    except ValueError as e:
+        return error(e)
+    except ConnectionError as e:
+        return error(e, 500)
+    return json_response({ep.STATE_RESP: states, ep.NUM_RECS: len(states)})
+
+
+async def states_suggest(request: Request):
+    return await suggest_response(sqry.suggest, ep.STATE_RESP,
+                                  'country_code', request)
+
+
+async def states_radius(request: Request):
+    return await geo_response(lambda args, limit: sqry.within_radius(
+        _float(args, 'lat'), _float(args, 'lon'), _float(args, 'km'),
+        limit=limit), request)
+
+
+async def states_within(request: Request):
+    def query(args, limit):
+        name, coords = ep.within_args(args)
+        return getattr(sqry, name)(*coords, limit=limit)
+    return await geo_response(query, request)
+
+
+async def states_batch(request: Request):
+    return await batch_create(sqry.create_many, request)
+
+
+@conditional(sqry)
+async def state_get(request: Request):
+    try:
+        state = await sqry.get_by_id(request.path_params['state_id'])
+    except ValueError as e:
+        return error(e, 404)
+    return json_response(state)
+
+
+async def state_put(request: Request):
+    try:
+        ok = await sqry.update_by_id(request.path_params['state_id'],
+                                     await payload(request))
+    except ValueError as e:
+        return error(e)
+    if not ok:
+        return error('No changes made or state not found', 404)
+    return json_response({ep.MESSAGE: 'Updated'})
+
+
+async def state_delete(request: Request):
+    try:
+        ok = await sqry.delete_by_id(request.path_params['state_id'])
+    except ValueError as e:
+        return error(e)
+    if not ok:
+        return error('State not found', 404)
+    return json_response({ep.MESSAGE: 'Deleted'})
+
+
+async def health(request: Request):
+    try:
+        await adbc.connect_db()
+    except Exception as e:
+        return error(e, 500)
+    if not dbc.is_db_up():
+        return error('Database unavailable', 500)
+    return json_response({'status': 'ok'})
+
+
+@conditional(cntry)
+async def countries_list(request: Request):
+    args = request.query_params
+    try:
+        limit = _limit(args)
+        if limit is None and wants_stream(request):
+            return ndjson_response(_aiter(
+                {cntry.ID: cid, **rec} for cid, rec in cntry.read().items()))
+        if limit is None:
+            countries = cntry.read()
+            return json_response({ep.COUNTRY_RESP: countries,
+                                  ep.NUM_RECS: len(countries)})
+        countries, next_cursor = cntry.read_page(limit, args.get('cursor'))
+        total = len(cntry.read()) if _flag(args, 'total') else None
+    except ValueError as e:
+        return error(e)
+    return paged_response(ep.COUNTRY_RESP, countries, next_cursor, total)
+
+
+async def countries_create(request: Request):
+    try:
+        new_id = cntry.create(await payload(request))
+    except ValueError as e:
+        return error(e)
+    return json_response({'id': str(new_id)}, 201)
+
+
+@conditional(cntry)
+async def countries_read(request: Request):
+    countries = cntry.read()
+    return json_response({ep.COUNTRY_RESP: countries,
+                          ep.NUM_RECS: len(countries)})
+
+
+@conditional(cntry)
+async def country_get(request: Request):
+    try:
+        return json_response(
+            cntry.get_country_by_id(request.path_params['country_id']))
+    except ValueError as e:
+        return error(e, 404)
+
+
+async def country_put(request: Request):
+    try:
+        cntry.update(request.path_params['country_id'],
+                     await payload(request))
+    except ValueError:
+        return error('Country not found', 404)
+    return json_response({ep.MESSAGE: 'Updated'})
+
+
+async def country_delete(request: Request):
+    try:
+        cntry.delete(request.path_params['country_id'])
+    except ValueError:
+        return error('Country not found', 404)
+    return json_response({ep.MESSAGE: 'Deleted'})
+
+
+async def hello(request: Request):
+    return json_response({ep.HELLO_RESP: 'world'})
+
+
+async def endpoints(request: Request):
+    return json_response({ep.ENDPOINT_RESP: sorted(
+        {route.path for route in request.app.routes})})
+
+
+async def counts(request: Request):
+    try:
+        groups = _flag(request.query_params, 'groups')
+    except ValueError as e:
+        return error(e)
+    try:
+        ret = {
+            'cities': await cqry.num_cities(),
+            'states': await sqry.count(),
+            'countries': len(cntry.read()),
+        }
+        if groups:
+            ret[ep.CITIES_BY_STATE] = await cqry.count_by_state()
+            ret[ep.STATES_BY_COUNTRY] = await sqry.count_by_country()
+    except ConnectionError as e:
+        return error(e, 500)
+    return json_response(ret)
+
+
+async def slow_queries_view(request: Request):
+    if not ep.is_admin(request.headers):
+        return error('Forbidden', 403)
+    args = request.query_params
+    try:
+        limit = _limit(args)
+        top = slow_queries.top(10 if limit is None else limit,
+                               args.get('sort', slow_queries.TOTAL_MS))
+    except ValueError as e:
+        return error(e)
+    return json_response({ep.SLOW_QUERIES_RESP: top,
+                          'Threshold ms': slow_queries.SLOW_QUERY_MS})
+
+
+async def metrics_view(request: Request):
+    return Response(metrics.render(), media_type=metrics.TEXT_MIME)
+
+
+class MetricsMiddleware:
+    """Counts and times requests by method and matched route template."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = ['500']
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = str(message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            route = route.path if route is not None else ep.UNMATCHED
+            metrics.http_requests.inc(scope['method'], route, status[0])
+            metrics.http_duration.observe(time.perf_counter() - start,
+                                          scope['method'], route)
+
+
+class TracingMiddleware:
+    """Opens a root span per sampled request (see data/tracing.py)."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        headers = dict(scope['headers'])
+        traceparent = headers.get(tracing.TRACEPARENT.encode(), b'')
+        span = tracing.start_trace(
+            f'{scope["method"]} {scope["path"]}', traceparent.decode(),
+            {'http.request.method': scope['method'],
+             'url.path': scope['path']})
+        if span is None:
+            return await self.app(scope, receive, send)
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                span.set('http.response.status_code', message['status'])
+                message['headers'] = list(message.get('headers', [])) + [
+                    (tracing.TRACE_HEADER.lower().encode(),
+                     span.trace.trace_id.encode())]
+            await send(message)
+
+        error = None
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            route = scope.get('route')
+            if route is not None:
+                span.name = f'{scope["method"]} {route.path}'
+                span.set('http.route', route.path)
+            tracing.end_trace(span, error)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await adbc.close_db()
+
+
+CITIES = ep.CITIES_EPS
+STATES = ep.STATES_EPS
+COUNTRIES = ep.COUNTRIES_EP
+
+routes = [
+    Route(f'{CITIES}/{ep.READ}', cities_read, methods=['GET']),
+    Route(f'{CITIES}/{ep.READ}', cities_create, methods=['POST']),
+    Route(CITIES, cities_create, methods=['POST']),
+    Route(CITIES, cities_many, methods=['GET']),
+    Route(f'{CITIES}/{ep.IDS}', cities_many, methods=['POST']),
+    Route(f'{CITIES}/{ep.BATCH}', cities_batch, methods=['POST']),
+    Route(f'{CITIES}/{ep.SUGGEST}', cities_suggest, methods=['GET']),
+    Route(CITIES + '/{city_id}', city_get, methods=['GET']),
+    Route(CITIES + '/{city_id}', city_put, methods=['PUT']),
+    Route(CITIES + '/{city_id}', city_delete, methods=['DELETE']),
+    Route(f'{STATES}/{ep.READ}', states_read, methods=['GET']),
+    Route(STATES, states_create, methods=['POST']),
+    Route(STATES, states_many, methods=['GET']),
+    Route(f'{STATES}/{ep.IDS}', states_many, methods=['POST']),
+    Route(f'{STATES}/{ep.BATCH}', states_batch, methods=['POST']),
+    Route(f'{STATES}/{ep.NEAR}', states_near, methods=['GET']),
+    Route(f'{STATES}/{ep.NEAREST}', states_nearest, methods=['GET']),
+    Route(f'{STATES}/{ep.SUGGEST}', states_suggest, methods=['GET']),
+    Route(f'{STATES}/{ep.DISTANCES}', states_distances, methods=['POST']),
+    Route(f'{STATES}/{ep.RADIUS}', states_radius, methods=['GET']),
+    Route(f'{STATES}/{ep.WITHIN}', states_within, methods=['GET']),
+    Route(STATES + '/{state_id}', state_get, methods=['GET']),
+    Route(STATES + '/{state_id}', state_put, methods=['PUT']),
+    Route(STATES + '/{state_id}', state_delete, methods=['DELETE']),
+    Route('/health', health, methods=['GET']),
+    Route(COUNTRIES, countries_list, methods=['GET']),
+    Route(COUNTRIES, countries_create, methods=['POST']),
+    Route(f'{COUNTRIES}/read', countries_read, methods=['GET']),
+    Route(COUNTRIES + '/{country_id}', country_get, methods=['GET']),
+    Route(COUNTRIES + '/{country_id}', country_put, methods=['PUT']),
+    Route(COUNTRIES + '/{country_id}', country_delete, methods=['DELETE']),
+    Route(ep.HELLO_EP, hello, methods=['GET']),
+    Route(ep.ENDPOINT_EP, endpoints, methods=['GET']),
+    Route('/counts', counts, methods=['GET']),
+    Route(ep.METRICS_EP, metrics_view, methods=['GET']),
+    Route(ep.SLOW_QUERIES_EP, slow_queries_view, methods=['GET']),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[
+        Middleware(TracingMiddleware),
+        Middleware(MetricsMiddleware),
+        Middleware(CORSMiddleware, allow_origins=['*'],
+                   allow_methods=['*'], allow_headers=['*']),
+        Middleware(compress.CompressMiddleware),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,244 @@
+"""
+Response compression for the flask app (an after_request hook) and the
+ASGI app (CompressMiddleware), so both behave the same.
+Negotiates br (when the `brotli` package is installed), gzip or deflate
+from Accept-Encoding. Small bodies are left alone, streamed (chunked)
+responses are compressed on the fly, and compressed bodies of tagged
+responses are cached by (ETag, encoding) so repeat hits skip the work.
+"""
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import request
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+BR = 'br'
+GZIP = 'gzip'
+DEFLATE = 'deflate'
+
+MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', '500'))
+LEVEL = int(os.environ.get('COMPRESS_LEVEL', '6'))
+CACHE_ENTRIES = int(os.environ.get('COMPRESS_CACHE_ENTRIES', '128'))
+# Streamed responses are flushed after this much input, so clients get
+# data promptly without paying a flush per chunk.
+STREAM_FLUSH_BYTES = int(os.environ.get('COMPRESS_FLUSH_BYTES', '16384'))
+
+COMPRESSIBLE = {
+    'application/json',
+    'application/x-ndjson',
+    'application/javascript',
+    'text/html',
+    'text/css',
+    'text/plain',
+}
+
+# zlib wbits for each encoding: gzip wrapper / zlib wrapper
+_WBITS = {GZIP: 31, DEFLATE: 15}
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def supported() -> list:
+    """Encodings we can produce, in order of preference."""
+    return ([BR] if brotli is not None else []) + [GZIP, DEFLATE]
+
+
+def etag_suffix(encoding: str) -> str:
+    """Compressed representations get their own strong ETag."""
+    return f'-{encoding}'
+
+
+def choose_encoding(accept_encoding) -> str:
+    """Best encoding the client accepts, or None."""
+    best, best_q = None, 0
+    for encoding in supported():
+        q = accept_encoding[encoding]
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == BR:
+        return brotli.compress(data, quality=min(LEVEL, 11))
+    comp = zlib.compressobj(LEVEL, zlib.DEFLATED, _WBITS[encoding])
+    return comp.compress(data) + comp.flush()
+
+
+def _compressor(encoding: str):
+    """Return (compress(chunk), flush(), finish()) callables."""
+    if encoding == BR:
+        comp = brotli.Compressor(quality=min(LEVEL, 11))
+        return comp.process, comp.flush, comp.finish
+    comp = zlib.compressobj(LEVEL, zlib.DEFLATED, _WBITS[encoding])
+    return (comp.compress, lambda: comp.flush(zlib.Z_SYNC_FLUSH),
+            comp.flush)
+
+
+class _StreamCompressor:
+    """Incremental compressor, flushing every STREAM_FLUSH_BYTES input."""
+    def __init__(self, encoding: str):
+        self._process, self._flush, self._finish = _compressor(encoding)
+        self._pending = 0
+
+    def feed(self, chunk) -> bytes:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        out = self._process(chunk)
+        self._pending += len(chunk)
+        if self._pending >= STREAM_FLUSH_BYTES:
+            out += self._flush()
+            self._pending = 0
+        return out
+
+    def finish(self) -> bytes:
+        return self._finish()
+
+
+def compress_stream(chunks, encoding: str):
+    """Compress an iterable of chunks lazily."""
+    comp = _StreamCompressor(encoding)
+    for chunk in chunks:
+        out = comp.feed(chunk)
+        if out:
+            yield out
+    yield comp.finish()
+
+
+def _cached_compress(etag: str, body: bytes, encoding: str) -> bytes:
+    if not etag or CACHE_ENTRIES < 1:
+        return compress(body, encoding)
+    key = (etag, encoding)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    data = compress(body, encoding)
+    with _cache_lock:
+        _cache[key] = data
+        while len(_cache) > CACHE_ENTRIES:
+            _cache.popitem(last=False)
+    return data
+
+
+def compress_response(response):
+    """after_request hook: compress response if it is worth it."""
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < MIN_SIZE:
+            return response
+        etag, _ = response.get_etag()
+        response.set_data(_cached_compress(etag, body, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag + etag_suffix(encoding), weak=weak)
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
+
+
+def _tagged(etag_header: str, encoding: str) -> str:
+    """An ETag header value for the encoding's copy, weakness kept."""
+    weak = etag_header.startswith('W/')
+    tag = etag_header.removeprefix('W/').strip('"')
+    return f'{"W/" if weak else ""}"{tag}{etag_suffix(encoding)}"'
+
+
+class CompressMiddleware:
+    """
+    ASGI counterpart of compress_response: same negotiation, minimum
+    size, per-encoding ETags, body cache and streaming compression.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        req_headers = Headers([(k.decode('latin-1'), v.decode('latin-1'))
+                               for k, v in scope['headers']])
+        encoding = choose_encoding(parse_accept_header(
+            req_headers.get('Accept-Encoding')))
+        start = None
+        stream = None
+
+        async def send_wrapper(message):
+            nonlocal start, stream
+            if message['type'] == 'http.response.start':
+                start = message
+                return
+            if message['type'] != 'http.response.body':
+                return await send(message)
+            if stream is not None:
+                body = stream.feed(message.get('body', b''))
+                if not message.get('more_body'):
+                    body += stream.finish()
+                return await send({**message, 'body': body})
+            if start is None:
+                return await send(message)
+            first, start = start, None
+            headers = Headers([(k.decode('latin-1'), v.decode('latin-1'))
+                               for k, v in first.get('headers', [])])
+            body = message.get('body', b'')
+            more = message.get('more_body', False)
+            status = first['status']
+            mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+            if (status < 200 or status in (204, 304)
+                    or 'Content-Encoding' in headers
+                    or mimetype not in COMPRESSIBLE):
+                await send(first)
+                return await send(message)
+            vary = headers.get('Vary')
+            if not vary:
+                headers['Vary'] = 'Accept-Encoding'
+            elif 'accept-encoding' not in vary.lower():
+                headers['Vary'] = f'{vary}, Accept-Encoding'
+            if encoding is None or (not more and len(body) < MIN_SIZE):
+                await send(_start(first, headers))
+                return await send(message)
+            etag = headers.get('ETag')
+            if more:
+                stream = _StreamCompressor(encoding)
+                body = stream.feed(body)
+                headers.pop('Content-Length', None)
+            else:
+                body = _cached_compress(
+                    etag and etag.removeprefix('W/').strip('"'),
+                    body, encoding)
+                headers['Content-Length'] = str(len(body))
+            headers['Content-Encoding'] = encoding
+            if etag:
+                headers['ETag'] = _tagged(etag, encoding)
+            await send(_start(first, headers))
+            await send({**message, 'body': body})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def _start(message: dict, headers: Headers) -> dict:
+    return {**message, 'headers': [
+        (k.lower().encode('latin-1'), v.encode('latin-1'))
+        for k, v in headers.items()]}
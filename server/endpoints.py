@@ -3,21 +3,35 @@ This is the file containing all of the endpoints for our flask app.
 The endpoint called `endpoints` will return all available endpoints.
 """
 # from http import HTTPStatus
+import hashlib
+import hmac
+import json
+import os
+import time
+from functools import wraps
 
-from flask import Flask  # , request
-from flask_restx import Resource, Api, fields  # Namespace
+from flask import Flask, Response, g, request
+from flask_restx import Resource, Api, fields, inputs  # Namespace
 from flask_cors import CORS
 
 # import werkzeug.exceptions as wz
 
 import cities.queries as cqry
 import country.country as cntry
+import data.db_connect as dbc
+import data.metrics as metrics
+import data.slow_queries as slow_queries
+import data.tracing as tracing
+import server.compress as compress
+import server.json_repr as json_repr
 import states.queries as sqry
 
 
 app = Flask(__name__)
 CORS(app)
+compress.init_app(app)
 api = Api(app)
+json_repr.init_api(api)
 
 # Reusable RESTX models (used by @api.expect for Swagger docs)
 city_create_model = api.model('CityCreate', {
@@ -40,6 +54,7 @@ state_model = api.model('State', {
 ERROR = 'Error'
 MESSAGE = 'Message'
 NUM_RECS = 'Number of Records'
+NEXT_CURSOR = 'Next Cursor'
 READ = 'read'
 
 ENDPOINT_EP = '/endpoints'
@@ -55,8 +70,40 @@ STATES_EPS = '/state'
 STATE_RESP = 'States'
 
 COUNTRIES_EP = '/countries'
+
+JSON_MIME = json_repr.JSON_MIME
+CACHE_CONTROL = os.environ.get('HTTP_CACHE_CONTROL', 'no-cache')
+NDJSON_MIME = 'application/x-ndjson'
 COUNTRY_RESP = 'Countries'
+METRICS_EP = '/metrics'
+SLOW_QUERIES_EP = '/admin/slow-queries'
+SLOW_QUERIES_RESP = 'Slow Queries'
+# Admin endpoints require it in the X-Admin-Token header; unset, they
+# are closed
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+# route label for requests that matched no rule (keeps label sets bounded)
+UNMATCHED = 'unmatched'
 # COUNT_RESP = 'counts' Not used
+BATCH = 'batch'
+IDS = 'ids'
+NEAR = 'near'
+NEAREST = 'nearest'
+WITHIN = 'within'
+RADIUS = 'radius'
+DISTANCES = 'distances'
+SUGGEST = 'suggest'
+POINTS = 'points'
+DISTANCES_KM = 'Distances km'
+WITHIN_KM = 'Within km'
+NOT_FOUND = 'Not Found'
+# most records one batch request may carry
+MAX_BATCH = int(os.environ.get('MAX_BATCH_RECORDS', '10000'))
+BATCH_RESULTS = 'Results'
+BATCH_INSERTED = 'Inserted'
+BATCH_FAILED = 'Failed'
+CITIES_BY_STATE = 'cities_by_state'
+STATES_BY_COUNTRY = 'states_by_country'
 
 sort_parser = api.parser()
 sort_parser.add_argument(
@@ -66,28 +113,419 @@ sort_parser.add_argument(
     help="Sort by name/state_code; use '-name' for descending",
 )
 
+# Keyset pagination: passing `limit` switches a list endpoint to paged mode.
+page_parser = api.parser()
+page_parser.add_argument(
+    "limit",
+    type=int,
+    required=False,
+    help="Page size; when set, results are paged in (sort, id) order",
+)
+page_parser.add_argument(
+    "cursor",
+    type=str,
+    required=False,
+    help="Opaque cursor from the previous page's 'Next Cursor'",
+)
+page_parser.add_argument(
+    "total",
+    type=inputs.boolean,
+    required=False,
+    default=False,
+    help="Include the (cached) total record count in paged responses",
+)
+page_parser.add_argument(
+    "stream",
+    type=inputs.boolean,
+    required=False,
+    default=False,
+    help="Stream every record as NDJSON (same as Accept: "
+         f"{NDJSON_MIME})",
+)
+
+
+slow_query_parser = api.parser()
+slow_query_parser.add_argument(
+    "limit",
+    type=int,
+    required=False,
+    default=10,
+    help="Number of query shapes to return",
+)
+slow_query_parser.add_argument(
+    "sort",
+    type=str,
+    required=False,
+    default=slow_queries.TOTAL_MS,
+    help=f"One of {', '.join(slow_queries.SORT_KEYS)}",
+)
+
+ids_parser = api.parser()
+ids_parser.add_argument(
+    IDS,
+    type=str,
+    required=True,
+    help="Comma-separated ids; POST them to .../ids for long lists",
+)
+
+geo_parser = api.parser()
+geo_parser.add_argument(
+    "limit",
+    type=int,
+    required=False,
+    default=sqry.DEFAULT_PAGE_SIZE,
+    help=f"Most states to return (up to {sqry.MAX_PAGE_SIZE})",
+)
+
+near_parser = geo_parser.copy()
+near_parser.add_argument("lat", type=float, required=True, help="Latitude")
+near_parser.add_argument("lon", type=float, required=True, help="Longitude")
+near_parser.add_argument(
+    "max_km",
+    type=float,
+    required=False,
+    help="Only states within this many km",
+)
+
+suggest_parser = api.parser()
+suggest_parser.add_argument("q", type=str, required=True,
+                            help="Name prefix (case and accents ignored)")
+suggest_parser.add_argument(
+    "limit",
+    type=int,
+    required=False,
+    default=cqry.DEFAULT_SUGGEST,
+    help=f"How many names to return (at most {cqry.MAX_SUGGEST})",
+)
+city_suggest_parser = suggest_parser.copy()
+city_suggest_parser.add_argument("state_code", type=str, required=False,
+                                 help="Only cities in this state")
+state_suggest_parser = suggest_parser.copy()
+state_suggest_parser.add_argument("country_code", type=str, required=False,
+                                  help="Only states in this country")
+
+nearest_parser = api.parser()
+nearest_parser.add_argument("lat", type=float, required=True,
+                            help="Latitude")
+nearest_parser.add_argument("lon", type=float, required=True,
+                            help="Longitude")
+nearest_parser.add_argument(
+    "k",
+    type=int,
+    required=False,
+    default=1,
+    help="How many of the closest states to return",
+)
+
+radius_parser = near_parser.copy()
+radius_parser.remove_argument("max_km")
+radius_parser.add_argument("km", type=float, required=True, help="Radius")
+
+within_parser = geo_parser.copy()
+within_parser.add_argument(
+    "box",
+    type=str,
+    required=False,
+    help="sw_lat,sw_lon,ne_lat,ne_lon",
+)
+within_parser.add_argument(
+    "polygon",
+    type=str,
+    required=False,
+    help="lat,lon;lat,lon;lat,lon;... (3 or more points)",
+)
+
+counts_parser = api.parser()
+counts_parser.add_argument(
+    "groups",
+    type=inputs.boolean,
+    required=False,
+    default=False,
+    help="Also return cities per state_code and states per country_code",
+)
+
+city_list_parser = sort_parser.copy()
+for _arg in page_parser.args:
+    city_list_parser.add_argument(_arg)
+
+
+def _route() -> str:
+    return request.url_rule.rule if request.url_rule else UNMATCHED
+
+
+@app.before_request
+def _start_timer():
+    g.start_time = time.perf_counter()
+    g.trace = tracing.start_trace(
+        f'{request.method} {_route()}',
+        request.headers.get(tracing.TRACEPARENT),
+        {'http.request.method': request.method,
+         'http.route': _route(),
+         'url.path': request.path})
+
+
+@app.after_request
+def _record_request(response):
+    """Count and time every request by method and route template."""
+    start = g.pop('start_time', None)
+    if start is not None:
+        route = _route()
+        metrics.http_requests.inc(request.method, route,
+                                  str(response.status_code))
+        metrics.http_duration.observe(time.perf_counter() - start,
+                                      request.method, route)
+    span = g.get('trace')
+    if span is not None:
+        span.set('http.response.status_code', response.status_code)
+        response.headers[tracing.TRACE_HEADER] = span.trace.trace_id
+    return response
+
+
+@app.teardown_request
+def _end_trace(exc):
+    tracing.end_trace(g.pop('trace', None), exc)
+
+
+def is_admin(headers) -> bool:
+    """
+    True only if ADMIN_TOKEN is set and the request carries it. Compared
+    as the bytes on the wire (servers decode headers as latin-1):
+    compare_digest raises TypeError on non-ASCII str.
+    """
+    if not ADMIN_TOKEN:
+        return False
+    sent = headers.get(ADMIN_TOKEN_HEADER, '')
+    return hmac.compare_digest(sent.encode('latin-1', 'replace'),
+                               ADMIN_TOKEN.encode())
+
+
+def paged_response(resp_key, page, next_cursor, total_fn, want_total):
+    """Shape one page of a list endpoint."""
+    ret = {resp_key: page, NEXT_CURSOR: next_cursor}
+    if want_total:
+        ret[NUM_RECS] = total_fn()
+    return ret
+
+
+def wants_stream(args) -> bool:
+    """True if the client asked for NDJSON via ?stream=1 or Accept."""
+    if args.get("stream"):
+        return True
+    accept = request.accept_mimetypes
+    return accept.best_match([JSON_MIME, NDJSON_MIME]) == NDJSON_MIME
+
+
+def ndjson_response(docs):
+    """
+    Write docs to the response one line at a time as the generator
+    produces them, so memory stays flat on large exports.
+    """
+    def generate():
+        for doc in docs:
+            yield json_repr.dumps(doc) + b'\n'
+    return Response(generate(), mimetype=NDJSON_MIME)
+
+
+def parse_ndjson(body: bytes) -> list:
+    """One record per non-blank line."""
+    recs = []
+    for num, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            recs.append(json.loads(line))
+        except ValueError:
+            raise ValueError(f'Invalid JSON on line {num}') from None
+    return recs
+
+
+def check_batch(recs) -> list:
+    """Raise ValueError unless recs is a non-empty list within MAX_BATCH."""
+    if not isinstance(recs, list):
+        raise ValueError('Batch must be a JSON array or NDJSON')
+    if not recs:
+        raise ValueError('Batch is empty')
+    if len(recs) > MAX_BATCH:
+        raise ValueError(f'Batch has over {MAX_BATCH} records')
+    return recs
+
+
+def batch_payload() -> list:
+    """The records of a batch request: a JSON array or NDJSON body."""
+    if request.mimetype == NDJSON_MIME:
+        return check_batch(parse_ndjson(request.get_data()))
+    return check_batch(request.get_json(silent=True))
+
+
+def batch_response(ret: dict) -> tuple:
+    """
+    Per-record results of a create_many, in input order: the new id or
+    the error. 201 if every record was inserted, else 207.
+    """
+    errors = {err[dbc.BULK_INDEX]: err[dbc.BULK_MESSAGE]
+              for err in ret[dbc.BULK_ERRORS]}
+    results = [
+        {'index': i, 'id': new_id} if new_id is not None
+        else {'index': i, ERROR: errors.get(i, 'Not inserted')}
+        for i, new_id in enumerate(ret[dbc.BULK_IDS])
+    ]
+    failed = len(results) - sum(new_id is not None
+                                for new_id in ret[dbc.BULK_IDS])
+    return {
+        BATCH_RESULTS: results,
+        BATCH_INSERTED: len(results) - failed,
+        BATCH_FAILED: failed,
+    }, 207 if failed else 201
+
+
+def parse_ids(text: str) -> list:
+    """Ids from a comma-separated query arg."""
+    return [i.strip() for i in (text or '').split(',') if i.strip()]
+
+
+def ids_payload() -> list:
+    """Ids from a POST body: a JSON array or {"ids": [...]}."""
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get(IDS)
+    if not isinstance(body, list):
+        raise ValueError(f'Body must be a JSON array or {{"{IDS}": [...]}}')
+    return body
+
+
+def many_response(resp_key: str, ids: list, docs: list) -> dict:
+    """Docs in request order (null if missing) plus the missing ids."""
+    return {
+        resp_key: docs,
+        NUM_RECS: sum(doc is not None for doc in docs),
+        NOT_FOUND: [i for i, doc in zip(ids, docs) if doc is None],
+    }
+
+
+def fetch_many(query_fn, resp_key: str, ids: list) -> tuple:
+    """Shared body of the multi-get endpoints."""
+    try:
+        return many_response(resp_key, ids, query_fn(ids)), 200
+    except ValueError as e:
+        return {ERROR: str(e)}, 400
+    except ConnectionError as e:
+        return {ERROR: str(e)}, 500
+
+
+def _floats(text: str) -> list:
+    try:
+        return [float(val) for val in text.split(',')]
+    except ValueError:
+        raise ValueError(f'Bad coordinates: {text!r}') from None
+
+
+def parse_points(text: str) -> list:
+    """[(lat, lon), ...] from 'lat,lon;lat,lon;...'."""
+    points = []
+    for pair in text.split(';'):
+        coords = _floats(pair)
+        if len(coords) != 2:
+            raise ValueError(f'Bad point: {pair!r}')
+        points.append(tuple(coords))
+    return points
+
+
+def within_args(args) -> tuple:
+    """
+    (query function name, its positional args) for ?box= or ?polygon=:
+    within_box with the four corner coordinates, or within_polygon.
+    """
+    box, polygon = args.get('box'), args.get('polygon')
+    if bool(box) == bool(polygon):
+        raise ValueError('Give exactly one of box or polygon')
+    if box:
+        corners = _floats(box)
+        if len(corners) != 4:
+            raise ValueError('box is sw_lat,sw_lon,ne_lat,ne_lon')
+        return 'within_box', corners
+    return 'within_polygon', [parse_points(polygon)]
+
+
+def distances_args(body) -> tuple:
+    """(points, km or None) from a batch distance request body."""
+    if not isinstance(body, dict):
+        raise ValueError(f'Body must be {{"{POINTS}": [[lat, lon], ...]}}')
+    return body.get(POINTS), body.get('km')
+
+
+def etag_for(version) -> str:
+    """Strong ETag for this request's URL at a data version."""
+    raw = f'{version}:{request.full_path}'
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def conditional(source):
+    """
+    Tag successful GET responses with an ETag built from
+    source.version(), a cheap version all workers agree on that moves on
+    every write, plus Cache-Control; and answer a matching If-None-Match
+    with 304 before touching the DB or the serializer. A None version
+    means the source can't vouch for other workers' writes: no tagging.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            version = source.version()
+            if version is None:
+                return fn(*args, **kwargs)
+            etag = etag_for(version)
+            headers = {'ETag': f'"{etag}"', 'Cache-Control': CACHE_CONTROL}
+            # compressed copies are tagged etag + encoding suffix
+            for variant in [''] + [compress.etag_suffix(enc)
+                                   for enc in compress.supported()]:
+                if request.if_none_match.contains(etag + variant):
+                    headers['ETag'] = f'"{etag}{variant}"'
+                    return Response(status=304, headers=headers)
+            resp = fn(*args, **kwargs)
+            if isinstance(resp, Response):
+                if resp.status_code == 200:
+                    resp.headers.update(headers)
+                return resp
+            if isinstance(resp, tuple):
+                return resp
+            if isinstance(resp, dict) and ERROR in resp:
+                return resp
+            return resp, 200, headers
+        return wrapper
+    return decorator
+
 
 @api.route(f'{CITIES_EPS}/{READ}')
 class Cities(Resource):
     """
     Endpoints for listing and creating city records in the database.
     """
-    @api.expect(sort_parser)
+    @api.expect(city_list_parser)
     @api.doc(
         description=(
             "Return a list of cities from the database. "
-            "Optionally sort by name or state_code using the 'sort' query"
+            "Optionally sort by name or state_code using the 'sort' query. "
+            "Pass 'limit' (and then 'cursor') to page through the results, "
+            "or 'stream' for newline-delimited JSON."
         )
     )
     @api.response(200, "Cities returned successfully")
-    @api.response(400, "Invalid sort field")
+    @api.response(400, "Invalid sort field, limit or cursor")
+    @conditional(cqry)
     def get(self):
         """
-        Returns all cities.
+        Returns all cities, or one page of them when 'limit' is given.
         """
         try:
-            args = sort_parser.parse_args()
+            args = city_list_parser.parse_args()
             sort = args.get("sort")
+            if args.get("limit") is not None:
+                cities, next_cursor = cqry.read_page(
+                    sort, args["limit"], args.get("cursor"))
+                return paged_response(CITY_RESP, cities, next_cursor,
+                                      cqry.total, args.get("total"))
+            if wants_stream(args):
+                return ndjson_response(cqry.stream(sort))
             cities = cqry.read_sorted(sort)
             num_recs = len(cities)
         except ValueError as e:
@@ -130,18 +568,35 @@ class States(Resource):
     """
     Endpoints for listing and creating states records in the database.
     """
+    @api.expect(page_parser)
     @api.doc(
-        description="Return a list of all states from the backing store."
+        description=(
+            "Return a list of all states from the backing store. "
+            "Pass 'limit' (and then 'cursor') to page by name, "
+            "or 'stream' for newline-delimited JSON."
+        )
     )
     @api.response(200, "States returned successfully")
+    @api.response(400, "Invalid limit or cursor")
     @api.response(500, "Backend error while reading states")
+    @conditional(sqry)
     def get(self):
         """
-        Returns all states.
+        Returns all states, or one page of them when 'limit' is given.
         """
         try:
+            args = page_parser.parse_args()
+            if args.get("limit") is not None:
+                states, next_cursor = sqry.read_page(
+                    limit=args["limit"], cursor=args.get("cursor"))
+                return paged_response(STATE_RESP, states, next_cursor,
+                                      sqry.total, args.get("total"))
+            if wants_stream(args):
+                return ndjson_response(sqry.stream())
             states = sqry.read()
             num_recs = len(states)
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
         except ConnectionError as e:
             return {ERROR: str(e)}
         return {
@@ -152,6 +607,12 @@ class States(Resource):
 
 @api.route(STATES_EPS)
 class StatesRoot(Resource):
+    @api.doc(description="Get many states by id, in request order")
+    @api.expect(ids_parser)
+    def get(self):
+        ids = parse_ids(ids_parser.parse_args()[IDS])
+        return fetch_many(sqry.get_many, STATE_RESP, ids)
+
     @api.doc(description="Create a new state")
     @api.expect(state_model)
     def post(self):
@@ -163,12 +624,132 @@ class StatesRoot(Resource):
         return {'id': str(new_id)}, 201
 
 
+def list_response(resp: str, query_fn, *args, **kwargs) -> tuple:
+    """{resp: query_fn(...), NUM_RECS: n}, with the usual error codes."""
+    try:
+        recs = query_fn(*args, **kwargs)
+    except ValueError as e:
+        return {ERROR: str(e)}, 400
+    except ConnectionError as e:
+        return {ERROR: str(e)}, 500
+    return {resp: recs, NUM_RECS: len(recs)}, 200
+
+
+def geo_response(query_fn, *args, **kwargs) -> tuple:
+    """Shared body of the spatial endpoints."""
+    return list_response(STATE_RESP, query_fn, *args, **kwargs)
+
+
+@api.route(f'{STATES_EPS}/{NEAR}')
+class StatesNear(Resource):
+    @api.doc(description="States nearest a point, closest first, with "
+                         "distance_km ($near on a 2dsphere index)")
+    @api.expect(near_parser)
+    def get(self):
+        args = near_parser.parse_args()
+        return geo_response(sqry.near, args['lat'], args['lon'],
+                            max_km=args['max_km'], limit=args['limit'])
+
+
+@api.route(f'{STATES_EPS}/{NEAREST}')
+class StatesNearest(Resource):
+    @api.doc(description="The k states closest to a point, from an "
+                         "in-process KD-tree (no DB round trip)")
+    @api.expect(nearest_parser)
+    def get(self):
+        args = nearest_parser.parse_args()
+        return geo_response(sqry.nearest, args['lat'], args['lon'],
+                            k=args['k'])
+
+
+@api.route(f'{STATES_EPS}/{SUGGEST}')
+class StatesSuggest(Resource):
+    @api.doc(description="States whose name starts with q, in name order, "
+                         "from an in-memory prefix index")
+    @api.expect(state_suggest_parser)
+    def get(self):
+        args = state_suggest_parser.parse_args()
+        return list_response(STATE_RESP, sqry.suggest, args['q'],
+                             args['limit'], args['country_code'])
+
+
+@api.route(f'{STATES_EPS}/{RADIUS}')
+class StatesRadius(Resource):
+    @api.doc(description="States within km of a point, with distance_km")
+    @api.expect(radius_parser)
+    def get(self):
+        args = radius_parser.parse_args()
+        return geo_response(sqry.within_radius, args['lat'], args['lon'],
+                            args['km'], limit=args['limit'])
+
+
+@api.route(f'{STATES_EPS}/{WITHIN}')
+class StatesWithin(Resource):
+    @api.doc(description="States inside a bounding box or polygon")
+    @api.expect(within_parser)
+    def get(self):
+        args = within_parser.parse_args()
+        try:
+            name, coords = within_args(args)
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        return geo_response(getattr(sqry, name), *coords,
+                            limit=args['limit'])
+
+
+@api.route(f'{STATES_EPS}/{DISTANCES}')
+class StatesDistances(Resource):
+    @api.doc(description="Great-circle km from each of a batch of points "
+                         "to every state ({\"points\": [[lat, lon], ...]})"
+                         ", or with \"km\" the states within that radius "
+                         "of each point")
+    def post(self):
+        try:
+            points, km = distances_args(request.get_json(silent=True))
+            if km is not None:
+                return {WITHIN_KM: sqry.distances_within(points, km)}
+            states, matrix = sqry.distances(points)
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        except ConnectionError as e:
+            return {ERROR: str(e)}, 500
+        return {STATE_RESP: states, DISTANCES_KM: matrix}
+
+
+@api.route(f'{STATES_EPS}/{IDS}')
+class StatesByIds(Resource):
+    @api.doc(description="Get many states by id; the body is a JSON "
+                         "array of ids or {\"ids\": [...]}")
+    def post(self):
+        try:
+            ids = ids_payload()
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        return fetch_many(sqry.get_many, STATE_RESP, ids)
+
+
+@api.route(f'{STATES_EPS}/{BATCH}')
+class StatesBatch(Resource):
+    @api.doc(description="Create many states from a JSON array or NDJSON "
+                         "body; returns a result per record")
+    @api.expect([state_model])
+    def post(self):
+        try:
+            ret = sqry.create_many(batch_payload())
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        except ConnectionError as e:
+            return {ERROR: str(e)}, 500
+        return batch_response(ret)
+
+
 @api.route(f'{STATES_EPS}/<string:state_id>')
 class StateItem(Resource):
     @api.doc(
         description="Get a state by id",
         params={'state_id': 'State id'}
         )
+    @conditional(sqry)
     def get(self, state_id):
         try:
             state = sqry.get_by_id(state_id)
@@ -201,10 +782,16 @@ class StateItem(Resource):
 
 @api.route(CITIES_EPS)
 class CitiesRoot(Resource):
-    """POST-only endpoint for creating cities at /cities
-    Kept separate so clients can POST to /cities while the
-    listing endpoint remains at /cities/read.
+    """POST creates a city at /cities; GET ?ids= fetches many by id.
+    Kept separate so the listing endpoint remains at /cities/read.
     """
+    @api.doc(description="Get many cities by id, in request order")
+    @api.expect(ids_parser)
+    def get(self):
+        """Get cities by id in one query"""
+        ids = parse_ids(ids_parser.parse_args()[IDS])
+        return fetch_many(cqry.get_many, CITY_RESP, ids)
+
     @api.expect(city_model)
     def post(self):
         """Create a new city record"""
@@ -216,10 +803,49 @@ class CitiesRoot(Resource):
         return {'id': str(new_id)}, 201
 
 
+@api.route(f'{CITIES_EPS}/{IDS}')
+class CitiesByIds(Resource):
+    @api.doc(description="Get many cities by id; the body is a JSON "
+                         "array of ids or {\"ids\": [...]}")
+    def post(self):
+        try:
+            ids = ids_payload()
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        return fetch_many(cqry.get_many, CITY_RESP, ids)
+
+
+@api.route(f'{CITIES_EPS}/{SUGGEST}')
+class CitiesSuggest(Resource):
+    @api.doc(description="Cities whose name starts with q, in name order, "
+                         "from an in-memory prefix index")
+    @api.expect(city_suggest_parser)
+    def get(self):
+        args = city_suggest_parser.parse_args()
+        return list_response(CITY_RESP, cqry.suggest, args['q'],
+                             args['limit'], args['state_code'])
+
+
+@api.route(f'{CITIES_EPS}/{BATCH}')
+class CitiesBatch(Resource):
+    @api.doc(description="Create many cities from a JSON array or NDJSON "
+                         "body; returns a result per record")
+    @api.expect([city_model])
+    def post(self):
+        try:
+            ret = cqry.create_many(batch_payload())
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        except ConnectionError as e:
+            return {ERROR: str(e)}, 500
+        return batch_response(ret)
+
+
 @api.route(f'{CITIES_EPS}/<string:city_id>')
 class CityItem(Resource):
     """GET/PUT/DELETE operations for a single city by id."""
     @api.doc(params={'city_id': 'City database id'})
+    @conditional(cqry)
     def get(self, city_id):
         try:
             city = cqry.get_by_id(city_id)
@@ -259,15 +885,34 @@ class Health(Resource):
             dbc.connect_db()
         except Exception as e:
             return {ERROR: str(e)}, 500
+        if not dbc.is_db_up():
+            return {ERROR: 'Database unavailable'}, 500
         return {'status': 'ok'}
 
 
 @api.route(COUNTRIES_EP)
 class CountriesRoot(Resource):
-    @api.doc(description="List all countries (in-memory cache)")
+    @api.expect(page_parser)
+    @api.doc(description=(
+        "List all countries (in-memory cache); "
+        "pass 'limit' and 'cursor' to page by id"
+    ))
+    @conditional(cntry)
     def get(self):
-        countries = cntry.read()
-        return {COUNTRY_RESP: countries, NUM_RECS: len(countries)}
+        args = page_parser.parse_args()
+        if args.get("limit") is None and wants_stream(args):
+            return ndjson_response(
+                {cntry.ID: cid, **rec} for cid, rec in cntry.read().items())
+        if args.get("limit") is None:
+            countries = cntry.read()
+            return {COUNTRY_RESP: countries, NUM_RECS: len(countries)}
+        try:
+            countries, next_cursor = cntry.read_page(
+                args["limit"], args.get("cursor"))
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        return paged_response(COUNTRY_RESP, countries, next_cursor,
+                              lambda: len(cntry.read()), args.get("total"))
 
     @api.doc(description="Create a new country in cache")
     @api.expect(country_create_model)
@@ -283,6 +928,7 @@ class CountriesRoot(Resource):
 @api.route(f'{COUNTRIES_EP}/read')
 class CountriesRead(Resource):
     @api.doc(description="List countries (compat endpoint)")
+    @conditional(cntry)
     def get(self):
         countries = cntry.read()
         return {COUNTRY_RESP: countries, NUM_RECS: len(countries)}
@@ -294,6 +940,7 @@ class CountryItem(Resource):
         description="Get a country by id",
         params={'country_id': 'Country id'}
     )
+    @conditional(cntry)
     def get(self, country_id):
         try:
             return cntry.get_country_by_id(country_id)
@@ -302,16 +949,18 @@ class CountryItem(Resource):
 
     @api.doc(description="Update a country by id (in cache)")
     def put(self, country_id):
-        if country_id not in cntry.country_cache:
+        try:
+            cntry.update(country_id, api.payload)
+        except ValueError:
             return {ERROR: 'Country not found'}, 404
-        cntry.country_cache[country_id].update(api.payload or {})
         return {MESSAGE: 'Updated'}, 200
 
     @api.doc(description="Delete a country by id (in cache)")
     def delete(self, country_id):
-        if country_id not in cntry.country_cache:
+        try:
+            cntry.delete(country_id)
+        except ValueError:
             return {ERROR: 'Country not found'}, 404
-        del cntry.country_cache[country_id]
         return {MESSAGE: 'Deleted'}, 200
 
 
@@ -342,13 +991,51 @@ class Endpoints(Resource):
         return {ENDPOINT_RESP: endpoints}
 
 
+@api.route(METRICS_EP)
+class Metrics(Resource):
+    """Prometheus scrape target."""
+    @api.doc(description="Metrics in the Prometheus text format")
+    def get(self):
+        return Response(metrics.render(), mimetype=metrics.TEXT_MIME)
+
+
+@api.route(SLOW_QUERIES_EP)
+class SlowQueries(Resource):
+    """Top-N slow query shapes seen by this process."""
+    @api.expect(slow_query_parser)
+    @api.doc(description=(
+        "Slowest query shapes (commands over SLOW_QUERY_MS), with their "
+        "explain plan summary and docs examined/returned"
+    ))
+    @api.response(403, "Missing or wrong admin token")
+    def get(self):
+        if not is_admin(request.headers):
+            return {ERROR: 'Forbidden'}, 403
+        args = slow_query_parser.parse_args()
+        try:
+            top = slow_queries.top(args["limit"], args["sort"])
+        except ValueError as e:
+            return {ERROR: str(e)}, 400
+        return {SLOW_QUERIES_RESP: top,
+                'Threshold ms': slow_queries.SLOW_QUERY_MS}
+
+
 @api.route('/counts')
 class Counts(Resource):
     """Return record counts for each top-level collections."""
     @api.doc(description="Record counts for cities, states, countries")
+    @api.expect(counts_parser)
     def get(self):
-        return {
-            'cities': cqry.num_cities(),
-            'states': sqry.count(),
-            'countries': len(cntry.read()),
-        }
+        args = counts_parser.parse_args()
+        try:
+            ret = {
+                'cities': cqry.num_cities(),
+                'states': sqry.count(),
+                'countries': len(cntry.read()),
+            }
+            if args['groups']:
+                ret[CITIES_BY_STATE] = cqry.count_by_state()
+                ret[STATES_BY_COUNTRY] = sqry.count_by_country()
+        except ConnectionError as e:
+            return {ERROR: str(e)}, 500
+        return ret
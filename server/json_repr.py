@@ -0,0 +1,67 @@
+"""
+JSON representation for the Flask-RESTX api.
+Uses orjson when it is installed and the stdlib json module otherwise.
+Both encode Mongo ObjectIds (as their hex string) and datetimes (ISO
+8601) directly, so documents don't need converting before they are
+returned. Set JSON_ENCODER=stdlib to force the stdlib encoder.
+"""
+import datetime as dt
+import json
+import os
+
+from bson import ObjectId
+from flask import make_response
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+JSON_MIME = 'application/json'
+
+ORJSON = 'orjson'
+STDLIB = 'stdlib'
+ENCODERS = (ORJSON, STDLIB)
+encoder = os.environ.get('JSON_ENCODER',
+                         ORJSON if orjson is not None else STDLIB)
+if encoder not in ENCODERS or (encoder == ORJSON and orjson is None):
+    encoder = STDLIB
+
+
+def _default(obj):
+    """Encode the non-JSON types Mongo hands back."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (dt.datetime, dt.date)):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} '
+                    'is not JSON serializable')
+
+
+def dumps_orjson(data) -> bytes:
+    return orjson.dumps(data, default=_default,
+                        option=orjson.OPT_NON_STR_KEYS)
+
+
+def dumps_stdlib(data) -> bytes:
+    return json.dumps(data, default=_default,
+                      separators=(',', ':')).encode()
+
+
+def dumps(data) -> bytes:
+    """Encode data with the active encoder."""
+    if encoder == ORJSON:
+        return dumps_orjson(data)
+    return dumps_stdlib(data)
+
+
+def output_json(data, code, headers=None):
+    """Flask-RESTX representation function for application/json."""
+    resp = make_response(dumps(data), code)
+    resp.headers.extend(headers or {})
+    resp.mimetype = JSON_MIME
+    return resp
+
+
+def init_api(api):
+    api.representation(JSON_MIME)(output_json)
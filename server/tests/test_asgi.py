@@ -0,0 +1,333 @@
+"""Tests for the async app in server/asgi.py."""
+import pytest
+from starlette.testclient import TestClient
+
+from server import asgi
+
+CITY_ID = '507f1f77bcf86cd799439011'
+
+
+def returns(value):
+    """An async stand-in for a query function."""
+    async def fn(*args, **kwargs):
+        return value
+    return fn
+
+
+async def agen(docs):
+    for doc in docs:
+        yield doc
+
+
+@pytest.fixture(scope='module')
+def client():
+    return TestClient(asgi.app)
+
+
+def test_hello(client):
+    r = client.get('/hello')
+    assert r.status_code == 200
+    assert r.json() == {'hello': 'world'}
+
+
+def test_bad_traceparent_is_ignored(client):
+    bad = f"00-{'a' * 32}-{'b' * 16}-zz"
+    r = client.get('/hello', headers={'traceparent': bad})
+    assert r.status_code == 200
+
+
+def test_slow_queries_needs_admin_token(client, monkeypatch):
+    monkeypatch.setattr('data.slow_queries.top', lambda n, sort: [])
+    monkeypatch.setattr(asgi.ep, 'ADMIN_TOKEN', None)
+    assert client.get('/admin/slow-queries').status_code == 403
+    monkeypatch.setattr(asgi.ep, 'ADMIN_TOKEN', 'secret')
+    r = client.get('/admin/slow-queries',
+                   headers={'X-Admin-Token': 'secr\u00e9t'.encode()})
+    assert r.status_code == 403
+    r = client.get('/admin/slow-queries',
+                   headers={'X-Admin-Token': 'secret'})
+    assert r.status_code == 200
+
+
+def test_endpoints_match_flask(client):
+    r = client.get('/endpoints')
+    paths = set(r.json()[asgi.ep.ENDPOINT_RESP])
+    assert {'/cities/read', '/state/read', '/counts', '/health'} <= paths
+
+
+def test_get_cities_read(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.read_sorted',
+                        returns([{'name': 'A'}]))
+    monkeypatch.setattr('cities.async_queries.version', lambda: 3)
+    r = client.get('/cities/read')
+    assert r.status_code == 200
+    assert r.json() == {'Cities': [{'name': 'A'}], 'Number of Records': 1}
+    assert r.headers['ETag']
+
+
+def test_get_cities_read_not_modified(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.read_sorted',
+                        returns([{'name': 'A'}]))
+    monkeypatch.setattr('cities.async_queries.version', lambda: 3)
+    etag = client.get('/cities/read').headers['ETag']
+    r = client.get('/cities/read', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+
+
+def test_no_etag_without_shared_version(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.read_sorted',
+                        returns([{'name': 'A'}]))
+    monkeypatch.setattr('cities.async_queries.version', lambda: None)
+    r = client.get('/cities/read', headers={'If-None-Match': '"x"'})
+    assert r.status_code == 200
+    assert 'ETag' not in r.headers
+
+
+def test_get_cities_read_paged(client, monkeypatch):
+    calls = {}
+
+    async def read_page(sort, limit, cursor):
+        calls.update(sort=sort, limit=limit, cursor=cursor)
+        return [{'name': 'A'}], 'next'
+
+    monkeypatch.setattr('cities.async_queries.read_page', read_page)
+    monkeypatch.setattr('cities.async_queries.total', returns(7))
+    r = client.get('/cities/read?limit=1&cursor=abc&total=true&sort=name')
+    assert r.status_code == 200
+    assert calls == {'sort': 'name', 'limit': 1, 'cursor': 'abc'}
+    assert r.json() == {'Cities': [{'name': 'A'}], 'Next Cursor': 'next',
+                        'Number of Records': 7}
+
+
+def test_get_cities_read_bad_limit(client):
+    r = client.get('/cities/read?limit=x')
+    assert r.status_code == 400
+
+
+def test_get_cities_read_stream(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.stream',
+                        lambda sort=None: agen([{'name': 'A'},
+                                                {'name': 'B'}]))
+    r = client.get('/cities/read?stream=1')
+    assert r.status_code == 200
+    assert r.headers['content-type'].startswith(asgi.ep.NDJSON_MIME)
+    assert r.text.splitlines() == ['{"name":"A"}', '{"name":"B"}']
+
+
+BIG = [{'name': f'City {i}', 'state_code': 'NY'} for i in range(200)]
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate'])
+def test_large_list_compressed_and_tagged(client, monkeypatch, encoding):
+    """Same negotiation and per-encoding ETags as the flask app."""
+    monkeypatch.setattr('cities.async_queries.read_sorted', returns(BIG))
+    monkeypatch.setattr('cities.async_queries.version', lambda: 3)
+    r = client.get('/cities/read', headers={'Accept-Encoding': encoding})
+    assert r.headers['content-encoding'] == encoding
+    assert 'Accept-Encoding' in r.headers['vary']
+    assert r.headers['etag'].endswith(f'-{encoding}"')
+    assert r.json()['Cities'] == BIG
+    r = client.get('/cities/read', headers={
+        'Accept-Encoding': encoding, 'If-None-Match': r.headers['etag']})
+    assert r.status_code == 304
+
+
+def test_small_body_not_compressed(client):
+    r = client.get('/hello', headers={'Accept-Encoding': 'gzip'})
+    assert 'content-encoding' not in r.headers
+
+
+def test_stream_is_compressed(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.stream',
+                        lambda sort=None: agen(BIG))
+    r = client.get('/cities/read?stream=1',
+                   headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['content-encoding'] == 'gzip'
+    assert 'content-length' not in r.headers
+    assert len(r.text.splitlines()) == len(BIG)
+
+
+@pytest.mark.parametrize('accept, streamed', [
+    ('application/x-ndjson', True),
+    ('application/json;q=0.5, application/x-ndjson', True),
+    ('application/x-ndjson;q=0.1, application/json', False),
+    ('*/*', False),
+])
+def test_accept_negotiation_matches_flask(client, monkeypatch, accept,
+                                          streamed):
+    monkeypatch.setattr('cities.async_queries.stream',
+                        lambda sort=None: agen([{'name': 'A'}]))
+    monkeypatch.setattr('cities.async_queries.read_sorted',
+                        returns([{'name': 'A'}]))
+    r = client.get('/cities/read', headers={'Accept': accept})
+    ndjson = r.headers['content-type'].startswith(asgi.ep.NDJSON_MIME)
+    assert ndjson == streamed
+
+
+def test_post_city(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.create', returns('db-1'))
+    r = client.post('/cities', json={'name': 'T'})
+    assert r.status_code == 201
+    assert r.json() == {'id': 'db-1'}
+
+
+def test_post_city_bad_payload(client):
+    r = client.post('/cities', json={'bad': 'payload'})
+    assert r.status_code == 400
+    assert 'Error' in r.json()
+
+
+def test_cities_batch(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.create_many', returns({
+        'ids': ['a', None],
+        'errors': [{'index': 1, 'code': None, 'message': 'Bad'}]}))
+    r = client.post('/cities/batch', content='{"name":"A"}\n{}\n',
+                    headers={'content-type': asgi.ep.NDJSON_MIME})
+    assert r.status_code == 207
+    assert r.json()[asgi.ep.BATCH_RESULTS] == [
+        {'index': 0, 'id': 'a'}, {'index': 1, asgi.ep.ERROR: 'Bad'}]
+
+
+def test_states_batch_bad_body(client):
+    r = client.post('/state/batch', json={'name': 'A'})
+    assert r.status_code == 400
+
+
+def test_cities_get_many(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.get_many',
+                        returns([None, {'name': 'A'}]))
+    r = client.get('/cities?ids=x,a')
+    assert r.json()[asgi.ep.NOT_FOUND] == ['x']
+    r = client.post('/cities/ids', json=['x', 'a'])
+    assert r.json()[asgi.ep.CITY_RESP] == [None, {'name': 'A'}]
+    assert client.get('/cities').status_code == 400
+
+
+def test_states_geo(client, monkeypatch):
+    calls = []
+
+    async def near(lat, lon, max_km=None, limit=None):
+        calls.append((lat, lon, max_km, limit))
+        return [{'name': 'A'}]
+
+    monkeypatch.setattr('states.async_queries.near', near)
+    monkeypatch.setattr('states.async_queries.within_box', returns([]))
+    r = client.get('/state/near?lat=1&lon=2&limit=3')
+    assert r.json()[asgi.ep.NUM_RECS] == 1
+    assert calls == [(1.0, 2.0, None, 3)]
+    assert client.get('/state/within?box=1,2,3,4').status_code == 200
+    assert client.get('/state/radius?lat=1&lon=2').status_code == 400
+
+
+def test_states_nearest(client, monkeypatch):
+    calls = []
+
+    async def nearest(lat, lon, k=None):
+        calls.append(k)
+        return []
+
+    monkeypatch.setattr('states.async_queries.nearest', nearest)
+    client.get('/state/nearest?lat=1&lon=2')
+    client.get('/state/nearest?lat=1&lon=2&k=4')
+    assert calls == [1, 4]
+    assert client.get('/state/nearest?lat=1&lon=2&k=x').status_code == 400
+
+
+def test_suggest(client, monkeypatch):
+    calls = []
+
+    async def suggest(q, limit=10, **scope):
+        calls.append((q, limit, scope))
+        return [{'name': 'New York'}]
+
+    monkeypatch.setattr('cities.async_queries.suggest', suggest)
+    monkeypatch.setattr('states.async_queries.suggest', suggest)
+    r = client.get('/cities/suggest?q=New&state_code=NY')
+    assert r.json()[asgi.ep.CITY_RESP] == [{'name': 'New York'}]
+    r = client.get('/state/suggest?q=New&limit=3')
+    assert r.json()[asgi.ep.NUM_RECS] == 1
+    assert calls == [('New', 10, {'state_code': 'NY'}),
+                     ('New', 3, {'country_code': None})]
+    assert client.get('/cities/suggest?q=a&limit=x').status_code == 400
+
+
+def test_states_distances(client, monkeypatch):
+    monkeypatch.setattr('states.async_queries.distances',
+                        returns(([{'code': 'NY'}], [[1.0]])))
+    r = client.post('/state/distances', json={'points': [[1, 2]]})
+    assert r.json()[asgi.ep.DISTANCES_KM] == [[1.0]]
+    assert client.post('/state/distances', json=[]).status_code == 400
+
+
+def test_city_item(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.get_by_id',
+                        returns({'name': 'X'}))
+    monkeypatch.setattr('cities.async_queries.update_by_id', returns(True))
+    monkeypatch.setattr('cities.async_queries.delete_by_id', returns(False))
+    assert client.get(f'/cities/{CITY_ID}').json() == {'name': 'X'}
+    r = client.put(f'/cities/{CITY_ID}', json={'name': 'Y'})
+    assert r.json() == {'Message': 'Updated'}
+    assert client.delete(f'/cities/{CITY_ID}').status_code == 404
+
+
+def test_get_state_not_found(client, monkeypatch):
+    async def get_by_id(state_id):
+        raise ValueError('State not found')
+
+    monkeypatch.setattr('states.async_queries.get_by_id', get_by_id)
+    r = client.get(f'/state/{CITY_ID}')
+    assert r.status_code == 404
+
+
+def test_get_states_read(client, monkeypatch):
+    monkeypatch.setattr('states.async_queries.read',
+                        returns([{'name': 'New York'}]))
+    r = client.get('/state/read')
+    assert r.status_code == 200
+    assert r.json()['Number of Records'] == 1
+
+
+def test_counts(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.num_cities', returns(3))
+    monkeypatch.setattr('states.async_queries.count', returns(2))
+    r = client.get('/counts')
+    assert r.status_code == 200
+    assert r.json()['cities'] == 3
+    assert r.json()['states'] == 2
+
+
+def test_counts_groups(client, monkeypatch):
+    monkeypatch.setattr('cities.async_queries.num_cities', returns(3))
+    monkeypatch.setattr('cities.async_queries.count_by_state',
+                        returns({'NY': 3}))
+    monkeypatch.setattr('states.async_queries.count', returns(2))
+    monkeypatch.setattr('states.async_queries.count_by_country',
+                        returns({'USA': 2}))
+    r = client.get('/counts?groups=1')
+    assert r.json()[asgi.ep.CITIES_BY_STATE] == {'NY': 3}
+    assert r.json()[asgi.ep.STATES_BY_COUNTRY] == {'USA': 2}
+    assert client.get('/counts?groups=maybe').status_code == 400
+
+
+def test_countries_read(client):
+    r = client.get('/countries')
+    assert r.status_code == 200
+    assert 'Countries' in r.json()
+
+
+def test_metrics(client):
+    client.get('/hello')
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    assert ('http_requests_total{method="GET",route="/hello",'
+            'status="200"}') in r.text
+
+
+def test_trace_header_when_sampled(client, monkeypatch, tmp_path):
+    import data.tracing as tracing
+    monkeypatch.setattr(tracing, 'SAMPLE_RATE', 1.0)
+    monkeypatch.setattr(tracing, 'TRACE_FILE', str(tmp_path / 't.jsonl'))
+    r = client.get('/hello')
+    assert len(r.headers[tracing.TRACE_HEADER]) == 32
+    tracing.flush()
+    assert 'GET /hello' in (tmp_path / 't.jsonl').read_text()
@@ -0,0 +1,84 @@
+"""Tests for server/compress.py response compression."""
+import gzip
+import json
+import zlib
+
+import pytest
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+
+from server import compress, endpoints
+
+BIG = [{'name': f'City {i}', 'state_code': 'NY'} for i in range(200)]
+
+
+@pytest.fixture(scope='module')
+def client():
+    endpoints.app.testing = True
+    return endpoints.app.test_client()
+
+
+def test_choose_encoding_prefers_quality():
+    accept = parse_accept_header('deflate;q=1, gzip;q=0.5', Accept)
+    assert compress.choose_encoding(accept) == compress.DEFLATE
+    assert compress.choose_encoding(
+        parse_accept_header('identity', Accept)) is None
+
+
+def test_gzip_large_list(client, monkeypatch):
+    monkeypatch.setattr('cities.queries.read_sorted', lambda sort=None: BIG)
+    monkeypatch.setattr('cities.queries.version', lambda: 1)
+    r = client.get('/cities/read', headers={'Accept-Encoding': 'gzip'})
+    assert r.status_code == 200
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in r.headers['Vary']
+    data = json.loads(gzip.decompress(r.get_data()))
+    assert data['Cities'] == BIG
+    assert r.headers['ETag'].endswith('-gzip"')
+
+
+def test_small_body_not_compressed(client):
+    r = client.get('/hello', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in r.headers
+    assert r.get_json() == {'hello': 'world'}
+
+
+def test_no_accept_encoding(client, monkeypatch):
+    monkeypatch.setattr('cities.queries.read_sorted', lambda sort=None: BIG)
+    r = client.get('/cities/read', headers={'Accept-Encoding': ''})
+    assert 'Content-Encoding' not in r.headers
+
+
+def test_stream_is_compressed(client, monkeypatch):
+    monkeypatch.setattr('cities.queries.stream',
+                        lambda sort=None: iter(BIG))
+    r = client.get('/cities/read?stream=1',
+                   headers={'Accept-Encoding': 'deflate'})
+    assert r.headers['Content-Encoding'] == 'deflate'
+    lines = zlib.decompress(r.get_data()).decode().splitlines()
+    assert [json.loads(line) for line in lines] == BIG
+
+
+def test_304_for_compressed_etag(client, monkeypatch):
+    monkeypatch.setattr('cities.queries.read_sorted', lambda sort=None: BIG)
+    monkeypatch.setattr('cities.queries.version', lambda: 1)
+    r = client.get('/cities/read', headers={'Accept-Encoding': 'gzip'})
+    r = client.get('/cities/read', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+
+
+def test_compressed_body_cached_by_etag(monkeypatch):
+    calls = []
+    real = compress.compress
+
+    def counting(data, encoding):
+        calls.append(encoding)
+        return real(data, encoding)
+    monkeypatch.setattr(compress, 'compress', counting)
+    monkeypatch.setattr(compress, '_cache', compress.OrderedDict())
+    body = b'x' * 1000
+    first = compress._cached_compress('tag', body, compress.GZIP)
+    second = compress._cached_compress('tag', body, compress.GZIP)
+    assert first == second
+    assert calls == [compress.GZIP]
@@ -1,4 +1,6 @@
 """Tests for server/endpoints.py API routes."""
+import json
+
 import pytest
 
 from server import endpoints
@@ -73,6 +75,66 @@ def test_get_cities_read(client, monkeypatch):
     assert 'Cities' in data and isinstance(data['Cities'], list)
 
 
+def test_get_cities_read_paged(client, monkeypatch):
+    """GET /cities/read?limit=N returns one page plus a next cursor."""
+    calls = {}
+
+    def fake_read_page(sort, limit, cursor):
+        calls.update(sort=sort, limit=limit, cursor=cursor)
+        return [{'name': 'A'}], 'next-tok'
+    monkeypatch.setattr('cities.queries.read_page', fake_read_page)
+    r = client.get('/cities/read?limit=1&cursor=tok&sort=-name')
+    assert r.status_code == 200
+    data = r.get_json()
+    assert data['Cities'] == [{'name': 'A'}]
+    assert data[endpoints.NEXT_CURSOR] == 'next-tok'
+    assert endpoints.NUM_RECS not in data
+    assert calls == {'sort': '-name', 'limit': 1, 'cursor': 'tok'}
+
+
+def test_get_cities_read_paged_total(client, monkeypatch):
+    """total=true adds the cached total to a paged response."""
+    monkeypatch.setattr('cities.queries.read_page',
+                        lambda sort, limit, cursor: ([], None))
+    monkeypatch.setattr('cities.queries.total', lambda: 42)
+    r = client.get('/cities/read?limit=5&total=true')
+    assert r.status_code == 200
+    data = r.get_json()
+    assert data[endpoints.NUM_RECS] == 42
+    assert data[endpoints.NEXT_CURSOR] is None
+
+
+def test_get_cities_read_paged_bad_cursor(client, monkeypatch):
+    """A bad cursor is a 400."""
+    def fake_read_page(sort, limit, cursor):
+        raise ValueError('Invalid cursor')
+    monkeypatch.setattr('cities.queries.read_page', fake_read_page)
+    r = client.get('/cities/read?limit=5&cursor=junk')
+    assert r.status_code == 400
+
+
+def test_get_cities_read_stream(client, monkeypatch):
+    """?stream=1 returns one JSON document per line."""
+    monkeypatch.setattr('cities.queries.stream',
+                        lambda sort=None: iter([{'name': 'A'}, {'name': 'B'}]))
+    r = client.get('/cities/read?stream=1')
+    assert r.status_code == 200
+    assert r.mimetype == endpoints.NDJSON_MIME
+    lines = r.get_data(as_text=True).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {'name': 'A'}, {'name': 'B'}]
+
+
+def test_get_state_read_stream_accept(client, monkeypatch):
+    """Accept: application/x-ndjson streams the states."""
+    monkeypatch.setattr('states.queries.stream', lambda: iter([{'name': 'S'}]))
+    r = client.get('/state/read',
+                   headers={'Accept': endpoints.NDJSON_MIME})
+    assert r.status_code == 200
+    assert r.mimetype == endpoints.NDJSON_MIME
+    assert json.loads(r.get_data(as_text=True)) == {'name': 'S'}
+
+
 def test_post_cities_read_create(client, monkeypatch):
     """POST /cities/read creates a city and returns 201."""
     monkeypatch.setattr('cities.queries.create', lambda payload: 'db-2')
@@ -92,6 +154,17 @@ def test_get_state_read(client, monkeypatch):
     assert 'States' in data
 
 
+def test_get_state_read_paged(client, monkeypatch):
+    """GET /state/read?limit=N returns one page plus a next cursor."""
+    monkeypatch.setattr('states.queries.read_page',
+                        lambda limit, cursor: ([{'name': 'S'}], 'tok'))
+    r = client.get('/state/read?limit=1')
+    assert r.status_code == 200
+    data = r.get_json()
+    assert data['States'] == [{'name': 'S'}]
+    assert data[endpoints.NEXT_CURSOR] == 'tok'
+
+
 def test_post_state_success(client, monkeypatch):
     """POST /state with valid payload returns 201 + new id."""
     monkeypatch.setattr('states.queries.create', lambda payload: 'state-1')
@@ -143,6 +216,20 @@ def test_get_countries_root(client, monkeypatch):
     assert 'Countries' in r.get_json()
 
 
+def test_get_countries_paged(client, monkeypatch):
+    """GET /countries?limit=N walks the cache page by page."""
+    monkeypatch.setattr('country.country.country_cache',
+                        {'1': {'name': 'US'}, '2': {'name': 'CA'}})
+    r = client.get('/countries?limit=1')
+    data = r.get_json()
+    assert list(data['Countries']) == ['1']
+    cursor = data[endpoints.NEXT_CURSOR]
+    r = client.get(f'/countries?limit=1&cursor={cursor}')
+    data = r.get_json()
+    assert list(data['Countries']) == ['2']
+    assert data[endpoints.NEXT_CURSOR] is None
+
+
 def test_post_countries_root(client, monkeypatch):
     """POST /countries creates a country and returns 201."""
     monkeypatch.setattr('country.country.create', lambda payload: 'c-1')
@@ -175,6 +262,75 @@ def test_delete_country_item(client, monkeypatch):
     assert r.status_code == 200
 
 
+# ---- Conditional GET tests ----
+
+def test_list_etag_and_304(client, monkeypatch):
+    """A matching If-None-Match gets 304 without reading the data."""
+    monkeypatch.setattr('states.queries.version', lambda: 7)
+    monkeypatch.setattr('states.queries.read', lambda: [{'name': 'S'}])
+    r = client.get('/state/read')
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+    assert r.headers['Cache-Control'] == endpoints.CACHE_CONTROL
+
+    def boom():
+        raise AssertionError('should not read on a 304')
+    monkeypatch.setattr('states.queries.read', boom)
+    r = client.get('/state/read', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.headers['ETag'] == etag
+
+
+def test_etag_changes_with_version(client, monkeypatch):
+    """A write (version bump) changes the ETag."""
+    monkeypatch.setattr('cities.queries.read_sorted',
+                        lambda sort=None: [{'name': 'A'}])
+    monkeypatch.setattr('cities.queries.version', lambda: 1)
+    first = client.get('/cities/read').headers['ETag']
+    monkeypatch.setattr('cities.queries.version', lambda: 2)
+    r = client.get('/cities/read', headers={'If-None-Match': first})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != first
+
+
+def test_no_etag_without_shared_version(client, monkeypatch):
+    """Without cache sync, cities/states responses are not tagged."""
+    monkeypatch.setattr('cities.queries.read_sorted',
+                        lambda sort=None: [{'name': 'A'}])
+    monkeypatch.setattr('data.db_connect._sync_thread', None)
+    r = client.get('/cities/read', headers={'If-None-Match': '"x"'})
+    assert r.status_code == 200
+    assert 'ETag' not in r.headers
+
+
+def test_etag_differs_by_query(client, monkeypatch):
+    """Different query strings are different representations."""
+    monkeypatch.setattr('country.country.read', lambda: {'1': {}})
+    a = client.get('/countries').headers['ETag']
+    b = client.get('/countries?stream=1').headers['ETag']
+    assert a != b
+
+
+def test_error_not_tagged(client, monkeypatch):
+    """Error responses carry no ETag."""
+    def not_found(cid):
+        raise ValueError('City not found')
+    monkeypatch.setattr('cities.queries.get_by_id', not_found)
+    r = client.get('/cities/507f1f77bcf86cd799439011')
+    assert r.status_code == 404
+    assert 'ETag' not in r.headers
+
+
+def test_country_write_changes_etag(client, monkeypatch):
+    """PUT on a country moves the countries version."""
+    monkeypatch.setattr('country.country.country_cache',
+                        {'1': {'name': 'US'}})
+    first = client.get('/countries/1').headers['ETag']
+    client.put('/countries/1', json={'name': 'USA'})
+    r = client.get('/countries/1', headers={'If-None-Match': first})
+    assert r.status_code == 200
+
+
 # ---- Utility endpoint tests ----
 
 def test_get_hello(client):
@@ -184,6 +340,13 @@ def test_get_hello(client):
     assert r.get_json().get('hello') == 'world'
 
 
+def test_bad_traceparent_is_ignored(client):
+    """A malformed traceparent header doesn't break the request."""
+    bad = f"00-{'a' * 32}-{'b' * 16}-zz"
+    r = client.get('/hello', headers={'traceparent': bad})
+    assert r.status_code == 200
+
+
 def test_get_endpoints(client):
     """GET /endpoints lists available API routes."""
     r = client.get('/endpoints')
@@ -200,6 +363,186 @@ def test_health_endpoint(client, monkeypatch):
     assert r.get_json().get('status') == 'ok'
 
 
+def test_health_endpoint_circuit_open(client, monkeypatch):
+    """GET /health reports 500 while the DB circuit is open."""
+    monkeypatch.setattr('data.db_connect.connect_db', lambda: None)
+    monkeypatch.setattr('data.db_connect.is_db_up', lambda: False)
+    r = client.get('/health')
+    assert r.status_code == 500
+
+
+def test_cities_batch_json(client, monkeypatch):
+    """POST /cities/batch inserts a JSON array with one call."""
+    calls = []
+
+    def create_many(recs):
+        calls.append(recs)
+        return {'ids': ['a', 'b'], 'errors': []}
+    monkeypatch.setattr('cities.queries.create_many', create_many)
+    r = client.post('/cities/batch', json=[{'name': 'A'}, {'name': 'B'}])
+    assert r.status_code == 201
+    assert calls == [[{'name': 'A'}, {'name': 'B'}]]
+    data = r.get_json()
+    assert data[endpoints.BATCH_RESULTS] == [{'index': 0, 'id': 'a'},
+                                             {'index': 1, 'id': 'b'}]
+    assert data[endpoints.BATCH_INSERTED] == 2
+
+
+def test_states_batch_ndjson_partial(client, monkeypatch):
+    """NDJSON bodies work; per-record failures give a 207."""
+    monkeypatch.setattr('states.queries.create_many', lambda recs: {
+        'ids': ['a', None],
+        'errors': [{'index': 1, 'code': None, 'message': 'Duplicate'}]})
+    body = '{"name": "A"}\n\n{"name": "B"}\n'
+    r = client.post('/state/batch', data=body,
+                    content_type=endpoints.NDJSON_MIME)
+    assert r.status_code == 207
+    data = r.get_json()
+    assert data[endpoints.BATCH_RESULTS][1] == {'index': 1,
+                                                endpoints.ERROR: 'Duplicate'}
+    assert (data[endpoints.BATCH_INSERTED],
+            data[endpoints.BATCH_FAILED]) == (1, 1)
+
+
+@pytest.mark.parametrize('body, mime', [
+    ('{"name": "A"}', endpoints.JSON_MIME),
+    ('[]', endpoints.JSON_MIME),
+    ('{"name": "A"}\nnot json\n', endpoints.NDJSON_MIME),
+])
+def test_batch_bad_body(client, body, mime):
+    r = client.post('/cities/batch', data=body, content_type=mime)
+    assert r.status_code == 400
+
+
+def test_batch_too_large(client, monkeypatch):
+    monkeypatch.setattr(endpoints, 'MAX_BATCH', 1)
+    r = client.post('/cities/batch', json=[{'name': 'A'}, {'name': 'B'}])
+    assert r.status_code == 400
+
+
+def test_cities_get_many(client, monkeypatch):
+    """GET /cities?ids= keeps request order and lists missing ids."""
+    calls = []
+
+    def get_many(ids):
+        calls.append(ids)
+        return [{'name': 'B'}, None]
+    monkeypatch.setattr('cities.queries.get_many', get_many)
+    r = client.get('/cities?ids=b, x')
+    assert r.status_code == 200
+    assert calls == [['b', 'x']]
+    data = r.get_json()
+    assert data[endpoints.CITY_RESP] == [{'name': 'B'}, None]
+    assert data[endpoints.NOT_FOUND] == ['x']
+    assert data[endpoints.NUM_RECS] == 1
+
+
+def test_states_post_many(client, monkeypatch):
+    """POST /state/ids takes the ids in the body."""
+    monkeypatch.setattr('states.queries.get_many',
+                        lambda ids: [{'name': i} for i in ids])
+    r = client.post('/state/ids', json={'ids': ['a', 'b']})
+    assert r.status_code == 200
+    assert r.get_json()[endpoints.STATE_RESP] == [{'name': 'a'},
+                                                  {'name': 'b'}]
+    assert client.post('/state/ids', json={'x': 1}).status_code == 400
+
+
+def test_get_many_missing_ids(client):
+    assert client.get('/cities').status_code == 400
+
+
+def test_states_near(client, monkeypatch):
+    """GET /state/near passes the point, radius and limit through."""
+    calls = []
+
+    def near(lat, lon, max_km=None, limit=None):
+        calls.append((lat, lon, max_km, limit))
+        return [{'name': 'A'}]
+    monkeypatch.setattr('states.queries.near', near)
+    r = client.get('/state/near?lat=40.5&lon=-74&max_km=10')
+    assert r.status_code == 200
+    assert r.get_json()[endpoints.NUM_RECS] == 1
+    assert calls == [(40.5, -74.0, 10.0, 50)]
+    assert client.get('/state/near?lat=40.5').status_code == 400
+
+
+def test_states_nearest(client, monkeypatch):
+    """GET /state/nearest defaults to the single closest state."""
+    calls = []
+
+    def nearest(lat, lon, k=None):
+        calls.append((lat, lon, k))
+        return [{'name': 'A', 'distance_km': 1.5}]
+    monkeypatch.setattr('states.queries.nearest', nearest)
+    r = client.get('/state/nearest?lat=1&lon=2')
+    assert r.status_code == 200
+    assert r.get_json()[endpoints.STATE_RESP][0]['distance_km'] == 1.5
+    client.get('/state/nearest?lat=1&lon=2&k=3')
+    assert calls == [(1.0, 2.0, 1), (1.0, 2.0, 3)]
+
+
+def test_suggest(client, monkeypatch):
+    """GET /cities/suggest and /state/suggest pass q, limit and scope."""
+    calls = []
+
+    def suggest(q, limit, scope):
+        calls.append((q, limit, scope))
+        return [{'name': 'New York'}]
+    monkeypatch.setattr('cities.queries.suggest', suggest)
+    monkeypatch.setattr('states.queries.suggest', suggest)
+    r = client.get('/cities/suggest?q=New&state_code=NY')
+    assert r.status_code == 200
+    assert r.get_json()[endpoints.CITY_RESP] == [{'name': 'New York'}]
+    r = client.get('/state/suggest?q=New&limit=3&country_code=USA')
+    assert r.get_json()[endpoints.STATE_RESP] == [{'name': 'New York'}]
+    assert calls == [('New', 10, 'NY'), ('New', 3, 'USA')]
+    assert client.get('/cities/suggest').status_code == 400
+
+    def bad_limit(q, limit, scope):
+        raise ValueError('bad limit')
+    monkeypatch.setattr('cities.queries.suggest', bad_limit)
+    assert client.get('/cities/suggest?q=a&limit=0').status_code == 400
+
+
+def test_states_distances(client, monkeypatch):
+    """POST /state/distances returns a matrix, or hits with km."""
+    monkeypatch.setattr('states.queries.distances',
+                        lambda points: ([{'code': 'NY'}], [[1.0]]))
+    monkeypatch.setattr('states.queries.distances_within',
+                        lambda points, km: [[{'code': 'NY'}]])
+    r = client.post('/state/distances', json={'points': [[1, 2]]})
+    assert r.status_code == 200
+    assert r.get_json()[endpoints.DISTANCES_KM] == [[1.0]]
+    r = client.post('/state/distances', json={'points': [[1, 2]], 'km': 5})
+    assert r.get_json()[endpoints.WITHIN_KM] == [[{'code': 'NY'}]]
+    r = client.post('/state/distances', json=[[1, 2]])
+    assert r.status_code == 400
+
+
+def test_states_within(client, monkeypatch):
+    """GET /state/within takes a box or a polygon, not both."""
+    calls = []
+    monkeypatch.setattr('states.queries.within_box',
+                        lambda *c, limit: calls.append(c) or [])
+    monkeypatch.setattr('states.queries.within_polygon',
+                        lambda pts, limit: calls.append(pts) or [])
+    assert client.get('/state/within?box=1,2,3,4').status_code == 200
+    assert client.get('/state/within?polygon=0,0;0,1;1,1').status_code == 200
+    assert calls == [(1.0, 2.0, 3.0, 4.0), [(0, 0), (0, 1), (1, 1)]]
+    assert client.get('/state/within').status_code == 400
+    assert client.get('/state/within?box=1,2,3').status_code == 400
+    assert client.get('/state/within?polygon=0,0;x').status_code == 400
+
+
+def test_states_radius_bad_value(client, monkeypatch):
+    def within_radius(*args, **kwargs):
+        raise ValueError('Latitude out of range: 99')
+    monkeypatch.setattr('states.queries.within_radius', within_radius)
+    r = client.get('/state/radius?lat=99&lon=0&km=5')
+    assert r.status_code == 400
+
+
 def test_counts_endpoint(client, monkeypatch):
     """GET /counts returns counts of cities, states, countries."""
     monkeypatch.setattr('cities.queries.num_cities', lambda: 2)
@@ -211,3 +554,90 @@ def test_counts_endpoint(client, monkeypatch):
     assert data.get('cities') == 2
     assert data.get('states') == 3
     assert data.get('countries') == 2
+
+
+def test_counts_endpoint_groups(client, monkeypatch):
+    """GET /counts?groups=true adds per-state and per-country counts."""
+    monkeypatch.setattr('cities.queries.num_cities', lambda: 2)
+    monkeypatch.setattr('cities.queries.count_by_state',
+                        lambda: {'NY': 2})
+    monkeypatch.setattr('states.queries.count', lambda: 1)
+    monkeypatch.setattr('states.queries.count_by_country',
+                        lambda: {'USA': 1})
+    r = client.get('/counts?groups=true')
+    assert r.status_code == 200
+    data = r.get_json()
+    assert data[endpoints.CITIES_BY_STATE] == {'NY': 2}
+    assert data[endpoints.STATES_BY_COUNTRY] == {'USA': 1}
+
+
+def test_counts_endpoint_db_down(client, monkeypatch):
+    """GET /counts reports 500 when the DB is unavailable."""
+    def down():
+        raise ConnectionError('Database unavailable')
+    monkeypatch.setattr('cities.queries.num_cities', down)
+    r = client.get('/counts')
+    assert r.status_code == 500
+
+
+def test_metrics(client):
+    """GET /metrics returns request counters in the text format."""
+    client.get('/hello')
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    assert r.mimetype == 'text/plain'
+    text = r.get_data(as_text=True)
+    assert ('http_requests_total{method="GET",route="/hello",'
+            'status="200"}') in text
+    assert 'http_request_duration_seconds_bucket' in text
+
+
+def test_trace_header_when_sampled(client, monkeypatch, tmp_path):
+    """Sampled requests carry their trace id back to the client."""
+    import data.tracing as tracing
+    monkeypatch.setattr(tracing, 'SAMPLE_RATE', 1.0)
+    monkeypatch.setattr(tracing, 'TRACE_FILE', str(tmp_path / 't.jsonl'))
+    r = client.get('/hello')
+    assert len(r.headers[tracing.TRACE_HEADER]) == 32
+    tracing.flush()
+    assert 'GET /hello' in (tmp_path / 't.jsonl').read_text()
+
+
+def test_slow_queries(client, monkeypatch):
+    """GET /admin/slow-queries returns the top-N summary."""
+    monkeypatch.setattr(endpoints, 'ADMIN_TOKEN', 'secret')
+    monkeypatch.setattr('data.slow_queries.top',
+                        lambda n, sort: [{'count': n, 'sort': sort}])
+    r = client.get('/admin/slow-queries?limit=3&sort=max_ms',
+                   headers={'X-Admin-Token': 'secret'})
+    assert r.status_code == 200
+    assert r.get_json()['Slow Queries'] == [{'count': 3, 'sort': 'max_ms'}]
+
+
+def test_slow_queries_needs_admin_token(client, monkeypatch):
+    monkeypatch.setattr(endpoints, 'ADMIN_TOKEN', 'secret')
+    assert client.get('/admin/slow-queries').status_code == 403
+    r = client.get('/admin/slow-queries',
+                   headers={'X-Admin-Token': 'secret'})
+    assert r.status_code == 200
+
+
+def test_slow_queries_closed_without_admin_token(client, monkeypatch):
+    monkeypatch.setattr(endpoints, 'ADMIN_TOKEN', None)
+    assert client.get('/admin/slow-queries').status_code == 403
+
+
+@pytest.mark.parametrize('sent', ['s\u00e9cret', 'secret\u20ac', ''])
+def test_is_admin_rejects_wrong_tokens(monkeypatch, sent):
+    """Non-ASCII tokens are refused, not a TypeError (a 500)."""
+    monkeypatch.setattr(endpoints, 'ADMIN_TOKEN', 'secret')
+    assert not endpoints.is_admin({'X-Admin-Token': sent})
+
+
+def test_non_ascii_admin_token(client, monkeypatch):
+    """A UTF-8 token arrives as its bytes decoded as latin-1."""
+    monkeypatch.setattr(endpoints, 'ADMIN_TOKEN', 's\u00e9cret')
+    monkeypatch.setattr('data.slow_queries.top', lambda n, sort: [])
+    wire = 's\u00e9cret'.encode().decode('latin-1')
+    r = client.get('/admin/slow-queries', headers={'X-Admin-Token': wire})
+    assert r.status_code == 200
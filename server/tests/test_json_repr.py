@@ -0,0 +1,41 @@
+import datetime as dt
+
+import pytest
+from bson import ObjectId
+
+import server.json_repr as jr
+
+OID = ObjectId('65a1b2c3d4e5f60718293a4b')
+WHEN = dt.datetime(2024, 1, 2, 3, 4, 5)
+DOC = {'_id': OID, 'updated': WHEN, 'name': 'Ithaca'}
+EXPECTED = {'_id': str(OID), 'updated': WHEN.isoformat(), 'name': 'Ithaca'}
+
+
+def test_dumps_stdlib():
+    import json
+    assert json.loads(jr.dumps_stdlib(DOC)) == EXPECTED
+
+
+@pytest.mark.skipif(jr.orjson is None, reason='orjson not installed')
+def test_dumps_orjson():
+    import json
+    assert json.loads(jr.dumps_orjson(DOC)) == EXPECTED
+
+
+def test_dumps_rejects_unknown_type():
+    with pytest.raises(TypeError):
+        jr.dumps_stdlib({'x': object()})
+
+
+def test_dumps_uses_stdlib(monkeypatch):
+    monkeypatch.setattr(jr, 'encoder', jr.STDLIB)
+    assert jr.dumps([1, 2]) == b'[1,2]'
+
+
+def test_output_json():
+    from server.endpoints import app
+    with app.test_request_context():
+        resp = jr.output_json(DOC, 200, {'X-Test': '1'})
+    assert resp.mimetype == jr.JSON_MIME
+    assert resp.headers['X-Test'] == '1'
+    assert resp.get_json() == EXPECTED
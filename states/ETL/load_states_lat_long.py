@@ -3,10 +3,18 @@ import csv
 
 from states.queries import (
     COUNTRY_CODE,
-    create,
+    LATITUDE,
+    LOCATION,
+    LONGITUDE,
+    STATE_CODE,
+    upsert_many,
 )
+from data.db_connect import BULK_ERRORS, BULK_INDEX, BULK_MESSAGE
+from data.geo import lat_lon, point
 
 CURR_COUNTRY = 'USA'
+# Dropped from a stored state when its row has no usable coordinates
+GEO_FIELDS = (LOCATION, LATITUDE, LONGITUDE)
 
 
 def extract(flnm: str) -> list:
@@ -25,8 +33,25 @@ def extract(flnm: str) -> list:
     return state_list
 
 
+def add_location(state_dict: dict):
+    """
+    Store latitude/longitude as numbers plus a GeoJSON point for the
+    2dsphere index. Rows without usable coordinates keep none of
+    GEO_FIELDS, and load() removes them from the stored state.
+    """
+    lat = state_dict.pop(LATITUDE, None)
+    lon = state_dict.pop(LONGITUDE, None)
+    try:
+        state_dict[LOCATION] = point(lat, lon)
+    except ValueError as e:
+        print(f'No location for {state_dict.get(STATE_CODE)}: {e}')
+        return
+    state_dict[LATITUDE], state_dict[LONGITUDE] = lat_lon(
+        state_dict[LOCATION])
+
+
 def transform(state_list: list) -> list:
-    """Convert rows into dicts, attach country code."""
+    """Convert rows into dicts, attach country code and location."""
     rev_list = []
     # First row contains column names
     col_names = state_list.pop(0)
@@ -36,13 +61,17 @@ def transform(state_list: list) -> list:
         for i, fld in enumerate(col_names):
             state_dict[fld] = state[i]
         state_dict[COUNTRY_CODE] = CURR_COUNTRY
+        add_location(state_dict)
         rev_list.append(state_dict)
     return rev_list
 
 
 def load(rev_list: list):
-    for state in rev_list:
-        create(state, reload=False)
+    """Upsert all rows in a few bulk round trips; report failed rows."""
+    ret = upsert_many(rev_list, clear=GEO_FIELDS)
+    for err in ret[BULK_ERRORS]:
+        print(f'Row {err[BULK_INDEX]} not loaded: {err[BULK_MESSAGE]}')
+    return ret
 
 
 def main():
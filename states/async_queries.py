@@ -0,0 +1,256 @@
+"""
+Async versions of the states.queries functions the API uses, for the
+ASGI app. They share states.queries' cache, validation and constants.
+"""
+from bson import ObjectId
+
+import data.db_connect as dbc
+import data.db_connect_async as adbc
+import data.geo as geo
+import data.metrics as metrics
+import data.tracing as tracing
+import states.queries as sqry
+
+STATE_COLLECTION = sqry.STATE_COLLECTION
+NAME = sqry.NAME
+DEFAULT_PAGE_SIZE = sqry.DEFAULT_PAGE_SIZE
+
+
+@tracing.traced
+async def load_cache():
+    """Loads all states into states.queries' cache."""
+    new_cache, new_ids = {}, {}
+    keyed = {sqry.STATE_CODE: {'$ne': None},
+             sqry.COUNTRY_CODE: {'$ne': None}}
+    async for state in adbc.find(STATE_COLLECTION, keyed, no_id=False):
+        key = (state[sqry.STATE_CODE], state[sqry.COUNTRY_CODE])
+        new_ids[state.pop(dbc.MONGO_ID)] = key
+        new_cache[key] = state
+    sqry._replace_cache(new_cache, new_ids)
+
+
+async def _ensure_cache():
+    metrics.cache_lookup(sqry.CACHE_NAME, sqry.cache is not None)
+    if sqry.cache is None:
+        await load_cache()
+
+
+async def _cache_drop(state: dict, state_id: str):
+    """Removes one state from the cache; reloads if it wasn't there."""
+    key = sqry._key(state)
+    sqry.key_by_id.pop(state_id, None)
+    if sqry.cache is None or key is None:
+        return
+    if sqry.cache.pop(key, None) is None:
+        await load_cache()
+        return
+    sqry._index_drop(key)
+
+
+@tracing.traced
+async def count() -> int:
+    """Number of states; see states.queries.count()."""
+    if sqry.cache is not None:
+        return len(sqry.cache)
+    return await adbc.count(STATE_COLLECTION)
+
+
+@tracing.traced
+async def count_by_country() -> dict:
+    """{country_code: number of states}; see states.queries."""
+    if sqry.cache is not None:
+        return sqry.count_by_country()
+    counts = await adbc.count_by(STATE_COLLECTION, sqry.COUNTRY_CODE)
+    return {code: n for code, n in counts.items() if code is not None}
+
+
+@tracing.traced
+async def read() -> list:
+    """Returns all states as a list from cache."""
+    await _ensure_cache()
+    return list(sqry.cache.values())
+
+
+@tracing.traced
+@dbc.patches_cache
+async def create(flds: dict) -> str:
+    """Creates a new state. Validates fields and checks for duplicates."""
+    await _ensure_cache()
+    code, country_code = sqry._validate(flds)
+    if (code, country_code) in sqry.cache:
+        raise ValueError(f'Duplicate key: {code=}; {country_code=}')
+    new_id = await adbc.create(STATE_COLLECTION, dict(flds))
+    sqry._cache_put(flds, new_id)
+    return new_id
+
+
+@tracing.traced
+@dbc.patches_cache
+async def create_many(recs: list) -> dict:
+    """Bulk-creates states; see states.queries.create_many()."""
+    if not isinstance(recs, list):
+        raise ValueError(f'Bad type for {type(recs)=}')
+    await _ensure_cache()
+    ret = await adbc.create_many(STATE_COLLECTION, recs,
+                                 validate=sqry._batch_validator())
+    for flds, new_id in zip(recs, ret[dbc.BULK_IDS]):
+        if new_id is not None:
+            sqry._cache_put(flds, new_id)
+    return ret
+
+
+@tracing.traced
+async def get_by_id(state_id: str) -> dict:
+    """Fetches a single state by its MongoDB ObjectId string."""
+    if not sqry.is_valid_id(state_id):
+        raise ValueError('Invalid id')
+    rec = await adbc.read_one(
+        STATE_COLLECTION, {dbc.MONGO_ID: ObjectId(state_id)})
+    if rec is None:
+        raise ValueError('State not found')
+    return rec
+
+
+@tracing.traced
+async def get_many(ids: list) -> list:
+    """States for ids in request order; see states.queries.get_many()."""
+    found = sqry._many_from_cache(ids)
+    missing = [state_id for state_id in ids if state_id not in found]
+    if missing:
+        found.update(await adbc.read_by_ids(STATE_COLLECTION, missing))
+    return [found.get(state_id) for state_id in ids]
+
+
+@tracing.traced
+@dbc.patches_cache
+async def update_by_id(state_id: str, update_fields: dict) -> bool:
+    """Updates a state by id. Returns True if any field actually changed."""
+    if not sqry.is_valid_id(state_id):
+        raise ValueError('Invalid id')
+    if not isinstance(update_fields, dict):
+        raise ValueError('update_fields must be a dict')
+    await _ensure_cache()
+    before = await adbc.update_and_fetch(
+        STATE_COLLECTION, {dbc.MONGO_ID: ObjectId(state_id)}, update_fields)
+    if before is None:
+        return False
+    after = {**before, **update_fields}
+    if sqry._key(after) != sqry._key(before):
+        await _cache_drop(before, state_id)
+    sqry._cache_put(after, state_id)
+    return any(before.get(k) != v for k, v in update_fields.items())
+
+
+@tracing.traced
+@dbc.patches_cache
+async def delete_by_id(state_id: str) -> bool:
+    """Deletes a state by id. Returns True if a document was deleted."""
+    if not sqry.is_valid_id(state_id):
+        raise ValueError('Invalid id')
+    await _ensure_cache()
+    deleted = await adbc.delete_and_fetch(
+        STATE_COLLECTION, {dbc.MONGO_ID: ObjectId(state_id)})
+    if deleted is None:
+        return False
+    await _cache_drop(deleted, state_id)
+    return True
+
+
+def stream():
+    """Async generator over every state, straight from the DB cursor."""
+    return adbc.find(STATE_COLLECTION)
+
+
+@tracing.traced
+async def read_page(sort=None, limit=DEFAULT_PAGE_SIZE,
+                    cursor=None) -> tuple:
+    """Returns (states, next_cursor) for one page, sorted in the DB."""
+    sqry._check_limit(limit)
+    sort = sort or NAME
+    desc = sort.startswith("-")
+    key = sort[1:] if desc else sort
+    if key not in sqry.SORTABLE_FIELDS:
+        raise ValueError(f'Invalid sort field: {key}')
+    return await adbc.read_page(STATE_COLLECTION, key, limit,
+                                cursor=cursor, desc=desc)
+
+
+@tracing.traced
+async def near(lat, lon, max_km=None, limit=DEFAULT_PAGE_SIZE) -> list:
+    """States nearest to (lat, lon); see states.queries.near()."""
+    sqry._check_limit(limit)
+    lat, lon = geo.check_lat_lon(lat, lon)
+    filt = {sqry.LOCATION: geo.near_filter(lat, lon, max_km)}
+    return sqry._add_distances(
+        await adbc.cached_find(STATE_COLLECTION, filt, limit=limit),
+        lat, lon)
+
+
+@tracing.traced
+async def nearest(lat, lon, k: int = 1) -> list:
+    """States closest to (lat, lon); see states.queries.nearest()."""
+    await _ensure_cache()
+    return sqry.nearest(lat, lon, k)
+
+
+@tracing.traced
+async def distances(points: list) -> tuple:
+    """Batch distance matrix; see states.queries.distances()."""
+    await _ensure_cache()
+    return sqry.distances(points)
+
+
+@tracing.traced
+async def distances_within(points: list, km: float) -> list:
+    """Batch radius filter; see states.queries.distances_within()."""
+    await _ensure_cache()
+    return sqry.distances_within(points, km)
+
+
+@tracing.traced
+async def suggest(q: str, limit: int = sqry.DEFAULT_SUGGEST,
+                  country_code: str = None) -> list:
+    """States by name prefix; see states.queries.suggest()."""
+    sqry._check_suggest(q, limit)
+    await _ensure_cache()
+    return sqry.suggest(q, limit, country_code)
+
+
+@tracing.traced
+async def within_radius(lat, lon, km, limit=DEFAULT_PAGE_SIZE) -> list:
+    """States within km of (lat, lon); see states.queries."""
+    sqry._check_limit(limit)
+    lat, lon = geo.check_lat_lon(lat, lon)
+    filt = {sqry.LOCATION: geo.radius_filter(lat, lon, km)}
+    return sqry._add_distances(
+        await adbc.cached_find(STATE_COLLECTION, filt, sort=[(NAME, 1)],
+                               limit=limit), lat, lon)
+
+
+@tracing.traced
+async def within_box(sw_lat, sw_lon, ne_lat, ne_lon,
+                     limit=DEFAULT_PAGE_SIZE) -> list:
+    """States inside a box; see states.queries.within_box()."""
+    sqry._check_limit(limit)
+    filt = {sqry.LOCATION: geo.box_filter(sw_lat, sw_lon, ne_lat, ne_lon)}
+    return await adbc.cached_find(STATE_COLLECTION, filt,
+                                  sort=[(NAME, 1)], limit=limit)
+
+
+@tracing.traced
+async def within_polygon(points: list,
+                         limit=DEFAULT_PAGE_SIZE) -> list:
+    """States inside a polygon; see states.queries.within_polygon()."""
+    sqry._check_limit(limit)
+    filt = {sqry.LOCATION: geo.polygon_filter(points)}
+    return await adbc.cached_find(STATE_COLLECTION, filt,
+                                  sort=[(NAME, 1)], limit=limit)
+
+
+@tracing.traced
+async def total() -> int:
+    """Cached total number of states in the DB."""
+    return await adbc.count(STATE_COLLECTION)
+
+
+version = sqry.version
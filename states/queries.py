@@ -2,9 +2,17 @@
 """
 This file deals with our state-level data.
 """
+import threading
+from collections import Counter
 from functools import wraps
 
 import data.db_connect as dbc
+import data.geo as geo
+import data.geo_batch as geo_batch
+import data.kdtree as kdtree
+import data.metrics as metrics
+import data.prefix_index as prefix_index
+import data.tracing as tracing
 from bson import ObjectId
 
 MIN_ID_LEN = 1
@@ -15,6 +23,12 @@ ID = 'id'
 NAME = 'name'
 STATE_CODE = 'code'
 COUNTRY_CODE = 'country_code'
+LATITUDE = 'latitude'
+LONGITUDE = 'longitude'
+# GeoJSON point built from latitude/longitude by the ETL
+LOCATION = 'location'
+# added to spatial query results
+DISTANCE_KM = 'distance_km'
 
 SAMPLE_CODE = 'NY'
 SAMPLE_COUNTRY = 'USA'
@@ -25,55 +39,215 @@ SAMPLE_STATE = {
     COUNTRY_CODE: SAMPLE_COUNTRY,
 }
 
-# Optional set of sortable fields (unused currently)
+# Fields the paged read can order by
 SORTABLE_FIELDS = {NAME, STATE_CODE, COUNTRY_CODE}
 
-# In-memory cache keyed by (STATE_CODE, COUNTRY_CODE)
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+# most ids get_many() resolves per call
+MAX_IDS = MAX_PAGE_SIZE
+# most query points distances()/distances_within() take per call
+MAX_POINTS = 10000
+DEFAULT_SUGGEST = 10
+MAX_SUGGEST = 100
+
+# near()/within_*() run on this
+dbc.register_index(STATE_COLLECTION, [(LOCATION, geo.GEOSPHERE)],
+                   'location_2dsphere')
+# The cache (and create's duplicate check) is keyed on (code, country)
+dbc.register_index(STATE_COLLECTION, [(STATE_CODE, 1), (COUNTRY_CODE, 1)],
+                   'code_country_code', unique=True)
+# delete() looks states up by (name, code)
+dbc.register_index(STATE_COLLECTION, [(NAME, 1), (STATE_CODE, 1)],
+                   'name_code')
+# read_page() orders case-insensitively on (field, _id)
+for _fld in SORTABLE_FIELDS:
+    dbc.register_index(STATE_COLLECTION, [(_fld, 1), (dbc.MONGO_ID, 1)],
+                       f'{_fld}_id_ci', collation=dbc.CASE_INSENSITIVE)
+
+# In-memory cache keyed by (STATE_CODE, COUNTRY_CODE). Writes patch it in
+# place; load_cache() is the fallback.
 cache = None
+# label for this cache in app_cache_requests_total
+CACHE_NAME = 'states'
+# {id string: cache key}, so changes that only carry an id can be applied
+key_by_id = {}
+# KD-tree over the cached states' locations, for nearest(). Built on
+# first use, then patched along with the cache.
+location_index = None
+# Columnar copy of the same locations for the batch distance queries;
+# rebuilt lazily after any change (it is O(states) to rebuild)
+location_columns = None
+# Name prefix index (scoped by country_code) for suggest(); lazy like
+# location_index
+name_index = None
+# Bumped (under _index_lock) after every cache change. A lazily built
+# index is only installed if no change landed while it was being built
+# from its snapshot; otherwise it would miss that change for good.
+_generation = 0
+_index_lock = threading.Lock()
 
 
 def needs_cache(fn):
     """Decorator: ensures cache is loaded before function runs."""
     @wraps(fn)
     def wrapper(*args, **kwargs):
+        metrics.cache_lookup(CACHE_NAME, cache is not None)
         if cache is None:
             load_cache()
         return fn(*args, **kwargs)
     return wrapper
 
 
+@tracing.traced
 def load_cache():
     """Loads all states from DB into memory, keyed by (code, country)."""
-    global cache
-    cache = {}
-    states = dbc.read(STATE_COLLECTION)
-    for state in states:
-        code = state.get(STATE_CODE)
-        country = state.get(COUNTRY_CODE)
-        if code is None or country is None:
+    new_cache, new_ids = {}, {}
+    keyed = {STATE_CODE: {'$ne': None}, COUNTRY_CODE: {'$ne': None}}
+    for state in dbc.find(STATE_COLLECTION, keyed, no_id=False):
+        key = (state[STATE_CODE], state[COUNTRY_CODE])
+        new_ids[state.pop(dbc.MONGO_ID)] = key
+        new_cache[key] = state
+    _replace_cache(new_cache, new_ids)
+
+
+def _replace_cache(new_cache: dict, new_ids: dict):
+    """Installs a freshly loaded cache; the indexes follow lazily."""
+    global cache, key_by_id, location_index, location_columns, name_index
+    global _generation
+    with _index_lock:
+        cache, key_by_id = new_cache, new_ids
+        location_index = location_columns = name_index = None
+        _generation += 1
+
+
+def _snapshot() -> tuple:
+    """(generation, cached (key, state) pairs) to build an index from."""
+    with _index_lock:
+        return _generation, list(cache.items())
+
+
+def _located(states):
+    """(key, lat, lon) for the (key, state) pairs with a valid location."""
+    for key, state in states:
+        try:
+            lat, lon = geo.lat_lon(state[LOCATION])
+            geo.check_lat_lon(lat, lon)
+        except (KeyError, TypeError, ValueError):
             continue
-        cache[(code, country)] = state
+        yield key, lat, lon
+
+
+def _index_put(key: tuple, state: dict):
+    """Keeps the name and location indexes in step with one state."""
+    global location_columns, _generation
+    with _index_lock:
+        _generation += 1
+        location_columns = None
+        if name_index is not None:
+            name_index.add(key, state.get(NAME), key[1])
+        if location_index is None:
+            return
+        located = list(_located([(key, state)]))
+        if located:
+            location_index.add(*located[0])
+        else:
+            location_index.remove(key)
+
+
+def _index_drop(key: tuple):
+    global location_columns, _generation
+    with _index_lock:
+        _generation += 1
+        location_columns = None
+        if name_index is not None:
+            name_index.remove(key)
+        if location_index is not None:
+            location_index.remove(key)
+
+
+def _key(state: dict):
+    """The cache key for a state, or None if it lacks code or country."""
+    code = state.get(STATE_CODE)
+    country = state.get(COUNTRY_CODE)
+    if code is None or country is None:
+        return None
+    return code, country
+
+
+def _cache_put(state: dict, state_id: str = None):
+    """Adds or replaces one state in the cache, if it is loaded."""
+    key = _key(state)
+    if cache is None or key is None:
+        return
+    rec = dict(state)
+    rec.pop(dbc.MONGO_ID, None)
+    cache[key] = rec
+    _index_put(key, rec)
+    if state_id is not None:
+        key_by_id[state_id] = key
+
+
+def _cache_drop(state: dict, state_id: str = None):
+    """Removes one state from the cache; reloads if it wasn't there."""
+    key = _key(state)
+    if state_id is not None:
+        key_by_id.pop(state_id, None)
+    if cache is None or key is None:
+        return
+    if cache.pop(key, None) is None:
+        load_cache()
+        return
+    _index_drop(key)
 
 
-@needs_cache
-def count() -> int:
-    """Returns total number of cached states."""
+def _on_change(kind: str, state_id: str, doc: dict):
+    """Applies a write made by any process (see dbc.subscribe_changes)."""
     if cache is None:
+        return
+    if kind == dbc.CHANGE_RELOAD:
         load_cache()
-    return len(cache)
+        return
+    old_key = key_by_id.pop(state_id, None)
+    if kind == dbc.CHANGE_DELETE or old_key != _key(doc):
+        cache.pop(old_key, None)
+        _index_drop(old_key)
+    if kind != dbc.CHANGE_DELETE:
+        _cache_put(doc, state_id)
 
 
-@needs_cache
+dbc.subscribe_changes(STATE_COLLECTION, _on_change)
+
+
+@tracing.traced
+def count() -> int:
+    """
+    Returns the number of states: the cache size when it is loaded,
+    otherwise the cached DB count (no full load just to count).
+    """
+    if cache is not None:
+        return len(cache)
+    return dbc.count(STATE_COLLECTION)
+
+
+@tracing.traced
 def num_states() -> int:
-    """Alias for count(); returns total cached states."""
-    if cache is None:
-        load_cache()
-    return len(cache)
+    """Alias for count()."""
+    return count()
 
 
-@needs_cache
-def create(flds: dict, reload=True) -> str:
-    """Creates a new state. Validates fields and checks for duplicates."""
+@tracing.traced
+def count_by_country() -> dict:
+    """{country_code: number of states}, from the cache when loaded."""
+    if cache is not None:
+        return dict(Counter(country for _, country in list(cache)))
+    return {code: n for code, n in
+            dbc.count_by(STATE_COLLECTION, COUNTRY_CODE).items()
+            if code is not None}
+
+
+def _validate(flds: dict) -> tuple:
+    """Checks required fields; returns the (code, country_code) key."""
     if not isinstance(flds, dict):
         raise ValueError(f'Bad type for {type(flds)=}')
     code = flds.get(STATE_CODE)
@@ -84,20 +258,298 @@ def create(flds: dict, reload=True) -> str:
         raise ValueError(f'Bad value for {code=}')
     if not country_code:
         raise ValueError(f'Bad value for {country_code=}')
+    return code, country_code
+
+
+def _batch_validator():
+    """
+    A validate() for dbc.create_many that also rejects keys already in
+    the cache or seen earlier in the same batch. Needs the cache loaded.
+    """
+    seen = set()
+
+    def validate(flds):
+        code, country_code = _validate(flds)
+        if (code, country_code) in cache or (code, country_code) in seen:
+            raise ValueError(f'Duplicate key: {code=}; {country_code=}')
+        seen.add((code, country_code))
+    return validate
+
+
+@tracing.traced
+@needs_cache
+@dbc.patches_cache
+def create(flds: dict, reload=True) -> str:
+    """Creates a new state. Validates fields and checks for duplicates."""
+    code, country_code = _validate(flds)
     if (code, country_code) in cache:
         raise ValueError(f'Duplicate key: {code=}; {country_code=}')
-    new_id = dbc.create(STATE_COLLECTION, flds)
+    new_id = dbc.create(STATE_COLLECTION, dict(flds))
     if reload:
-        load_cache()
+        _cache_put(flds, new_id)
     return new_id
 
 
+@tracing.traced
+@needs_cache
+@dbc.patches_cache
+def create_many(recs: list) -> dict:
+    """
+    Creates many states through unordered bulk inserts and adds the
+    inserted ones to the cache. Duplicates (against the cache or earlier
+    records in the same batch) are reported per item rather than failing
+    the batch.
+    """
+    if not isinstance(recs, list):
+        raise ValueError(f'Bad type for {type(recs)=}')
+    ret = dbc.create_many(STATE_COLLECTION, recs,
+                          validate=_batch_validator())
+    for flds, new_id in zip(recs, ret[dbc.BULK_IDS]):
+        if new_id is not None:
+            _cache_put(flds, new_id)
+    return ret
+
+
+@tracing.traced
+@dbc.patches_cache
+def upsert_many(recs: list, clear: tuple = ()) -> dict:
+    """
+    Inserts or updates states keyed on (code, country_code) in bulk, so
+    re-running a load is idempotent. Fields in clear that a record lacks
+    are removed from the stored state. Invalid records are reported per
+    index, as create_many() does, and the rest still written. Patches
+    the cache with the records that were written.
+    """
+    if not isinstance(recs, list):
+        raise ValueError(f'Bad type for {type(recs)=}')
+    ret = dbc.upsert_many(STATE_COLLECTION, recs, (STATE_CODE, COUNTRY_CODE),
+                          clear=clear, validate=_validate)
+    if cache is not None:
+        failed = {err[dbc.BULK_INDEX] for err in ret[dbc.BULK_ERRORS]}
+        new_ids = ret[dbc.BULK_UPSERTED_IDS]
+        for i, flds in enumerate(recs):
+            if i not in failed:
+                rec = {**cache.get(_key(flds), {}), **flds}
+                for fld in clear:
+                    if fld not in flds:
+                        rec.pop(fld, None)
+                _cache_put(rec, new_ids.get(i))
+    return ret
+
+
+@tracing.traced
 @needs_cache
 def read() -> list:
     """Returns all states as a list from cache."""
     return list(cache.values())
 
 
+def stream():
+    """Lazily yields every state straight from the DB cursor."""
+    return dbc.find(STATE_COLLECTION)
+
+
+def _check_limit(limit: int):
+    if not isinstance(limit, int) or not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+
+
+@tracing.traced
+def read_page(sort=None, limit=DEFAULT_PAGE_SIZE, cursor=None) -> tuple:
+    """
+    Returns (states, next_cursor) for one page, sorted in the DB.
+    Reads Mongo directly rather than the cache so pages are O(limit).
+    """
+    _check_limit(limit)
+    sort = sort or NAME
+    desc = sort.startswith("-")
+    key = sort[1:] if desc else sort
+    if key not in SORTABLE_FIELDS:
+        raise ValueError(f'Invalid sort field: {key}')
+    return dbc.read_page(STATE_COLLECTION, key, limit, cursor=cursor,
+                         desc=desc)
+
+
+def _add_distances(states: list, lat: float, lon: float) -> list:
+    """Sets DISTANCE_KM from (lat, lon) on each state."""
+    for state in states:
+        state[DISTANCE_KM] = round(geo.haversine_km(
+            lat, lon, *geo.lat_lon(state[LOCATION])), 3)
+    return states
+
+
+@tracing.traced
+def near(lat, lon, max_km=None, limit=DEFAULT_PAGE_SIZE) -> list:
+    """
+    Up to limit states closest to (lat, lon), nearest first, within
+    max_km if given. $near on the 2dsphere index; each result carries
+    its distance_km.
+    """
+    _check_limit(limit)
+    lat, lon = geo.check_lat_lon(lat, lon)
+    filt = {LOCATION: geo.near_filter(lat, lon, max_km)}
+    return _add_distances(
+        dbc.cached_find(STATE_COLLECTION, filt, limit=limit), lat, lon)
+
+
+@tracing.traced
+def within_radius(lat, lon, km, limit=DEFAULT_PAGE_SIZE) -> list:
+    """
+    States within km of (lat, lon) ($geoWithin $centerSphere), by name,
+    each with its distance_km.
+    """
+    _check_limit(limit)
+    lat, lon = geo.check_lat_lon(lat, lon)
+    filt = {LOCATION: geo.radius_filter(lat, lon, km)}
+    return _add_distances(
+        dbc.cached_find(STATE_COLLECTION, filt, sort=[(NAME, 1)],
+                        limit=limit), lat, lon)
+
+
+@tracing.traced
+def within_box(sw_lat, sw_lon, ne_lat, ne_lon,
+               limit=DEFAULT_PAGE_SIZE) -> list:
+    """States inside a south-west/north-east box, by name."""
+    _check_limit(limit)
+    filt = {LOCATION: geo.box_filter(sw_lat, sw_lon, ne_lat, ne_lon)}
+    return dbc.cached_find(STATE_COLLECTION, filt, sort=[(NAME, 1)],
+                           limit=limit)
+
+
+@tracing.traced
+def within_polygon(points: list, limit=DEFAULT_PAGE_SIZE) -> list:
+    """States inside a polygon of (lat, lon) points, by name."""
+    _check_limit(limit)
+    filt = {LOCATION: geo.polygon_filter(points)}
+    return dbc.cached_find(STATE_COLLECTION, filt, sort=[(NAME, 1)],
+                           limit=limit)
+
+
+@tracing.traced
+@needs_cache
+def nearest(lat, lon, k: int = 1) -> list:
+    """
+    The k cached states closest to (lat, lon), nearest first, each with
+    its distance_km. Answered in process from a KD-tree over the cache,
+    so there is no DB round trip.
+    """
+    global location_index
+    if not isinstance(k, int) or not 1 <= k <= MAX_PAGE_SIZE:
+        raise ValueError(f'k must be between 1 and {MAX_PAGE_SIZE}')
+    lat, lon = geo.check_lat_lon(lat, lon)
+    index = location_index
+    if index is None:
+        built_at, states = _snapshot()
+        index = kdtree.KDTree(_located(states))
+        with _index_lock:
+            if _generation == built_at:
+                location_index = index
+    found = []
+    for key, km in index.nearest(lat, lon, k):
+        state = cache.get(key)
+        if state is not None:
+            found.append({**state, DISTANCE_KM: round(km, 3)})
+    return found
+
+
+def _columns():
+    global location_columns
+    cols = location_columns
+    if cols is None:
+        built_at, states = _snapshot()
+        cols = geo_batch.Columns(_located(states))
+        with _index_lock:
+            if _generation == built_at:
+                location_columns = cols
+    return cols
+
+
+def _check_points(points):
+    if isinstance(points, list) and len(points) > MAX_POINTS:
+        raise ValueError(f'At most {MAX_POINTS} points per request')
+
+
+def _state_ref(key: tuple) -> dict:
+    return {STATE_CODE: key[0], COUNTRY_CODE: key[1],
+            NAME: (cache.get(key) or {}).get(NAME)}
+
+
+@tracing.traced
+@needs_cache
+def distances(points: list) -> tuple:
+    """
+    (states, km) for a batch of (lat, lon) points: the located cached
+    states as {code, country_code, name}, and per point a row of
+    great-circle km to each of them, computed in one vectorized pass.
+    """
+    _check_points(points)
+    cols = _columns()
+    km = geo_batch.distance_matrix(cols, points)
+    return [_state_ref(key) for key in cols.keys], km
+
+
+@tracing.traced
+@needs_cache
+def distances_within(points: list, km: float) -> list:
+    """
+    For each (lat, lon) in points, the cached states within km of it,
+    nearest first, as {code, country_code, name, distance_km}.
+    """
+    _check_points(points)
+    cols = _columns()
+    return [[{**_state_ref(cols.keys[i]), DISTANCE_KM: dist}
+             for i, dist in hits]
+            for hits in geo_batch.within(cols, points, km)]
+
+
+def _check_suggest(q, limit: int):
+    if not isinstance(q, str) or not prefix_index.normalize(q):
+        raise ValueError('q must be a non-empty string')
+    if not isinstance(limit, int) or not 1 <= limit <= MAX_SUGGEST:
+        raise ValueError(f'limit must be between 1 and {MAX_SUGGEST}')
+
+
+@tracing.traced
+@needs_cache
+def suggest(q: str, limit: int = DEFAULT_SUGGEST,
+            country_code: str = None) -> list:
+    """
+    Cached states whose name starts with q (ignoring case and accents),
+    in name order, optionally only in country_code.
+    """
+    global name_index
+    _check_suggest(q, limit)
+    index = name_index
+    if index is None:
+        built_at, states = _snapshot()
+        index = prefix_index.PrefixIndex(
+            (key, state.get(NAME), key[1]) for key, state in states)
+        with _index_lock:
+            if _generation == built_at:
+                name_index = index
+    found = []
+    for key in index.search(q, limit, scope=country_code,
+                            scoped=country_code is not None):
+        state = cache.get(key)
+        if state is not None:
+            found.append(dict(state))
+    return found
+
+
+def version():
+    """
+    Shared counter that moves on every write to states (for ETags), or
+    None while cache sync is off; see dbc.shared_version().
+    """
+    return dbc.shared_version(STATE_COLLECTION)
+
+
+@tracing.traced
+def total() -> int:
+    """Cached total number of states in the DB."""
+    return dbc.count(STATE_COLLECTION)
+
+
 def is_valid_id(_id: str) -> bool:
     """Checks if _id is a non-empty string."""
     if not isinstance(_id, str):
@@ -107,6 +559,7 @@ def is_valid_id(_id: str) -> bool:
     return True
 
 
+@tracing.traced
 @needs_cache
 def get_by_id(state_id: str) -> dict:
     """Fetches a single state by its MongoDB ObjectId string."""
@@ -118,36 +571,79 @@ def get_by_id(state_id: str) -> dict:
     return rec
 
 
+def _many_from_cache(ids: list) -> dict:
+    """{id: state with its _id} for the ids found in the loaded cache."""
+    dbc.check_id_list(ids, MAX_IDS)
+    metrics.cache_lookup(CACHE_NAME, cache is not None)
+    if cache is None:
+        return {}
+    found = {}
+    for state_id in ids:
+        key = key_by_id.get(state_id)
+        if key in cache:
+            found[state_id] = {**cache[key], dbc.MONGO_ID: state_id}
+    return found
+
+
+@tracing.traced
+def get_many(ids: list) -> list:
+    """
+    States for ids in request order, None where an id matches no state.
+    Served from the cache when it is loaded; any ids it lacks (or all of
+    them, when it isn't) are fetched in one $in query.
+    """
+    found = _many_from_cache(ids)
+    missing = [state_id for state_id in ids if state_id not in found]
+    if missing:
+        found.update(dbc.read_by_ids(STATE_COLLECTION, missing))
+    return [found.get(state_id) for state_id in ids]
+
+
+@tracing.traced
 @needs_cache
+@dbc.patches_cache
 def update_by_id(state_id: str, update_fields: dict) -> bool:
-    """Updates a state by id. Returns True if a document was modified."""
+    """Updates a state by id. Returns True if any field actually changed."""
     if not is_valid_id(state_id):
         raise ValueError('Invalid id')
     if not isinstance(update_fields, dict):
         raise ValueError('update_fields must be a dict')
-    res = dbc.update(
+    before = dbc.update_and_fetch(
         STATE_COLLECTION, {dbc.MONGO_ID: ObjectId(state_id)}, update_fields)
-    load_cache()
-    return getattr(res, 'modified_count', 0) > 0
+    if before is None:
+        return False
+    after = {**before, **update_fields}
+    if _key(after) != _key(before):
+        _cache_drop(before, state_id)
+    _cache_put(after, state_id)
+    return any(before.get(k) != v for k, v in update_fields.items())
 
 
+@tracing.traced
 @needs_cache
+@dbc.patches_cache
 def delete_by_id(state_id: str) -> bool:
     """Deletes a state by id. Returns True if a document was deleted."""
     if not is_valid_id(state_id):
         raise ValueError('Invalid id')
-    deleted = dbc.delete(STATE_COLLECTION, {dbc.MONGO_ID: ObjectId(state_id)})
-    load_cache()
-    return deleted > 0
+    deleted = dbc.delete_and_fetch(
+        STATE_COLLECTION, {dbc.MONGO_ID: ObjectId(state_id)})
+    if deleted is None:
+        return False
+    _cache_drop(deleted, state_id)
+    return True
 
 
-def delete(name: str, state_code: str) -> bool:
+@tracing.traced
+@dbc.patches_cache
+def delete(name: str, state_code: str) -> int:
     """Deletes a state by name + code (legacy). Raises if not found."""
-    ret = dbc.delete(STATE_COLLECTION, {NAME: name, STATE_CODE: state_code})
-    if ret < 1:
+    deleted = dbc.delete_and_fetch(
+        STATE_COLLECTION, {NAME: name, STATE_CODE: state_code})
+    if deleted is None:
         raise ValueError(f'State not found: {state_code}')
-    load_cache()
-    return ret
+    _cache_drop(deleted, deleted[dbc.MONGO_ID])
+    return 1
 
 
 # def read_sorted(sort=None):
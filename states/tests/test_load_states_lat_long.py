@@ -0,0 +1,51 @@
+import pytest
+
+import states.ETL.load_states_lat_long as etl
+import states.queries as qry
+
+HEADER = [qry.STATE_CODE, qry.LATITUDE, qry.LONGITUDE, qry.NAME]
+
+
+def test_add_location():
+    state = {qry.STATE_CODE: 'NY', qry.LATITUDE: '43.0',
+             qry.LONGITUDE: '-75.0'}
+    etl.add_location(state)
+    assert state[qry.LOCATION] == qry.geo.point(43, -75)
+    assert (state[qry.LATITUDE], state[qry.LONGITUDE]) == (43.0, -75.0)
+
+
+@pytest.mark.parametrize('coords', [
+    {qry.LATITUDE: '', qry.LONGITUDE: ''},
+    {qry.LATITUDE: 'north', qry.LONGITUDE: '-75.0'},
+    {qry.LATITUDE: '95.0', qry.LONGITUDE: '-75.0'},
+    {qry.LATITUDE: '43.0'},
+    {},
+])
+def test_add_location_bad_coordinates(coords):
+    state = {qry.STATE_CODE: 'NY', **coords}
+    etl.add_location(state)
+    assert not set(etl.GEO_FIELDS) & set(state)
+
+
+def test_transform():
+    rows = [list(HEADER),
+            ['NY', '43.0', '-75.0', 'New York'],
+            ['XX', '', '', 'Nowhere']]
+    good, bad = etl.transform(rows)
+    assert good[qry.COUNTRY_CODE] == bad[qry.COUNTRY_CODE] == 'USA'
+    assert good[qry.LOCATION] == qry.geo.point(43, -75)
+    assert bad == {qry.STATE_CODE: 'XX', qry.NAME: 'Nowhere',
+                   qry.COUNTRY_CODE: 'USA'}
+
+
+def test_load_clears_geo_fields(monkeypatch):
+    """Rows without coordinates drop any stored location."""
+    calls = []
+
+    def upsert_many(recs, clear=()):
+        calls.append((recs, clear))
+        return {qry.dbc.BULK_ERRORS: []}
+    monkeypatch.setattr(etl, 'upsert_many', upsert_many)
+    recs = [{qry.STATE_CODE: 'XX', qry.COUNTRY_CODE: 'USA'}]
+    etl.load(recs)
+    assert calls == [(recs, etl.GEO_FIELDS)]
@@ -98,6 +98,7 @@ def test_get_by_id(temp_state):
     state = qry.get_by_id(temp_state)
     assert state is not None
     assert qry.NAME in state
+    assert state[qry.dbc.MONGO_ID] == temp_state  # a str, like get_many's
 
 
 def test_get_by_id_invalid():
@@ -156,3 +157,292 @@ def test_create_missing_state_code():
 def test_create_missing_country_code():
     with pytest.raises(ValueError):
         qry.create({qry.NAME: 'Test', qry.STATE_CODE: 'TS'})
+
+
+def test_read_page(temp_state):
+    states, cursor = qry.read_page(limit=1)
+    assert len(states) <= 1
+    if cursor is not None:
+        more, _ = qry.read_page(limit=1, cursor=cursor)
+        assert more != states
+
+
+def test_read_page_bad_limit():
+    with pytest.raises(ValueError, match='limit'):
+        qry.read_page(limit=0)
+
+
+def test_total():
+    assert qry.total() >= 0
+
+
+def test_stream(temp_state_no_del):
+    assert any(
+        s.get(qry.STATE_CODE) == temp_state_no_del[qry.STATE_CODE]
+        for s in qry.stream()
+    )
+
+
+def test_create_many_reports_duplicates():
+    rec = get_temp_rec()
+    ret = qry.create_many([rec, deepcopy(rec), {}])
+    ids = ret[qry.dbc.BULK_IDS]
+    try:
+        assert qry.is_valid_id(ids[0])
+        assert ids[1] is None and ids[2] is None
+        assert [e[qry.dbc.BULK_INDEX]
+                for e in ret[qry.dbc.BULK_ERRORS]] == [1, 2]
+        assert (rec[qry.STATE_CODE], rec[qry.COUNTRY_CODE]) in qry.cache
+    finally:
+        for new_id in filter(None, ids):
+            qry.delete_by_id(new_id)
+
+
+def test_upsert_many_is_idempotent():
+    rec = get_temp_rec()
+    qry.upsert_many([rec])
+    try:
+        old_count = qry.num_states()
+        ret = qry.upsert_many([deepcopy(rec)])
+        assert ret['upserted'] == 0
+        assert qry.num_states() == old_count
+    finally:
+        qry.delete(rec[qry.NAME], rec[qry.STATE_CODE])
+
+
+def test_upsert_many_clears_cached_fields(monkeypatch):
+    """Fields the load clears don't linger in the cache."""
+    ny = {qry.NAME: 'New York', qry.STATE_CODE: 'NY',
+          qry.COUNTRY_CODE: 'USA', qry.LOCATION: qry.geo.point(43, -75)}
+    monkeypatch.setattr(qry, 'cache', {('NY', 'USA'): dict(ny)})
+    monkeypatch.setattr(qry, 'key_by_id', {})
+    monkeypatch.setattr(qry.dbc, 'upsert_many', lambda *a, **kw: {
+        qry.dbc.BULK_ERRORS: [], qry.dbc.BULK_UPSERTED_IDS: {}})
+    rec = {qry.NAME: 'New York', qry.STATE_CODE: 'NY',
+           qry.COUNTRY_CODE: 'USA'}
+    qry.upsert_many([rec], clear=(qry.LOCATION,))
+    assert qry.cache[('NY', 'USA')] == rec
+
+
+def test_upsert_many_reports_bad_rows(monkeypatch):
+    """One bad row doesn't abort the load."""
+    sent = []
+
+    def bulk_write(coll, requests, **kw):
+        sent.extend(requests)
+        return {qry.dbc.BULK_ERRORS: [], qry.dbc.BULK_UPSERTED_IDS: {}}
+    monkeypatch.setattr(qry.dbc, 'bulk_write', bulk_write)
+    monkeypatch.setattr(qry, 'cache', {})
+    monkeypatch.setattr(qry, 'key_by_id', {})
+    ny = {qry.NAME: 'New York', qry.STATE_CODE: 'NY',
+          qry.COUNTRY_CODE: 'USA'}
+    ret = qry.upsert_many([{qry.NAME: 'No Code'}, ny])
+    assert [err[qry.dbc.BULK_INDEX]
+            for err in ret[qry.dbc.BULK_ERRORS]] == [0]
+    assert len(sent) == 1
+    assert qry.cache == {('NY', 'USA'): ny}
+
+
+def test_writes_patch_cache_without_reload(monkeypatch):
+    rec = get_temp_rec()
+    key = (rec[qry.STATE_CODE], rec[qry.COUNTRY_CODE])
+    qry.read()  # make sure the cache is loaded
+    new_id = qry.create(rec)
+    monkeypatch.setattr(qry, 'load_cache', lambda: pytest.fail(
+        'cache should be patched, not reloaded'))
+    assert qry.cache[key] == rec
+    assert qry.update_by_id(new_id, {qry.NAME: 'Patched State'})
+    assert qry.cache[key][qry.NAME] == 'Patched State'
+    assert qry.delete_by_id(new_id)
+    assert key not in qry.cache
+
+
+def test_on_change_moves_key(monkeypatch):
+    monkeypatch.setattr(qry, 'cache', {('A', 'X'): {qry.NAME: 'a'}})
+    monkeypatch.setattr(qry, 'key_by_id', {'id1': ('A', 'X')})
+    doc = {qry.NAME: 'b', qry.STATE_CODE: 'B', qry.COUNTRY_CODE: 'X'}
+    qry._on_change(qry.dbc.CHANGE_UPDATE, 'id1', doc)
+    assert qry.cache == {('B', 'X'): doc}
+    qry._on_change(qry.dbc.CHANGE_DELETE, 'id1', None)
+    assert qry.cache == {}
+    # a repeated delete (e.g. our own write echoed back) is harmless
+    qry._on_change(qry.dbc.CHANGE_DELETE, 'id1', None)
+
+
+def test_counts_without_cache_load(monkeypatch):
+    monkeypatch.setattr(qry, 'cache', None)
+    monkeypatch.setattr(qry, 'load_cache', lambda: pytest.fail(
+        'counting should not load the cache'))
+    monkeypatch.setattr(qry.dbc, 'count', lambda coll: 7)
+    monkeypatch.setattr(qry.dbc, 'count_by',
+                        lambda coll, fld: {'USA': 5, None: 2})
+    assert qry.count() == 7
+    assert qry.count_by_country() == {'USA': 5}
+
+
+def test_count_by_country_from_cache(monkeypatch):
+    monkeypatch.setattr(qry, 'cache', {('NY', 'USA'): {}, ('NJ', 'USA'): {},
+                                       ('ON', 'CAN'): {}})
+    assert qry.count() == 3
+    assert qry.count_by_country() == {'USA': 2, 'CAN': 1}
+
+
+def test_get_many_from_cache(monkeypatch):
+    monkeypatch.setattr(qry, 'cache', {('NY', 'USA'): {qry.NAME: 'NY'}})
+    monkeypatch.setattr(qry, 'key_by_id', {'a': ('NY', 'USA')})
+    monkeypatch.setattr(qry.dbc, 'read_by_ids', lambda coll, ids: {})
+    assert qry.get_many(['x', 'a']) == [
+        None, {qry.NAME: 'NY', qry.dbc.MONGO_ID: 'a'}]
+
+
+def test_near_adds_distance(monkeypatch):
+    calls = []
+
+    def cached_find(coll, filt, **kwargs):
+        calls.append((filt, kwargs))
+        return [{qry.NAME: 'A', qry.LOCATION: qry.geo.point(41, -74)}]
+    monkeypatch.setattr(qry.dbc, 'cached_find', cached_find)
+    states = qry.near(40, -74, max_km=200, limit=5)
+    assert states[0][qry.DISTANCE_KM] == pytest.approx(111.2, abs=0.1)
+    filt, kwargs = calls[0]
+    assert filt[qry.LOCATION]['$near']['$maxDistance'] == 200000
+    assert kwargs == {'limit': 5}
+
+
+def test_within_bad_limit():
+    with pytest.raises(ValueError):
+        qry.within_box(1, 2, 3, 4, limit=0)
+
+
+def test_nearest_follows_cache_writes(monkeypatch):
+    ny, ca = ('NY', 'USA'), ('CA', 'USA')
+    monkeypatch.setattr(qry, 'cache', {
+        ny: {qry.NAME: 'New York', qry.LOCATION: qry.geo.point(43, -75)},
+        ('XX', 'USA'): {qry.NAME: 'No location'},
+    })
+    monkeypatch.setattr(qry, 'key_by_id', {})
+    monkeypatch.setattr(qry, 'location_index', None)
+    monkeypatch.setattr(qry, 'load_cache', lambda: pytest.fail(
+        'nearest should not reload'))
+    assert [s[qry.NAME] for s in qry.nearest(40, -74, k=5)] == ['New York']
+    qry._cache_put({qry.NAME: 'California', qry.STATE_CODE: 'CA',
+                    qry.COUNTRY_CODE: 'USA',
+                    qry.LOCATION: qry.geo.point(37, -120)})
+    found = qry.nearest(36, -119, k=2)
+    assert [s[qry.NAME] for s in found] == ['California', 'New York']
+    assert found[0][qry.DISTANCE_KM] < found[1][qry.DISTANCE_KM]
+    qry._cache_drop({qry.STATE_CODE: 'CA', qry.COUNTRY_CODE: 'USA'})
+    assert ca not in qry.location_index
+    with pytest.raises(ValueError):
+        qry.nearest(40, -74, k=0)
+
+
+def test_nearest_build_racing_a_write(monkeypatch):
+    """A write landing mid-build isn't lost from the KD-tree."""
+    monkeypatch.setattr(qry, 'cache', {
+        ('NY', 'USA'): {qry.NAME: 'New York',
+                        qry.LOCATION: qry.geo.point(43, -75)}})
+    monkeypatch.setattr(qry, 'key_by_id', {})
+    monkeypatch.setattr(qry, 'location_index', None)
+    real_tree = qry.kdtree.KDTree
+
+    def tree_with_write(items):
+        tree = real_tree(items)
+        if qry.cache.get(('CA', 'USA')) is None:
+            qry._cache_put({qry.NAME: 'California', qry.STATE_CODE: 'CA',
+                            qry.COUNTRY_CODE: 'USA',
+                            qry.LOCATION: qry.geo.point(37, -120)})
+        return tree
+    monkeypatch.setattr(qry.kdtree, 'KDTree', tree_with_write)
+    qry.nearest(40, -74)
+    assert qry.location_index is None  # stale build was not installed
+    found = qry.nearest(36, -119)
+    assert [s[qry.NAME] for s in found] == ['California']
+    assert ('CA', 'USA') in qry.location_index
+
+
+def test_columns_build_racing_a_write(monkeypatch):
+    """Columns built across a write are not kept."""
+    monkeypatch.setattr(qry, 'cache', {
+        ('NY', 'USA'): {qry.NAME: 'New York',
+                        qry.LOCATION: qry.geo.point(43, -75)}})
+    monkeypatch.setattr(qry, 'key_by_id', {})
+    monkeypatch.setattr(qry, 'location_columns', None)
+    real_columns = qry.geo_batch.Columns
+
+    def columns_with_write(items):
+        cols = real_columns(items)
+        if qry.cache.get(('CA', 'USA')) is None:
+            qry._cache_put({qry.NAME: 'California', qry.STATE_CODE: 'CA',
+                            qry.COUNTRY_CODE: 'USA',
+                            qry.LOCATION: qry.geo.point(37, -120)})
+        return cols
+    monkeypatch.setattr(qry.geo_batch, 'Columns', columns_with_write)
+    qry.distances([[40, -74]])
+    assert qry.location_columns is None
+    states, _ = qry.distances([[40, -74]])
+    assert {s[qry.STATE_CODE] for s in states} == {'NY', 'CA'}
+    assert qry.location_columns is not None
+
+
+def test_suggest_follows_cache_writes(monkeypatch):
+    monkeypatch.setattr(qry, 'cache', {
+        ('NY', 'USA'): {qry.NAME: 'New York'},
+        ('NB', 'CAN'): {qry.NAME: 'New Brunswick'},
+    })
+    monkeypatch.setattr(qry, 'key_by_id', {})
+    monkeypatch.setattr(qry, 'name_index', None)
+    monkeypatch.setattr(qry, 'load_cache', lambda: pytest.fail(
+        'suggest should not reload'))
+    assert [s[qry.NAME] for s in qry.suggest('new')] == ['New Brunswick',
+                                                         'New York']
+    assert qry.suggest('new', country_code='USA') == [
+        {qry.NAME: 'New York'}]
+    qry._cache_put({qry.NAME: 'New Jersey', qry.STATE_CODE: 'NJ',
+                    qry.COUNTRY_CODE: 'USA'})
+    assert [s[qry.NAME] for s in qry.suggest('new j')] == ['New Jersey']
+    qry._cache_drop({qry.STATE_CODE: 'NY', qry.COUNTRY_CODE: 'USA'})
+    assert [s[qry.NAME] for s in qry.suggest('NEW', 5, 'USA')] == [
+        'New Jersey']
+    with pytest.raises(ValueError):
+        qry.suggest('new', limit=0)
+
+
+def test_suggest_build_racing_a_write(monkeypatch):
+    """A state written while the name index is built still shows up."""
+    monkeypatch.setattr(qry, 'cache', {('NY', 'USA'): {qry.NAME: 'New York'}})
+    monkeypatch.setattr(qry, 'key_by_id', {})
+    monkeypatch.setattr(qry, 'name_index', None)
+    real_index = qry.prefix_index.PrefixIndex
+
+    def index_with_write(items):
+        index = real_index(items)
+        if ('NJ', 'USA') not in qry.cache:
+            qry._cache_put({qry.NAME: 'New Jersey', qry.STATE_CODE: 'NJ',
+                            qry.COUNTRY_CODE: 'USA'})
+        return index
+    monkeypatch.setattr(qry.prefix_index, 'PrefixIndex', index_with_write)
+    qry.suggest('new')
+    assert qry.name_index is None
+    assert [s[qry.NAME] for s in qry.suggest('new')] == ['New Jersey',
+                                                         'New York']
+
+
+def test_batch_distances_follow_cache(monkeypatch):
+    monkeypatch.setattr(qry, 'cache', {
+        ('NY', 'USA'): {qry.NAME: 'New York',
+                        qry.LOCATION: qry.geo.point(43, -75)},
+    })
+    monkeypatch.setattr(qry, 'key_by_id', {})
+    monkeypatch.setattr(qry, 'location_columns', None)
+    states, km = qry.distances([[43, -75], [44, -75]])
+    assert states == [{qry.STATE_CODE: 'NY', qry.COUNTRY_CODE: 'USA',
+                       qry.NAME: 'New York'}]
+    assert km[0] == [0.0] and km[1][0] == pytest.approx(111.2, abs=0.1)
+    qry._cache_put({qry.NAME: 'New Jersey', qry.STATE_CODE: 'NJ',
+                    qry.COUNTRY_CODE: 'USA',
+                    qry.LOCATION: qry.geo.point(40, -74.5)})
+    within = qry.distances_within([[40.1, -74.5]], 200)
+    assert [s[qry.STATE_CODE] for s in within[0]] == ['NJ']
+    with pytest.raises(ValueError):
+        qry.distances([[0, 0]] * (qry.MAX_POINTS + 1))